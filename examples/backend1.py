@@ -125,7 +125,7 @@ class Float4(TypeImplementation):
         '''
         return POINTER(c_float)
 
-    def ctype_argument(self, backend, value):
+    def ctype_argument(self, backend, value, attrs=()):
         '''Defines how python object is converted to ctype argument
         '''
         if isinstance(value, int) or isinstance(value, long): # an address
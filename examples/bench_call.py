@@ -0,0 +1,73 @@
+# Call overhead microbenchmark
+#
+# Measures calls per second of a JIT'ed scalar function through
+# the generic per-argument conversion loop (the old wrapper), the
+# generated wrapper and its unchecked fast path.  The speedup is relative
+# to the generic wrapper.
+#
+
+import timeit
+from mlvm.ir import *
+from mlvm.jit import JIT
+from mlvm.llvm.backend import LLVMBackend
+from mlvm.llvm.jit import LLVMExecutionManager
+
+N = 200000
+
+def build_context():
+    context = Context(TypeSystem())
+
+    # int32 foo(int32 x, int32 y) { return x + y; }
+    foo = context.add_function("foo")
+    foodef = foo.add_definition('int32', ('int32', 'int32'))
+    fooimpl = foodef.implement()
+    b = Builder(fooimpl.append_basic_block())
+    x, y = fooimpl.args
+    b.ret(b.add(x, y))
+    return context, foodef
+
+def generic_wrapper(backend, funcdef, callable):
+    '''The wrapper as it was before build_wrapper generated specialized
+    wrappers.
+    '''
+    get_ty_impl = backend.get_type_implementation
+    rettyimpl = get_ty_impl(funcdef.return_type)
+    argtyimpls = [get_ty_impl(x) for x in funcdef.args]
+
+    def _wrapper(*args):
+        actual_args = []
+        if len(argtyimpls) != len(args):
+            raise TypeError("Function takes exactly %d arguments; but got %d" %\
+                            (len(argtyimpls), len(args)))
+        for ty, arg in zip(argtyimpls, args):
+            actual_args.append(ty.ctype_argument(backend, arg))
+        retval = callable(*actual_args)
+        return rettyimpl.ctype_return(backend, retval)
+    return _wrapper
+
+def calls_per_second(fn):
+    elapsed = min(timeit.repeat(lambda: fn(1, 2), number=N, repeat=3))
+    return N / elapsed
+
+def bench_call():
+    context, funcdef = build_context()
+
+    backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+    manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+    jit = JIT(manager, {'': backend})
+    function = jit.compile(funcdef)
+
+    before = generic_wrapper(backend, funcdef, function.ctype)
+
+    baseline = calls_per_second(before)
+    print "Calls per second".center(80, '=')
+    print "%-20s %12s %8s" % ("", "calls/s", "speedup")
+    for name, fn in [("generic wrapper", before),
+                     ("generated wrapper", function),
+                     ("unchecked", function.unchecked),
+                     ("raw ctypes", function.ctype)]:
+        rate = baseline if fn is before else calls_per_second(fn)
+        print "%-20s %12.0f %7.2fx" % (name, rate, rate / baseline)
+
+if __name__ == '__main__':
+    bench_call()
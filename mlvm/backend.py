@@ -2,6 +2,13 @@
 class TypeUnimplementedError(Exception):
     pass
 
+def argument_attributes(funcdef):
+    '''List the attribute set of each argument of a definition.
+    '''
+    if funcdef.is_declaration:
+        return [set() for _ in funcdef.args]
+    return [arg.attributes for arg in funcdef.implementation.args]
+
 class TypeImplementation(object):
     def __init__(self, name):
         self.__name = name
@@ -22,7 +29,17 @@ class TypeImplementation(object):
     def ctype(self, backend):
         raise NotImplementedError
 
-    def ctype_argument(self, backend, value):
+    def ctype_parameter(self, backend):
+        '''The ctype in the prototype of a JIT'ed function.
+        It must accept the values returned by ctype_argument.
+        '''
+        return self.ctype(backend)
+
+    def ctype_argument(self, backend, value, attrs=()):
+        '''Convert a Python value for the ctype function.
+
+        attrs --- the attributes of the argument; see argument_attributes.
+        '''
         return value
 
     def ctype_return(self, backend, value):
@@ -64,6 +81,21 @@ class TypeImplementation(object):
     def epilog(self, backend, builder, arg, value, attrs):
         pass
 
+    def unbox(self, backend, builder, api, obj, attrs):
+        '''Convert a Python object to the argument representation in
+        native code.
+
+        Returns (value, cleanup).  `cleanup` is None or a callable that
+        takes a builder and emits code to run after the call.
+        '''
+        raise NotImplementedError
+
+    def box(self, backend, builder, api, value):
+        '''Convert a return value to a new reference of a Python object
+        in native code.
+        '''
+        raise NotImplementedError
+
 class Value(object):
     '''
     Use to aid translation from MLVM IR to LLVM IR
@@ -35,6 +35,16 @@ _builtin_special = ['pred', 'address']
 
 _builtin_void = ['void']
 
+# SIMD vector types: name -> (element type, number of lanes)
+_builtin_vector = {'float4'  : ('float', 4),
+                   'float8'  : ('float', 8),
+                   'double2' : ('double', 2),
+                   'double4' : ('double', 4),
+                   'int32x4' : ('int32', 4),
+                   'int32x8' : ('int32', 8),
+                   'int64x2' : ('int64', 2),
+                   'int64x4' : ('int64', 4),}
+
 _builtin_int = _builtin_signed_int + _builtin_unsigned_int
 
 def _build_implicit_cast_table():
@@ -75,8 +85,10 @@ class TypeSystem(object):
     builtin_unsigned_int = _builtin_unsigned_int
     builtin_int = _builtin_signed_int + _builtin_unsigned_int
     builtin_special = _builtin_special
+    builtin_vector = sorted(_builtin_vector)
 
-    builtins = _builtin_special + _builtin_int + _builtin_real + _builtin_void
+    builtins = (_builtin_special + _builtin_int + _builtin_real +
+                _builtin_void + sorted(_builtin_vector))
 
     builtin_implicit_cast = _build_implicit_cast_table()
 
@@ -402,10 +414,22 @@ class FunctionImplementation(object):
                                                 namemap[id(term.condition)],
                                                 idx_of_bb(term.true_branch),
                                                 idx_of_bb(term.false_branch)))
+            elif isinstance(term, ParallelBranch):
+                term_template = "{:>12s} {:s}, {:s} [{:s}, {:s}] ; {:s} {:d}"
+                buf.append(term_template.format('pbr',
+                                                namemap[id(term.index)],
+                                                namemap[id(term.stop)],
+                                                idx_of_bb(term.body),
+                                                idx_of_bb(term.destination),
+                                                term.schedule, term.chunk))
             elif isinstance(term, Branch):
                 term_template = "{:>12s} {:s}"
                 buf.append(term_template.format('br',
                                                 idx_of_bb(term.destination)))
+                if term.hints:
+                    hints = ', '.join('%s=%s' % kv
+                                      for kv in sorted(term.hints.items()))
+                    buf[-1] += ' ; loop hints: %s' % hints
             elif isinstance(term, Return):
                 term_template = "{:>12s} {:s}"
                 if term.value:
@@ -514,11 +538,58 @@ class BasicBlock(object):
 class Branch(object):
     def __init__(self, dest):
         self.__dest = dest
+        self.__hints = {}
 
     @property
     def destination(self):
         return self.__dest
 
+    @property
+    def hints(self):
+        '''Loop hints of a loop back-edge.  See mlvm.irutil.for_loop.
+        '''
+        return self.__hints
+
+class ParallelBranch(Branch):
+    '''Run the blocks from `body` once for every value of `index` in
+    [index, stop), concurrently, then continue at `destination`.
+    A branch to `destination` in the body ends an iteration.
+    See mlvm.irutil.parallel_range.
+    '''
+    SCHEDULES = ('static', 'dynamic')
+
+    def __init__(self, index, stop, body, dest, schedule='static', chunk=0):
+        super(ParallelBranch, self).__init__(dest)
+        if schedule not in self.SCHEDULES:
+            raise ValueError("Unknown schedule: %s" % schedule)
+        self.__index = index
+        self.__stop = stop
+        self.__body = body
+        self.__schedule = schedule
+        self.__chunk = chunk
+
+    @property
+    def index(self):
+        return self.__index
+
+    @property
+    def stop(self):
+        return self.__stop
+
+    @property
+    def body(self):
+        return self.__body
+
+    @property
+    def schedule(self):
+        return self.__schedule
+
+    @property
+    def chunk(self):
+        '''Number of iterations per task; 0 lets the runtime choose.
+        '''
+        return self.__chunk
+
 class Return(object):
     def __init__(self, value):
         self.__value = value
@@ -205,6 +205,12 @@ class Builder(object):
         self.basic_block.terminator = br
         return br
 
+    def parallel_branch(self, index, stop, body, dest, schedule='static',
+                        chunk=0):
+        br = ParallelBranch(index, stop, body, dest, schedule, chunk)
+        self.basic_block.terminator = br
+        return br
+
     def compare(self, op, lhs, rhs):
         cmp = Compare(op, lhs, rhs)
         self.basic_block.operations.append(cmp)
@@ -1,8 +1,34 @@
 import contextlib
 from mlvm.ir import Builder
 
+#
+# Loop hints
+#
+# for_loop, for_range and for_slice accept keyword hints for the optimizer.
+# They are attached to the back-edge of the loop; see Branch.hints.
+#
+#   vectorize_width=N  --- vectorize with N lanes; 1 disables vectorization
+#   interleave=N       --- interleave N vectorized iterations
+#   unroll=N           --- unroll N times
+#   independent=True   --- no iteration reads or writes memory that another
+#                          iteration writes; the vectorizer skips its
+#                          runtime alias checks
+#
+# Hints are advisory; a backend drops the hints it does not support.
+# A wrong `independent` hint is undefined behavior.
+#
+
+LOOP_HINTS = frozenset(['vectorize_width', 'interleave', 'unroll',
+                        'independent'])
+
+def _check_hints(hints):
+    for name in hints:
+        if name not in LOOP_HINTS:
+            raise TypeError("Unknown loop hint: %s" % name)
+
 @contextlib.contextmanager
-def for_loop(builder):
+def for_loop(builder, **hints):
+    _check_hints(hints)
     bbentry = builder.basic_block
     bbcond = builder.append_basic_block()
     bbbody = builder.append_basic_block()
@@ -35,6 +61,9 @@ def for_loop(builder):
             '''
             builder.set_basic_block(bbbody)
             yield
+            # a block without terminator returns in a void function
+            if builder.basic_block.terminator is None:
+                builder.branch(bbstep)
 
         @contextlib.contextmanager
         def step(self):
@@ -43,7 +72,8 @@ def for_loop(builder):
             '''
             builder.set_basic_block(bbstep)
             yield
-            builder.branch(bbcond)
+            backedge = builder.branch(bbcond)
+            backedge.hints.update(hints)
 
         def break_loop(self):
             '''Break out of the the loop-body
@@ -60,9 +90,9 @@ def for_loop(builder):
 
 
 @contextlib.contextmanager
-def for_range(builder, index, stop, step=None):
+def for_range(builder, index, stop, step=None, **hints):
     step = step or builder.const(index.type, 1)
-    with for_loop(builder) as loop:
+    with for_loop(builder, **hints) as loop:
         with loop.cond() as setcond:
             pred = builder.compare('<', index, stop)
             setcond(pred)
@@ -72,6 +102,99 @@ def for_range(builder, index, stop, step=None):
             index_next = builder.add(index, step)
             builder.assign(index_next, index)
 
+@contextlib.contextmanager
+def for_slice(builder, index, array, **hints):
+    '''Loop `index` over [0, array_len(array)) of a slice array.
+    The length is read once before the loop.
+    '''
+    builder.assign(builder.const(index.type, 0), index)
+    stop = builder.array_len(array)
+    with for_range(builder, index, stop, **hints):
+        yield
+
+@contextlib.contextmanager
+def _loop_nest(builder, indices, starts, stops, steps, hints):
+    '''Nested for_range loops; the hints apply to the innermost.
+    '''
+    if not indices:
+        yield
+        return
+    builder.assign(starts[0], indices[0])
+    inner_hints = hints if len(indices) == 1 else {}
+    with for_range(builder, indices[0], stops[0], steps[0], **inner_hints):
+        with _loop_nest(builder, indices[1:], starts[1:], stops[1:],
+                        steps[1:], hints):
+            yield
+
+@contextlib.contextmanager
+def for_tiled(builder, indices, bounds, tile_sizes, **hints):
+    '''Loop the indices over [0, bounds[k]) tile by tile; the first index
+    is the outermost.  A tile spans tile_sizes[k] values of index k, or the
+    remainder at the end of the range.
+
+    indices    --- integer variables.
+    bounds     --- the stop of each index.
+    tile_sizes --- positive integers.
+    hints      --- loop hints of the innermost loop; see for_loop.
+    '''
+    _check_hints(hints)
+    if not len(indices) == len(bounds) == len(tile_sizes):
+        raise ValueError("Expect a bound and a tile size for every index")
+    for size in tile_sizes:
+        if size < 1:
+            raise ValueError("Tile sizes must be positive: %r" % (size,))
+
+    bounds = [builder.cast(n, x.type) for n, x in zip(bounds, indices)]
+    tiles = [builder.var(x.type) for x in indices]
+    ends = [builder.var(x.type) for x in indices]
+    zeros = [builder.const(x.type, 0) for x in indices]
+    sizes = [builder.const(x.type, size)
+             for x, size in zip(indices, tile_sizes)]
+    with _loop_nest(builder, tiles, zeros, bounds, sizes, {}):
+        # end = min(tile + size, bound)
+        for tile, end, bound, size in zip(tiles, ends, bounds, sizes):
+            builder.assign(builder.add(tile, size), end)
+            with if_else(builder, builder.compare('>', end, bound)) as ifelse:
+                with ifelse.true():
+                    builder.assign(bound, end)
+                with ifelse.false():
+                    pass
+        with _loop_nest(builder, indices, tiles, ends, [None] * len(indices),
+                        hints):
+            yield
+
+@contextlib.contextmanager
+def parallel_range(builder, index, stop, schedule='static', chunk=0,
+                   **hints):
+    '''Run the body once for every value of `index` in [index, stop) on
+    the threads of the backend.  Iterations run in any order and must not
+    depend on each other.
+
+    schedule --- 'static' splits the range into equal chunks per thread;
+                 'dynamic' hands out chunks to the threads as they finish.
+    chunk    --- (optional) iterations per chunk; 0 lets the backend choose.
+    hints    --- loop hints of the iterations of a thread; see for_loop.
+
+    The index and the variables used only in the body are private to each
+    thread.  Other variables and arguments are read when the loop starts;
+    if the body assigns them, all threads share them.  The index keeps its
+    value after the loop.  The body cannot return.  A parallel loop nested
+    in another one runs serially in each iteration of the outer loop.
+    '''
+    _check_hints(hints)
+    if chunk < 0:
+        raise ValueError("Negative chunk: %d" % chunk)
+    stop = builder.cast(stop, index.type)
+    bbbody = builder.append_basic_block()
+    bbend = builder.append_basic_block()
+    br = builder.parallel_branch(index, stop, bbbody, bbend, schedule, chunk)
+    br.hints.update(hints)
+    builder.set_basic_block(bbbody)
+    yield
+    if builder.basic_block.terminator is None:
+        builder.branch(bbend)
+    builder.set_basic_block(bbend)
+
 @contextlib.contextmanager
 def if_else(builder, pred):
     bbentry = builder.basic_block
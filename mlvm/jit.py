@@ -1,4 +1,7 @@
 import weakref
+import threading
+import contextlib
+from mlvm.parallel import parallel_call
 
 class JIT(object):
 
@@ -21,10 +24,15 @@ class JIT(object):
         self.__manager = manager
         self.__backends = backends
         self.__opt = opt
+        self.__lock = threading.Lock()
+        self.__compiling = {} # (name, argtys) -> [lock, number of users]
 
     def list_backends(self):
         return self.__backends.items()
 
+    def get_backend(self, name=''):
+        return self.__backends[name]
+
     @property
     def manager(self):
         return self.__manager
@@ -37,27 +45,112 @@ class JIT(object):
     def opt(self):
         return self.__opt
 
-    def compile(self, funcdef, backend='', attrs={}, gil=True):
+    def compile(self, funcdef, backend='', attrs={}, gil=True,
+                trampoline=False, lazy=False):
         '''Compile a function-definition using a specific backend.
         
-        attrs --- attributes for build_function
+        attrs      --- attributes for build_function
+        trampoline --- If True, the function is called through a builtin
+                       function object built by the execution manager,
+                       bypassing ctypes.
+        lazy       --- If True and the definition is not compiled, returns
+                       a LazyJITFunction that compiles on first use.
         '''
-        if self.manager.has_function(funcdef):
+        codegen = self.__backends[backend]
+        if lazy and not self.manager.has_function(funcdef):
+            options = dict(attrs=attrs, gil=gil, trampoline=trampoline)
+            return LazyJITFunction(self, funcdef, backend, options)
+        try:
             wrapper, ctype = self.manager.get_function(funcdef)
-        else:
-            codegen = self.__backends[backend]
+        except KeyError:
+            wrapper, ctype = self._compile_once(codegen, funcdef, attrs, gil)
+        if trampoline:
+            wrapper = self.manager.get_trampoline(codegen, funcdef, gil)
+        return JITFunction(self, wrapper, ctype, funcdef, backend)
+
+    def recompile(self, funcdef, backend='', attrs={}, gil=True):
+        '''Compile a function-definition again and swap the new version
+        in for all callers, including existing JITFunctions.  Use it after
+        changing the implementation or to compile with another backend;
+        e.g. one with a higher optimization level.
+
+        The backend must use indirect calls; see LLVMBackend.
+        '''
+        codegen = self.__backends[backend]
+        with self._compiling(funcdef):
+            unit = codegen.compile(funcdef)
+            unit = codegen.link(unit)
+            wrapper, ctype = self.manager.replace_function(codegen, funcdef,
+                                                           unit, attrs, gil)
+        return JITFunction(self, wrapper, ctype, funcdef, backend)
+
+    def _compile_once(self, codegen, funcdef, attrs, gil, pending=()):
+        '''Compile and build a function-definition unless it is built.
+        The callees that are not built, or were evicted, are built first.
+
+        Concurrent requests for the same definition wait for a single
+        compilation.
+
+        pending --- keys of the callers being compiled by this thread.
+        '''
+        try:
+            return self.manager.get_function(funcdef)
+        except KeyError:
+            pass
+        # the results keep the callees referenced until the caller is built
+        pending += ((funcdef.name, tuple(funcdef.args)),)
+        callees = [self._compile_once(codegen, defn, attrs, gil, pending)
+                   for defn in _direct_callees(funcdef)
+                   if (defn.name, tuple(defn.args)) not in pending]
+        with self._compiling(funcdef):
+            try:
+                return self.manager.get_function(funcdef)
+            except KeyError:
+                pass
             unit = codegen.compile(funcdef)
             unit = codegen.link(unit)
-            wrapper, ctype = self.manager.build_function(codegen, funcdef,
-                                                         unit, attrs, gil)
-        return JITFunction(self, wrapper, ctype, funcdef)
+            return self.manager.build_function(codegen, funcdef, unit,
+                                               attrs, gil)
+
+    @contextlib.contextmanager
+    def _compiling(self, funcdef):
+        '''Hold the compilation lock of a definition.
+        '''
+        key = (funcdef.name, tuple(funcdef.args))
+        with self.__lock:
+            entry = self.__compiling.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            # keep the lock while other threads hold it or wait for it
+            with self.__lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.__compiling[key]
+
+def _direct_callees(funcdef):
+    '''List the implemented function-definitions that funcdef calls.
+    '''
+    found = []
+    for bb in funcdef.implementation.basic_blocks:
+        for op in bb.operations:
+            if not op.name.startswith('call.func'):
+                continue
+            callee = op.callee
+            if callee.is_declaration or any(callee is x for x in found):
+                continue
+            found.append(callee)
+    return found
 
 class JITFunction(object):
-    def __init__(self, parent, wrapper, ctype, funcdef):
+    def __init__(self, parent, wrapper, ctype, funcdef, backend=''):
         self.__parent = weakref.proxy(parent) # does not own
         self.__wrapper = wrapper
         self.__ctype = ctype
         self.__funcdef = weakref.proxy(funcdef) # does not own
+        self.__backend = backend
 
     @property
     def definition(self):
@@ -71,15 +164,134 @@ class JITFunction(object):
     def parent(self):
         return self.__parent
 
+    @property
+    def unchecked(self):
+        '''A callable that skips argument count and conversion error
+        checking.  Use it in tight loops where the arguments are known to be
+        valid.
+        '''
+        return getattr(self.__wrapper, 'unchecked', self.__wrapper)
+
+    @property
+    def backend(self):
+        '''Name of the backend that compiled the function.
+        '''
+        return self.__backend
+
+    @property
+    def is_compiled(self):
+        return True
+
     def __call__(self, *args):
         return self.__wrapper(*args)
 
+    def call_many(self, *args, **kws):
+        '''Call the function for each element of the argument sequences
+        in a single native call with the GIL released.
+
+        Scalar arguments are broadcasted.
+
+        out --- (optional) a contiguous array for the results.
+        '''
+        backend = self.parent.get_backend(self.backend)
+        batch = self.parent.manager.get_batch(backend, self.definition)
+        return batch(*args, **kws)
+
+    map = call_many
+
+    def parallel(self, *args, **kws):
+        '''Call a kernel taking arrays and an element count on chunks of
+        the index range using a pool of threads.  The function must be
+        compiled with gil=False unless a process executor is used.
+
+        count    --- (optional) index of the element count argument.
+                     Defaults to the last integer argument.
+        grain    --- (optional) minimum number of elements per chunk.
+        executor --- (optional) a mlvm.parallel.ParallelExecutor or
+                     a mlvm.llvm.process.ProcessExecutor.
+
+        Returns the list of results of each chunk.
+        '''
+        backend = self.parent.get_backend(self.backend)
+        return parallel_call(backend, self.definition, self.ctype, args,
+                             **kws)
+
     def __eq__(self, rhs):
         '''Two instances are equal if their parent is the same and
         the callable is the same.
         '''
         return self.parent is rhs.parent and self.__wrapper is rhs.__wrapper
 
+    def _bind(self, function):
+        '''Use the wrapper and ctype function of another instance.
+        '''
+        self.__wrapper = function.__wrapper
+        self.__ctype = function.__ctype
+
+class LazyJITFunction(JITFunction):
+    '''A JITFunction that compiles its definition on first use; i.e. when
+    it is called or its ctype is requested.  Then it forwards to the
+    compiled JITFunction.
+    '''
+    def __init__(self, parent, funcdef, backend, options):
+        '''
+        options --- keyword arguments of JIT.compile.
+        '''
+        super(LazyJITFunction, self).__init__(parent, None, None, funcdef,
+                                              backend)
+        self.__options = options
+        self.__lock = threading.Lock()
+        self.__funcdef = weakref.ref(funcdef) # does not own
+        self.__function = None
+
+    @property
+    def is_compiled(self):
+        return self.__function is not None
+
+    def materialize(self):
+        '''Compile the definition unless it is compiled.  Returns the
+        compiled JITFunction.
+        '''
+        function = self.__function
+        if function is None:
+            with self.__lock:
+                function = self.__function
+                if function is None:
+                    funcdef = self.__funcdef()
+                    if funcdef is None:
+                        raise ReferenceError("definition no longer exists")
+                    function = self.parent.compile(funcdef, self.backend,
+                                                   **self.__options)
+                    # bind before publishing so that equality holds
+                    # for any thread that sees the compiled function
+                    self._bind(function)
+                    self.__function = function
+        return function
+
+    @property
+    def ctype(self):
+        return self.materialize().ctype
+
+    @property
+    def unchecked(self):
+        return self.materialize().unchecked
+
+    def __call__(self, *args):
+        return self.materialize()(*args)
+
+    def call_many(self, *args, **kws):
+        return self.materialize().call_many(*args, **kws)
+
+    map = call_many
+
+    def parallel(self, *args, **kws):
+        return self.materialize().parallel(*args, **kws)
+
+    def __eq__(self, rhs):
+        if self is rhs:
+            return True
+        return self.is_compiled and super(LazyJITFunction, self).__eq__(rhs)
+
 class ExecutionManagerInterface(object):
     '''
     An execution manager provides managment of compiled function for execution.
@@ -87,14 +299,20 @@ class ExecutionManagerInterface(object):
     is performed by a backend.
         
     Once a function is built by an execution manager for execution,
-    it should not be built again.  The execution manager does not protects
-    against duplicated compilation.  Instead the user of the manager should
-    guarantee this rule is not violated.
+    it should not be built again.  JIT guarantees a definition is compiled
+    once even if it is requested by several threads at the same time.
+
+    An execution manager must be safe to use from multiple threads.
+    Functions that are built must be callable without locking.
     '''
     def has_function(self, funcdef):
         raise NotImplementedError
 
     def get_function(self, funcdef):
+        '''Returns a wrapper and a ctype function of a function built by
+        build_function.  Raises KeyError if the function is not built or
+        has been evicted.
+        '''
         raise NotImplementedError
 
     def build_function(self, codegen, funcdef, unit, attrs, gil):
@@ -103,3 +321,23 @@ class ExecutionManagerInterface(object):
         The handler is implemented in TypeImplementation.
         '''
         raise NotImplementedError
+
+    def replace_function(self, codegen, funcdef, unit, attrs, gil):
+        '''Build a new version of a function and make every caller use it.
+        Returns a wrapper and a ctype function like build_function.
+        '''
+        raise NotImplementedError
+
+    def get_batch(self, backend, funcdef):
+        '''Returns a callable that calls a function built by build_function
+        for each element of the argument sequences in a native loop.
+        '''
+        raise NotImplementedError
+
+    def get_trampoline(self, backend, funcdef, gil):
+        '''Returns a builtin function object that calls a function built
+        by build_function with the native calling convention of Python.
+        Arguments and return value are converted by the unbox and box
+        methods of TypeImplementation.
+        '''
+        raise NotImplementedError
@@ -1,19 +1,332 @@
 __all__ = ['LLVMBackend']
 
+import re
 import ctypes
-from ctypes import c_float, c_double, c_size_t, POINTER
+import numbers
+import threading
+import warnings
+from ctypes import c_float, c_double, c_size_t, c_void_p, POINTER
 
+import llvm
 import llvm.core as lc
 import llvm.passes as lp
 
 from mlvm.backend import *
 from mlvm.context import (_builtin_signed_int, _builtin_unsigned_int,
-                          _builtin_real, _builtin_special,
-                          ConditionBranch, Branch, Return)
+                          _builtin_real, _builtin_special, _builtin_vector,
+                          ConditionBranch, ParallelBranch, Branch, Return)
+from mlvm import value as irvalue
 from mlvm.utils import ADDRESS_WIDTH
+from mlvm.llvm import threadpool
 
 INLINER_THRESHOLD = 1000
 
+#
+# Argument attributes
+#
+# Attributes of pointer arguments (arrays, pointers, vectors) are lowered
+# to LLVM parameter attributes of the generated function:
+#
+#   in         --- nocapture; also readonly without 'out' (LLVM 3.3+)
+#   out        --- nocapture
+#   noalias    --- noalias; no other argument accesses the same memory
+#   align(N)   --- the pointer is aligned to N bytes
+#   nonnull    --- nonnull, if LLVM supports it
+#
+# These are promises of the caller; breaking them is undefined behavior.
+# Other attributes are ignored.
+#
+
+_re_align = re.compile(r"^align\((\d+)\)$")
+
+_LLVM_VERSION = tuple(getattr(llvm, 'version', (0, 0)))
+
+# readonly is a parameter attribute since LLVM 3.3
+_PARAM_READONLY = _LLVM_VERSION >= (3, 3)
+
+def _lower_argument_attributes(larg, attrs):
+    if not isinstance(larg.type, lc.PointerType):
+        return
+    def add(name):
+        attr = getattr(lc, name, None)
+        if attr is not None:
+            larg.add_attribute(attr)
+
+    if 'in' in attrs or 'out' in attrs:
+        add('ATTR_NO_CAPTURE')
+    if 'in' in attrs and 'out' not in attrs and _PARAM_READONLY:
+        add('ATTR_READONLY')
+    if 'noalias' in attrs:
+        add('ATTR_NO_ALIAS')
+    if 'nonnull' in attrs:
+        add('ATTR_NON_NULL')
+    for attr in attrs:
+        match = _re_align.match(attr)
+        if match:
+            align = int(match.group(1))
+            if align & (align - 1) or not align:
+                raise ValueError("Alignment must be a power of 2: %s" % attr)
+            larg.alignment = align
+
+#
+# Fast-math flags
+#
+# The floating-point arithmetic instruction of an operation gets the
+# fast-math flags named in the attributes of the operation and of its
+# function implementation:
+#
+#   nnan       --- no operand or result is a NaN
+#   ninf       --- no operand or result is infinite
+#   nsz        --- the sign of a zero is insignificant
+#   arcp       --- x / y may be computed as x * (1 / y)
+#   contract   --- may be fused with a multiply-add (LLVM 5+)
+#   reassoc    --- may be reassociated (LLVM 6+)
+#   fast       --- all of the above
+#
+# The loop vectorizer (see Loop hints) reorders a floating-point reduction
+# only with reassoc; before LLVM 6, only with 'fast', which sets unsafe
+# algebra.  Flags that llvmpy cannot set are dropped with a RuntimeWarning.
+# A result that breaks nnan or ninf is undefined.
+#
+
+FAST_MATH_FLAGS = ('nnan', 'ninf', 'nsz', 'arcp', 'contract', 'reassoc')
+
+_FAST_MATH_SETTERS = {'nnan': 'setHasNoNaNs',
+                      'ninf': 'setHasNoInfs',
+                      'nsz': 'setHasNoSignedZeros',
+                      'arcp': 'setHasAllowReciprocal',
+                      'contract': 'setHasAllowContract',
+                      'reassoc': 'setHasAllowReassoc'}
+
+_FAST_MATH_OPCODES = frozenset(['fadd', 'fsub', 'fmul', 'fdiv', 'frem'])
+
+def _fast_math_flags(attrs):
+    if 'fast' in attrs:
+        return set(FAST_MATH_FLAGS)
+    return set(attrs) & set(FAST_MATH_FLAGS)
+
+def _set_fast_math(inst, flags):
+    ptr = getattr(inst, '_ptr', None)
+    if flags == set(FAST_MATH_FLAGS):
+        # unsafe algebra, which implies the other flags, before LLVM 6
+        for name in ('setFast', 'setHasUnsafeAlgebra'):
+            setter = getattr(ptr, name, None)
+            if setter is not None:
+                setter(True)
+                return
+    dropped = []
+    for flag in sorted(flags):
+        setter = getattr(ptr, _FAST_MATH_SETTERS[flag], None)
+        if setter is not None:
+            setter(True)
+        else:
+            dropped.append(flag)
+    if dropped:
+        warnings.warn("fast-math flags not supported by llvmpy: %s"
+                      % ', '.join(dropped), RuntimeWarning)
+
+#
+# Loop hints
+#
+# The hints of a loop back-edge (see mlvm.irutil.for_loop) are lowered to
+# the llvm.loop metadata of the branch.  The metadata names changed in
+# LLVM 3.5; hints without a name in the LLVM version are dropped.  The
+# loop vectorizer runs at link time with opt >= OPT_NORMAL.
+#
+#   vectorize_width --- llvm.loop.vectorize.width (llvm.vectorizer.width)
+#   interleave      --- llvm.loop.interleave.count (llvm.vectorizer.unroll)
+#   unroll          --- llvm.loop.unroll.count (LLVM 3.5+)
+#   independent     --- llvm.mem.parallel_loop_access on every load and
+#                       store of the loop (LLVM 3.3+).  The intrinsics are
+#                       inlined at link time before the loop is marked.
+#
+
+if _LLVM_VERSION >= (3, 5):
+    _LOOP_HINTS = {'vectorize_width': 'llvm.loop.vectorize.width',
+                   'interleave': 'llvm.loop.interleave.count',
+                   'unroll': 'llvm.loop.unroll.count'}
+else:
+    _LOOP_HINTS = {'vectorize_width': 'llvm.vectorizer.width',
+                   'interleave': 'llvm.vectorizer.unroll'}
+
+_PARALLEL_LOOPS = _LLVM_VERSION >= (3, 3)
+
+def _loop_id(module, hints, name):
+    '''Returns the llvm.loop node of a loop, or None if llvmpy cannot
+    build it.  The first operand of the node is the node itself.
+    name --- a unique name of the loop in the module.
+    '''
+    i32 = lc.Type.int(32)
+    operands = [lc.MetaDataString.get(module, name)]  # replaced by the node
+    for hint in sorted(hints):
+        if hint in _LOOP_HINTS:
+            value = lc.Constant.int(i32, int(hints[hint]))
+            key = lc.MetaDataString.get(module, _LOOP_HINTS[hint])
+            operands.append(lc.MetaData.get(module, [key, value]))
+    node = lc.MetaData.get(module, operands)
+    replace = getattr(getattr(node, '_ptr', None), 'replaceOperandWith', None)
+    if replace is None:
+        return None
+    replace(0, node._ptr)
+    return node
+
+def _mark_parallel_loop(lfunc, header, latch, loopid):
+    '''Mark the loads and stores of the natural loop of the back-edge
+    latch -> header, given by block names, with
+    llvm.mem.parallel_loop_access.  Returns False if the loop is not found.
+    '''
+    blocks = dict((bb.name, bb) for bb in lfunc.basic_blocks)
+    preds = {}
+    for bb in lfunc.basic_blocks:
+        for succ in bb.instructions[-1].operands:
+            if isinstance(succ, lc.BasicBlock):
+                preds.setdefault(succ.name, []).append(bb.name)
+    # a call in the latch moves the back-edge when it is inlined
+    if latch not in preds.get(header, ()):
+        return False
+
+    body = set([header])
+    pending = [latch]
+    while pending:
+        name = pending.pop()
+        if name not in body:
+            body.add(name)
+            pending.extend(preds.get(name, ()))
+
+    for name in body:
+        for inst in blocks[name].instructions:
+            if inst.opcode_name in ('load', 'store'):
+                inst.set_metadata('llvm.mem.parallel_loop_access', loopid)
+    return True
+
+#
+# Parallel loops
+#
+# The body of a ParallelBranch (see mlvm.irutil.parallel_range) is outlined
+# into an internal function `void (i8* ctx, intp lo, intp hi)` that runs
+# the iterations [lo, hi).  The enclosing function passes the values that
+# the body uses in a context structure and calls the runtime of
+# mlvm.llvm.threadpool.  In the body:
+#
+#   the index                --- is private to each thread
+#   variables used only in
+#   the body                 --- are private to each thread
+#   other variables and
+#   arguments                --- are copied when the loop starts, unless
+#                                the body assigns them or takes their
+#                                reference; then they are shared
+#   other values             --- are copied
+#
+
+def _successors(term):
+    if isinstance(term, ConditionBranch):
+        return [term.true_branch, term.false_branch]
+    elif isinstance(term, ParallelBranch):
+        return [term.body, term.destination]
+    elif isinstance(term, Branch):
+        return [term.destination]
+    return []
+
+def _parallel_region(term):
+    '''Returns the blocks of the body of a ParallelBranch.
+    '''
+    region = []
+    seen = set([id(term.destination)])
+    pending = [term.body]
+    while pending:
+        bb = pending.pop()
+        if id(bb) in seen:
+            continue
+        seen.add(id(bb))
+        region.append(bb)
+        if isinstance(bb.terminator, Return):
+            raise TypeError("Cannot return from a parallel loop")
+        pending.extend(_successors(bb.terminator))
+    return region
+
+def _serial_blocks(blocks):
+    '''Returns the blocks that are not in the body of a parallel loop
+    of the blocks.
+    '''
+    inner = set()
+    for bb in blocks:
+        if isinstance(bb.terminator, ParallelBranch):
+            inner.update(id(x) for x in _parallel_region(bb.terminator))
+    return [bb for bb in blocks if id(bb) not in inner]
+
+def _block_uses(bb):
+    '''Yields the values used by the operations and the terminator of a
+    block.
+    '''
+    for op in bb.operations:
+        for value in op.operands:
+            yield value
+    term = bb.terminator
+    if isinstance(term, ConditionBranch):
+        yield term.condition
+    elif isinstance(term, ParallelBranch):
+        yield term.index
+        yield term.stop
+    elif isinstance(term, Return) and term.value is not None:
+        yield term.value
+
+def _parallel_captures(impl, region, term):
+    '''Returns (captured, shared, private) of the body of a ParallelBranch:
+    captured --- values defined outside of the body, in order of use.
+    shared   --- ids of the captured variables and arguments that the body
+                 assigns or references.
+    private  --- variables used only in the body, except the index.
+    '''
+    inside = set(id(bb) for bb in region)
+    defined = set()
+    assigned = set()
+    for bb in region:
+        for op in bb.operations:
+            defined.add(id(op))
+            if op.name in ('assign', 'ref'):
+                assigned.add(id(op.operands[-1]))
+
+    outside = set()
+    for bb in impl.basic_blocks:
+        if id(bb) not in inside:
+            outside.update(id(x) for x in _block_uses(bb))
+
+    captured = []
+    private = []
+    seen = set([id(term.index)])
+    for bb in region:
+        for value in _block_uses(bb):
+            if (id(value) in seen or id(value) in defined or
+                    isinstance(value, irvalue.Constant)):
+                continue
+            seen.add(id(value))
+            if (isinstance(value, irvalue.Variable) and
+                    id(value) not in outside):
+                private.append(value)
+            else:
+                captured.append(value)
+    shared = set(id(x) for x in captured if id(x) in assigned)
+    return captured, shared, private
+
+def _resize_int(builder, value, ty, signed):
+    if value.type.width > ty.width:
+        return builder.trunc(value, ty)
+    elif value.type.width < ty.width:
+        if signed:
+            return builder.sext(value, ty)
+        return builder.zext(value, ty)
+    return value
+
+class _SharedVariable(Variable):
+    '''A variable of the function that encloses a parallel loop, given by
+    the address of its storage.
+    '''
+    def __init__(self, backend, tyimpl, storage):
+        Value.__init__(self, backend, tyimpl, storage)
+
+    def deallocate(self, builder):
+        pass    # owned by the enclosing function
+
 class SimpleTypeImplementation(TypeImplementation):
     def __init__(self, name, ty, cty):
         super(SimpleTypeImplementation, self).__init__(name)
@@ -65,14 +378,126 @@ class SimpleTypeImplementation(TypeImplementation):
     def store(self, backend, builder, value, storage):
         builder.store(value, storage)
 
+class VoidImplementation(SimpleTypeImplementation):
+    def box(self, backend, builder, api, value):
+        return api.none(builder)
+
 class IntegerImplementation(SimpleTypeImplementation):
     def constant(self, backend, value):
         return lc.Constant.int(self._type, value)
 
+    @property
+    def _signed(self):
+        return self.name in _builtin_signed_int
+
+    def unbox(self, backend, builder, api, obj, attrs):
+        i64 = lc.Type.int(64)
+        if self._signed:
+            value = api.as_signed(builder, obj)
+        else:
+            value = api.as_unsigned(builder, obj)
+        if self._type.width == 1:
+            return builder.icmp(lc.ICMP_NE, value, lc.Constant.null(i64)), None
+        elif self._type.width < 64:
+            return builder.trunc(value, self._type), None
+        return value, None
+
+    def box(self, backend, builder, api, value):
+        i64 = lc.Type.int(64)
+        if self._type.width == 1:
+            return api.from_bool(builder, value)
+        elif self._signed:
+            if self._type.width < 64:
+                value = builder.sext(value, i64)
+            return api.from_signed(builder, value)
+        else:
+            if self._type.width < 64:
+                value = builder.zext(value, i64)
+            return api.from_unsigned(builder, value)
+
 class RealImplementation(SimpleTypeImplementation):
     def constant(self, backend, value):
         return lc.Constant.real(self._type, value)
 
+    def unbox(self, backend, builder, api, obj, attrs):
+        value = api.as_double(builder, obj)
+        if self._type != lc.Type.double():
+            value = builder.fptrunc(value, self._type)
+        return value, None
+
+    def box(self, backend, builder, api, value):
+        if self._type != lc.Type.double():
+            value = builder.fpext(value, lc.Type.double())
+        return api.from_double(builder, value)
+
+class VectorImplementation(SimpleTypeImplementation):
+    '''A SIMD vector of a scalar type.
+
+    Vectors are values in a function and are returned by value.  As
+    arguments, they are passed as a pointer to the elements so that
+    JIT'ed functions accept arrays and sequences.  A JIT'ed function
+    cannot return a vector to Python.
+    '''
+    def __init__(self, backend, name, element, lanes):
+        ty = lc.Type.vector(element.value(backend), lanes)
+        cty = POINTER(element.ctype(backend))
+        super(VectorImplementation, self).__init__(name, ty, cty)
+        self.__element = element
+        self.__lanes = lanes
+
+    @property
+    def element(self):
+        return self.__element
+
+    @property
+    def lanes(self):
+        return self.__lanes
+
+    def argument(self, backend):
+        return lc.Type.pointer(self.element.value(backend))
+
+    def prolog(self, backend, builder, value, attrs):
+        ptr = builder.bitcast(value, lc.Type.pointer(self._type))
+        return builder.load(ptr, align=self._element_size())
+
+    def precall(self, backend, builder, value):
+        # spill into a temporary in the entry block
+        entry = builder.basic_block.function.basic_blocks[0]
+        entry_builder = lc.Builder.new(entry)
+        entry_builder.position_at_beginning(entry)
+        tmp = entry_builder.alloca(self._type)
+        builder.store(value, tmp)
+        return builder.bitcast(tmp, self.argument(backend))
+
+    def constant(self, backend, value):
+        try:
+            values = list(value)
+        except TypeError:
+            values = [value] * self.lanes  # broadcast a scalar
+        if len(values) != self.lanes:
+            raise ValueError("%s expects %d values; got %d" %
+                             (self.name, self.lanes, len(values)))
+        return lc.Constant.vector([self.element.constant(backend, x)
+                                   for x in values])
+
+    def ctype_parameter(self, backend):
+        return c_void_p
+
+    def ctype_argument(self, backend, value, attrs=()):
+        '''Accepts a pointer to the elements, an address or a sequence of
+        the elements.
+        '''
+        if isinstance(value, (self._ctype, numbers.Integral)):
+            return value
+        values = list(value)
+        if len(values) != self.lanes:
+            raise ValueError("%s expects %d values; got %d" %
+                             (self.name, self.lanes, len(values)))
+        return (self._ctype._type_ * self.lanes)(*values)
+
+    def _element_size(self):
+        return ctypes.sizeof(self._ctype._type_)
+
 class PointerTypeImplementation(SimpleTypeImplementation):
     def __init__(self, backend, pointee):
         name = pointee.name + '*'
@@ -90,6 +515,8 @@ class LLVMTranslator(object):
         self.__funcdef = funcdef
         self.__valuemap = {}
         self.__bbmap = {}
+        self.__entry = None
+        self.__parallel = None  # the ParallelBranch of an outlined body
 
     @property
     def backend(self):
@@ -137,7 +564,7 @@ class LLVMTranslator(object):
 
     def __implement(self, func):
         impl = self.funcdef.implementation
-        bb_entry = func.append_basic_block('entry')
+        bb_entry = self.__entry = func.append_basic_block('entry')
         builder = lc.Builder.new(bb_entry)
 
         # prepare constant
@@ -155,12 +582,14 @@ class LLVMTranslator(object):
                               self.valuemap[var.initializer].use(builder))
         # build prolog for arguments]
         for larg, arg in zip(func.args, impl.args):
+            _lower_argument_attributes(larg, arg.attributes)
             tyimpl = self.__get_ty_impl(arg.type)
             self.valuemap[arg] = Argument(self.backend, tyimpl, builder, larg,
                                           arg.attributes)
 
 
-        for i, irbb in enumerate(impl.basic_blocks):
+        blocks = _serial_blocks(impl.basic_blocks)
+        for i, irbb in enumerate(blocks):
             # allocate basicblocks
             bb = func.append_basic_block("block_%d" % i)
             self.bbmap[irbb] = bb
@@ -168,11 +597,11 @@ class LLVMTranslator(object):
         # branch to first block
         builder.branch(self.bbmap[impl.basic_blocks[0]])
 
-        self.__build_body(impl, builder)
+        self.__build_body(impl, blocks, builder)
 
 
-    def __build_body(self, impl, builder):
-        for i, irbb in enumerate(impl.basic_blocks):
+    def __build_body(self, impl, blocks, builder):
+        for i, irbb in enumerate(blocks):
             # populate basicblocks
             bb = self.bbmap[irbb]
             builder.position_at_end(bb)
@@ -213,8 +642,14 @@ class LLVMTranslator(object):
                     truebr = self.bbmap[term.true_branch]
                     falsebr = self.bbmap[term.false_branch]
                     builder.cbranch(cond, truebr, falsebr)
+                elif isinstance(term, ParallelBranch):
+                    self.__build_parallel(builder, term)
                 elif isinstance(term, Branch):
-                    builder.branch(self.bbmap[term.destination])
+                    br = builder.branch(self.bbmap[term.destination])
+                    if term.hints:
+                        self.__set_loop_hints(builder, br,
+                                              self.bbmap[term.destination],
+                                              term.hints)
                 else:
                     assert isinstance(term, Return)
                     if term.value is None:
@@ -226,15 +661,153 @@ class LLVMTranslator(object):
                         builder.ret(retval)
 
             else: # default pass through
-                if impl.return_type != "void":
-                    assert i + 1 < len(impl.basic_blocks), \
+                if self.__parallel is not None:
+                    # end of an iteration
+                    builder.branch(self.bbmap[self.__parallel.destination])
+                elif impl.return_type != "void":
+                    assert i + 1 < len(blocks), \
                         "Missing return statement in the last block of %s" \
                             % self.__funcdef
-                    builder.branch(self.bbmap[impl.basic_blocks[i + 1]])
+                    builder.branch(self.bbmap[blocks[i + 1]])
                 else:
                     self.__teardown(builder)
                     builder.ret_void()
 
+    def __build_parallel(self, builder, term):
+        impl = self.funcdef.implementation
+        order = dict((id(bb), i) for i, bb in enumerate(impl.basic_blocks))
+        region = sorted(_parallel_region(term), key=lambda bb: order[id(bb)])
+        captured, shared, private = _parallel_captures(impl, region, term)
+
+        # pass the captured values in a context on the stack
+        fields = []
+        for value in captured:
+            if id(value) in shared:
+                fields.append(self.valuemap[value].value)
+            else:
+                fields.append(self.valuemap[value].use(builder))
+        ctxty = lc.Type.struct([x.type for x in fields])
+        entry_builder = lc.Builder.new(self.__entry)
+        entry_builder.position_at_beginning(self.__entry)
+        ctx = entry_builder.alloca(ctxty)
+        for i, field in enumerate(fields):
+            builder.store(field, builder.gep(ctx, [_int32(0), _int32(i)]))
+
+        module = _builder_module(builder)
+        name = '%s.parallel.%s' % (builder.basic_block.function.name,
+                                   builder.basic_block.name)
+        lbody = self.__outline(module, name, term, region, captured, shared,
+                               private, ctxty)
+
+        intp = lc.Type.int(ADDRESS_WIDTH * 8)
+        signed = term.index.type in _builtin_signed_int
+        start = _resize_int(builder, self.valuemap[term.index].use(builder),
+                            intp, signed)
+        stop = _resize_int(builder, self.valuemap[term.stop].use(builder),
+                           intp, signed)
+        schedule = threadpool.SCHEDULES[term.schedule]
+        pfor = module.get_or_insert_function(threadpool.parallel_for_type(),
+                                             threadpool.PARALLEL_FOR)
+        builder.call(pfor, [lbody,
+                            builder.bitcast(ctx, lc.Type.pointer(
+                                                        lc.Type.int(8))),
+                            start, stop, _int32(schedule),
+                            lc.Constant.int(intp, term.chunk)])
+        builder.branch(self.bbmap[term.destination])
+
+    def __outline(self, module, name, term, region, captured, shared,
+                  private, ctxty):
+        '''Build the function that runs the iterations [lo, hi) of the
+        body of a parallel loop.
+        '''
+        lfunc = module.add_function(threadpool.body_type(), name)
+        lfunc.linkage = lc.LINKAGE_INTERNAL
+        lctx, lo, hi = lfunc.args
+
+        sub = LLVMTranslator(self.backend, self.funcdef)
+        sub.__parallel = term
+        bbentry = sub.__entry = lfunc.append_basic_block('entry')
+        builder = lc.Builder.new(bbentry)
+
+        for value, valobj in self.valuemap.items():
+            if isinstance(valobj, ConstValue):
+                sub.valuemap[value] = valobj
+
+        ctx = builder.bitcast(lctx, lc.Type.pointer(ctxty))
+        for i, value in enumerate(captured):
+            field = builder.load(builder.gep(ctx, [_int32(0), _int32(i)]))
+            tyimpl = self.__get_ty_impl(value.type)
+            if id(value) in shared:
+                sub.valuemap[value] = _SharedVariable(self.backend, tyimpl,
+                                                      field)
+            elif isinstance(value, (irvalue.Variable, irvalue.Argument)):
+                copy = Variable(self.backend, tyimpl, builder)
+                copy.assign(builder, field)
+                sub.valuemap[value] = copy
+            else:
+                sub.valuemap[value] = Value(self.backend, tyimpl, field)
+
+        for var in private:
+            tyimpl = self.__get_ty_impl(var.type)
+            valobj = sub.valuemap[var] = Variable(self.backend, tyimpl,
+                                                  builder)
+            if var.initializer:
+                valobj.assign(builder,
+                              sub.valuemap[var.initializer].use(builder))
+
+        tyimpl = self.__get_ty_impl(term.index.type)
+        ity = tyimpl.value(self.backend)
+        if not isinstance(ity, lc.IntegerType):
+            raise TypeError("The index of a parallel loop must be an "
+                            "integer; got %s" % term.index.type)
+        signed = term.index.type in _builtin_signed_int
+        index = sub.valuemap[term.index] = Variable(self.backend, tyimpl,
+                                                    builder)
+
+        blocks = _serial_blocks(region)
+        bbcond = lfunc.append_basic_block('cond')
+        for i, irbb in enumerate(blocks):
+            sub.bbmap[irbb] = lfunc.append_basic_block('block_%d' % i)
+        bbstep = lfunc.append_basic_block('step')
+        bbexit = lfunc.append_basic_block('exit')
+        sub.bbmap[term.destination] = bbstep
+
+        # for (index = lo; index < hi; ++index)
+        index.assign(builder, _resize_int(builder, lo, ity, signed))
+        last = _resize_int(builder, hi, ity, signed)
+        builder.branch(bbcond)
+
+        builder.position_at_end(bbcond)
+        flag = lc.ICMP_SLT if signed else lc.ICMP_ULT
+        builder.cbranch(builder.icmp(flag, index.use(builder), last),
+                        sub.bbmap[term.body], bbexit)
+
+        builder.position_at_end(bbstep)
+        index.assign(builder, builder.add(index.use(builder),
+                                          lc.Constant.int(ity, 1)))
+        br = builder.branch(bbcond)
+        if term.hints:
+            sub.__set_loop_hints(builder, br, bbcond, term.hints)
+
+        builder.position_at_end(bbexit)
+        sub.__teardown(builder)
+        builder.ret_void()
+
+        sub.__build_body(self.funcdef.implementation, blocks, builder)
+        return lfunc
+
+    def __set_loop_hints(self, builder, br, header, hints):
+        latch = builder.basic_block
+        loopid = _loop_id(_builder_module(builder), hints,
+                          'mlvm.loop.%s.%s' % (latch.function.name,
+                                               header.name))
+        if loopid is None:
+            return
+        br.set_metadata('llvm.loop', loopid)
+        if hints.get('independent') and _PARALLEL_LOOPS:
+            self.backend._add_parallel_loop(latch.function, header.name,
+                                            latch.name, loopid)
+
     def __build_call(self, builder, op):
         operands = [self.valuemap[x].use(builder)
                     for x in op.operands]
@@ -271,6 +844,12 @@ class LLVMTranslator(object):
                         for x, v in zip(operands, op.operands)]
         tmp = opimpl(builder, *operands)
 
+        flags = _fast_math_flags(op.attributes |
+                                 self.funcdef.implementation.attributes)
+        if (flags and isinstance(tmp, lc.Instruction) and
+                tmp.opcode_name in _FAST_MATH_OPCODES):
+            _set_fast_math(tmp, flags)
+
         if callop: # postcall
             for x, v in zip(operands, op.operands):
                 self.valuemap[v].type.postcall(self.__backend,
@@ -301,12 +880,15 @@ class LLVMBackend(Backend):
     OPT_AGGRESSIVE = 3
     OPT_MAXIMUM = OPT_AGGRESSIVE
 
-    def __init__(self, address_width=None, opt=OPT_NORMAL):
+    def __init__(self, address_width=None, opt=OPT_NORMAL, indirect=False):
         '''
         address_width --- Address width in bytes.  If it is None, it 
                           will be set to match the current machine.
         opt --- Optimization level.  Controls what LLVM optimization
                 passes to run on the generated module.
+        indirect --- If True, calls to functions load the callee from a
+                     global function pointer named by slot_name so that
+                     the callee can be replaced after the caller is built.
         '''
         super(LLVMBackend, self).__init__()
         if not address_width: # auto-detect
@@ -314,20 +896,27 @@ class LLVMBackend(Backend):
         assert address_width in [4, 8]
         self.__address_width = address_width
         self.__opt = opt
+        self.__indirect = indirect
                 
         # pass manager builder
         self.__pmb = lp.PassManagerBuilder.new()
         self.__pmb.opt_level = self.__opt
         self.__pmb.use_inliner_with_threshold(INLINER_THRESHOLD)
+        if hasattr(self.__pmb, 'loop_vectorize'):   # LLVM 3.2+
+            self.__pmb.loop_vectorize = self.__opt >= self.OPT_NORMAL
 
         # module-level pass manager
         self.__pm = lp.PassManager.new()
         self.__pmb.populate(self.__pm)
 
-        # intrinsic library module
-        self.__intrlib = lc.Module.new("mlvm.intrinsic.%d" % id(self))
-        self.__intrlibfpm = lp.FunctionPassManager.new(self.__intrlib)
-        self.__pmb.populate(self.__intrlibfpm)
+        # loops marked at link time; function name -> [(header, latch, id)]
+        self.__parallel_loops = {}
+
+        # intrinsics; LLVM name -> (retty, argtys, impl).  Each one is
+        # built in a module of its own when a linked module first uses it.
+        self.__intrinsics = {}
+        self.__intrlibs = {}    # LLVM name -> module
+        self.__intrlock = threading.Lock()
 
         # initialize default implementations
         self._default_type_implementation()
@@ -345,10 +934,22 @@ class LLVMBackend(Backend):
     def opt(self):
         return self.__opt
 
+    @property
+    def indirect(self):
+        return self.__indirect
+
     def compile(self, funcdef):
+        marked = dict((name, len(marks))
+                      for name, marks in self.__parallel_loops.items())
         llfunc = LLVMTranslator(self, funcdef).translate()
         module = llfunc.module
 
+        # the loops of an earlier compile that is not linked are stale
+        for func in module.functions:
+            marks = self.__parallel_loops.get(func.name)
+            if marks and not func.is_declaration:
+                del marks[:marked.get(func.name, 0)]
+
         llfunc.verify()
 
         # function-level optimize
@@ -358,19 +959,85 @@ class LLVMBackend(Backend):
 
     def link(self, llfunc):
         module = llfunc.module
-        # link intrinsics
-        module.link_in(self.__intrlib.clone())
+        # link the used intrinsics
+        for lib in self.__intrinsic_libraries(module):
+            module.link_in(lib)
 
         # link extra libraries
         for lib in self.list_extra_libraries():
             module.link_in(lib.clone())
 
         module.verify()
+
+        # the loops of llfunc and of the bodies of its parallel loops
+        loops = [(func, self.__parallel_loops.pop(func.name))
+                 for func in module.functions
+                 if func.name in self.__parallel_loops]
+        if loops:
+            # expose the loads and stores of the intrinsics to the markers
+            pm = lp.PassManager.new()
+            pm.add('always-inline')
+            pm.run(module)
+            for func, marks in loops:
+                for header, latch, loopid in marks:
+                    _mark_parallel_loop(func, header, latch, loopid)
                 
         # module-level optimization
         self.__pm.run(module)
         return llfunc
 
+    def __intrinsic_libraries(self, module):
+        '''Returns copies of the modules of the intrinsics declared in a
+        module, and of the intrinsics they declare, in name order.
+        '''
+        libs = {}
+        with self.__intrlock:
+            pending = [func.name for func in module.functions
+                       if func.is_declaration
+                       and func.name in self.__intrinsics]
+            while pending:
+                name = pending.pop()
+                if name in libs:
+                    continue
+                lib = self.__intrlibs.get(name)
+                if lib is None:
+                    lib = self.__build_intrinsic(name)
+                    self.__intrlibs[name] = lib
+                libs[name] = lib
+                pending.extend(func.name for func in lib.functions
+                               if func.is_declaration
+                               and func.name in self.__intrinsics)
+            return [libs[name].clone() for name in sorted(libs)]
+
+    def __build_intrinsic(self, name):
+        retty, argtys, impl = self.__intrinsics[name]
+        module = lc.Module.new("%s.%d" % (name, id(self)))
+        lretty = self.__to_llvm_type(retty, 'return_type')
+        largtys = [self.__to_llvm_type(x, 'argument') for x in argtys]
+        fnty = lc.Type.function(lretty, largtys)
+        lfunc = module.add_function(fnty, name)
+
+        # set function linkage, attributes & visibility
+        lfunc.linkage = lc.LINKAGE_LINKONCE_ODR
+        lfunc.add_attribute(lc.ATTR_ALWAYS_INLINE)
+        lfunc.visibility = lc.VISIBILITY_HIDDEN
+
+        # implement
+        impl(lfunc)
+        lfunc.verify()
+        # optimize
+        fpm = lp.FunctionPassManager.new(module)
+        self.__pmb.populate(fpm)
+        fpm.run(lfunc)
+        return module
+
+    def _add_parallel_loop(self, lfunc, header, latch, loopid):
+        '''Mark a loop of a compiled function as parallel when the
+        function is linked.  See _mark_parallel_loop.
+        '''
+        loops = self.__parallel_loops.setdefault(lfunc.name, [])
+        loops.append((header, latch, loopid))
+
     def _default_operation_implementation(self):
         self._default_comparision_implementation()
         self._default_cast_implementation()
@@ -409,6 +1076,19 @@ class LLVMBackend(Backend):
             for raw, real in realop.items():
                 self.implement_operation(raw, (ty, ty), impl(real))
 
+        # lane-wise arithmetic of vectors; integer vectors are signed
+        vectorop = {
+            'add': 'add',
+            'sub': 'sub',
+            'mul': 'mul',
+            'div': 'sdiv',
+            'rem': 'srem',
+        }
+        for ty, (elemty, lanes) in _builtin_vector.items():
+            ops = realop if elemty in realtypes else vectorop
+            for raw, real in ops.items():
+                self.implement_operation(raw, (ty, ty), impl(real))
+
     def _default_cast_implementation(self):
         def icast(fromty, toty):
             signed = toty in _builtin_signed_int
@@ -512,8 +1192,13 @@ class LLVMBackend(Backend):
                 ty = ('int%d' % bits,)
                 self.implement_operation(op, ty*2, cmp_int(signed_flag))
 
+            # address and pred are unsigned
+            for ty in _builtin_special:
+                self.implement_operation(op, (ty, ty),
+                                         cmp_uint(unsigned_flag))
+
             for ty in ['float', 'double']:
-                self.implement_operation(op, ty*2, cmp_real(float_flag))
+                self.implement_operation(op, (ty, ty), cmp_real(float_flag))
 
     def _default_type_implementation(self):
         def factory(cls, name, ty, cty):
@@ -526,22 +1211,47 @@ class LLVMBackend(Backend):
             factory(IntegerImplementation, 'int%d' % bits, ty, scty)
             factory(IntegerImplementation, 'uint%d' % bits, ty, ucty)
 
-        factory(SimpleTypeImplementation, "void", lc.Type.void(), None)
+        factory(VoidImplementation, "void", lc.Type.void(), None)
         factory(IntegerImplementation, 'pred', lc.Type.int(1), NotImplemented)
         factory(RealImplementation, 'float', lc.Type.float(), c_float)
         factory(RealImplementation, 'double', lc.Type.double(), c_double)
         factory(IntegerImplementation, 'address',
                 lc.Type.int(self.address_width * 8), c_size_t)
 
+        for name, (elemty, lanes) in _builtin_vector.items():
+            element = self.get_type_implementation(elemty)
+            self.implement_type(VectorImplementation(self, name, element,
+                                                     lanes))
+
     def _build_intrinsic_call(self, op):
         argtys = op.callee.args
         fname = 'mlvm.intrinsic.%s.%s' % (op.callee.name, '.'.join(argtys))
         return self._build_call(fname, op.callee.return_type, argtys)
 
     def _build_function_call(self, op):
-        argtys = op.callee.args
-        fname = self.mangle_function(op.callee.name, argtys)
-        return self._build_call(fname, op.callee.return_type, argtys)
+        return self._build_definition_call(op.callee)
+
+    def _build_definition_call(self, funcdef):
+        argtys = funcdef.args
+        fname = self.mangle_function(funcdef.name, argtys)
+        if self.__indirect:
+            return self._build_indirect_call(fname, funcdef.return_type,
+                                             argtys)
+        return self._build_call(fname, funcdef.return_type, argtys)
+
+    def _build_indirect_call(self, fname, retty, argtys):
+        def _build(builder, *args):
+            assert len(args) == len(argtys)
+            module = _builder_module(builder)
+
+            largtys = [self.__to_llvm_type(x, 'argument')
+                       for x in argtys]
+            lretty = self.__to_llvm_type(retty, 'return_type')
+            fnty = lc.Type.function(lretty, largtys)
+            slot = _get_or_insert_global(module, lc.Type.pointer(fnty),
+                                         self.slot_name(fname))
+            return builder.call(builder.load(slot), args)
+        return _build
 
     def _build_call(self, fname, retty, argtys):
         def _build(builder, *args):
@@ -567,26 +1277,11 @@ class LLVMBackend(Backend):
 
     def _implement_intrinsic(self, name, retty, argtys, impl):
         '''
-        Add intrinsic implementation to the intrinsic library
+        Add intrinsic implementation to the intrinsic library.
+        The function is built when a linked module first uses it.
         '''
-
-        # make function
         name = 'mlvm.intrinsic.%s.%s' % (name, '.'.join(argtys))
-        lretty = self.__to_llvm_type(retty, 'return_type')
-        largtys = [self.__to_llvm_type(x, 'argument') for x in argtys]
-        fnty = lc.Type.function(lretty, largtys)
-        lfunc = self.__intrlib.add_function(fnty, name)
-
-        # set function linkage, attributes & visibility
-        lfunc.linkage = lc.LINKAGE_LINKONCE_ODR
-        lfunc.add_attribute(lc.ATTR_ALWAYS_INLINE)
-        lfunc.visibility = lc.VISIBILITY_HIDDEN
-        
-        # implement
-        impl(lfunc)
-        lfunc.verify()
-        # optimize
-        self.__intrlibfpm.run(lfunc)
+        self.__intrinsics[name] = (retty, tuple(argtys), impl)
 
     def _get_pointer_implementation(self, pointee):
         return PointerTypeImplementation(self, pointee)
@@ -614,6 +1309,24 @@ class LLVMBackend(Backend):
         joint = '%s.%s' % (name, '.'.join(argtys))
         return cls.mangle_symbol(joint)
 
+    @classmethod
+    def slot_name(cls, mangled):
+        '''Name of the global function pointer of a mangled function
+        for indirect calls.
+        '''
+        return '%s.slot' % mangled
+
+def _int32(value):
+    return lc.Constant.int(lc.Type.int(32), value)
+
 def _builder_module(builder):
     module = builder.basic_block.function.module
     return module
+
+def _get_or_insert_global(module, ty, name):
+    '''Returns a global variable; declares it if it does not exist.
+    '''
+    for gv in module.global_variables:
+        if gv.name == name:
+            return gv
+    return module.add_global_variable(ty, name)
@@ -0,0 +1,230 @@
+#
+# Batched invocation of JIT'ed scalar functions.
+#
+# A native loop calls the function for every element of the argument
+# arrays and writes the results into an output array.  It is called
+# through CFUNCTYPE so the GIL is released for the whole loop.
+#
+
+import ctypes
+import numbers
+from ctypes import CFUNCTYPE, c_void_p, c_ssize_t, sizeof, addressof
+
+import llvm.core as lc
+
+from mlvm.utils import (ADDRESS_WIDTH, ctype_typestr, typestr_of_format,
+                        get_buffer_info, PyBUF_C_CONTIGUOUS, PyBUF_FORMAT,
+                        PyBUF_WRITABLE)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _scalar_ctype(backend, tyimpl):
+    cty = tyimpl.ctype(backend)
+    if not (isinstance(cty, type) and issubclass(cty, ctypes._SimpleCData)
+            and cty._type_ in 'bhilqBHILQfdg?'):
+        raise TypeError("%s is not a scalar type" % tyimpl.name)
+    return cty
+
+def build_batch_loop(backend, funcdef):
+    '''Build a loop that calls a JIT'ed function over arrays.
+
+    The loop has the signature:
+
+        void (T0 *a0, intp s0, ..., R *out, intp n)
+
+    where sK is the stride of aK in elements; 0 broadcasts a scalar.
+    `out` is absent if the function returns void.
+
+    Returns (module, name, externals).
+    '''
+    get_ty_impl = backend.get_type_implementation
+    rettyimpl = get_ty_impl(funcdef.return_type)
+    argtyimpls = [get_ty_impl(x) for x in funcdef.args]
+    void = funcdef.return_type == 'void'
+
+    for ty in argtyimpls:
+        _scalar_ctype(backend, ty)
+    if not void:
+        _scalar_ctype(backend, rettyimpl)
+
+    intp = lc.Type.int(ADDRESS_WIDTH * 8)
+    ZERO = lc.Constant.int(intp, 0)
+    ONE = lc.Constant.int(intp, 1)
+
+    params = []
+    for ty in argtyimpls:
+        params += [lc.Type.pointer(ty.argument(backend)), intp]
+    if not void:
+        params.append(lc.Type.pointer(rettyimpl.return_type(backend)))
+    params.append(intp)
+
+    mangled = backend.mangle_function(funcdef.name, funcdef.args)
+    module = lc.Module.new('mlvm.batch.%s' % mangled)
+    name = '%s.batch' % mangled
+    lfunc = module.add_function(lc.Type.function(lc.Type.void(), params),
+                                name)
+
+    args = list(lfunc.args)
+    count = args.pop()
+    if not void:
+        out = args.pop()
+        out.add_attribute(lc.ATTR_NO_ALIAS)
+    arrays = args[0::2]
+    strides = args[1::2]
+
+    bbentry = lfunc.append_basic_block('entry')
+    bbcond = lfunc.append_basic_block('cond')
+    bbbody = lfunc.append_basic_block('body')
+    bbexit = lfunc.append_basic_block('exit')
+
+    builder = lc.Builder.new(bbentry)
+    builder.branch(bbcond)
+
+    builder.position_at_end(bbcond)
+    idx = builder.phi(intp, name='idx')
+    idx.add_incoming(ZERO, bbentry)
+    builder.cbranch(builder.icmp(lc.ICMP_ULT, idx, count), bbbody, bbexit)
+
+    builder.position_at_end(bbbody)
+    values = [builder.load(builder.gep(array, [builder.mul(idx, stride)]))
+              for array, stride in zip(arrays, strides)]
+    call = backend._build_definition_call(funcdef)
+    result = call(builder, *values)
+    if not void:
+        builder.store(result, builder.gep(out, [idx]))
+    idx_next = builder.add(idx, ONE, name='idx_next')
+    idx.add_incoming(idx_next, bbbody)
+    builder.branch(bbcond)
+
+    builder.position_at_end(bbexit)
+    builder.ret_void()
+
+    lfunc.verify()
+    return module, name, {}
+
+class BatchLoop(object):
+    '''Calls a native batch loop with Python sequences.
+    '''
+    def __init__(self, address, argctypes, retctype):
+        '''
+        argctypes --- ctypes of the arguments of the scalar function.
+        retctype  --- ctype of the return value or None for void.
+        '''
+        self.__argctypes = tuple(argctypes)
+        self.__retctype = retctype
+        protos = [c_void_p, c_ssize_t] * len(argctypes)
+        if retctype is not None:
+            protos.append(c_void_p)
+        protos.append(c_ssize_t)
+        self.__function = CFUNCTYPE(None, *protos)(address)
+
+    def __call__(self, *args, **kws):
+        '''Call the function for each element of the arguments.
+
+        Each argument is a NumPy array, a sequence or a scalar.
+        Scalars are broadcasted.  All non-scalar arguments must have
+        the same length.
+
+        out --- (optional) a contiguous array for the results.
+
+        Returns the output array.  If `out` is omitted, a new NumPy array
+        is returned, or a list if NumPy is not available.
+        '''
+        out = kws.pop('out', None)
+        if kws:
+            raise TypeError("Unexpected keyword arguments: %s" %
+                            ', '.join(kws))
+        if len(args) != len(self.__argctypes):
+            raise TypeError("Function takes exactly %d arguments; but got %d"
+                            % (len(self.__argctypes), len(args)))
+
+        count = None
+        actual = []
+        keepalive = []
+        for i, (cty, arg) in enumerate(zip(self.__argctypes, args)):
+            if isinstance(arg, numbers.Number):
+                scalar = cty(arg)
+                keepalive.append(scalar)
+                actual += [addressof(scalar), 0]
+                continue
+            address, length, holder = _get_buffer(arg, cty, False)
+            keepalive.append(holder)
+            if count is None:
+                count = length
+            elif count != length:
+                raise ValueError("Argument %d has length %d; expected %d" %
+                                 (i, length, count))
+            actual += [address, 1]
+
+        if count is None:
+            raise ValueError("At least one argument must be a sequence")
+
+        created = False
+        if self.__retctype is not None:
+            if out is None:
+                out = _empty(self.__retctype, count)
+                created = True
+            address, length, holder = _get_buffer(out, self.__retctype, True)
+            if length != count:
+                raise ValueError("Output has length %d; expected %d" %
+                                 (length, count))
+            actual.append(address)
+        actual.append(count)
+
+        self.__function(*actual)
+
+        if created and isinstance(out, ctypes.Array):
+            return out[:]
+        return out
+
+def _empty(cty, count):
+    if numpy is not None:
+        return numpy.empty(count, dtype=ctype_typestr(cty))
+    return (cty * count)()
+
+def _get_buffer(value, cty, writable):
+    '''Returns (address, length, holder) of the contiguous data of `value`
+    as an array of `cty`.  `holder` must be kept alive during the call.
+    '''
+    if isinstance(value, ctypes.Array) and value._type_ is cty:
+        return addressof(value), len(value), value
+
+    interface = getattr(value, '__array_interface__', None)
+    if interface is not None:
+        shape = interface['shape']
+        strides = interface.get('strides')
+        address, readonly = interface['data']
+        if (len(shape) == 1 and
+                interface['typestr'] == ctype_typestr(cty) and
+                (strides is None or strides == (sizeof(cty),))):
+            if writable and readonly:
+                raise ValueError("Output array is read-only")
+            return address, shape[0], value
+        if writable:
+            raise TypeError("Output must be a contiguous 1-D array of %s" %
+                            ctype_typestr(cty))
+        if numpy is not None:
+            value = numpy.ascontiguousarray(value, dtype=ctype_typestr(cty))
+            if value.ndim != 1:
+                raise ValueError("Arguments must be 1-D")
+            return value.__array_interface__['data'][0], len(value), value
+
+    flags = PyBUF_C_CONTIGUOUS | PyBUF_FORMAT
+    if writable:
+        flags |= PyBUF_WRITABLE
+    try:
+        info = get_buffer_info(value, flags)
+    except (TypeError, BufferError):
+        pass
+    else:
+        if typestr_of_format(info.format, info.itemsize) == ctype_typestr(cty):
+            return info.address, info.nbytes // info.itemsize, value
+
+    if writable:
+        raise TypeError("Output must be a writable array of %s" %
+                        ctype_typestr(cty))
+    array = (cty * len(value))(*value)
+    return addressof(array), len(array), array
@@ -0,0 +1,239 @@
+#
+# Loop fusion of the elementwise intrinsics of mlvm.llvm.ext.arraytype.
+#
+# A run of elementwise intrinsic calls over the same count in a basic block
+# is replaced by a call to a generated intrinsic that computes every
+# operation in a single loop.  Within an iteration, an element written by
+# one operation is passed in a register to the next operations instead of
+# being reloaded.
+#
+# Only arithmetic, casts and comparisons of scalars may appear between the
+# calls of a run; they are kept before the fused call.  Distinct operands
+# of a run must be the same array or must not overlap.
+#
+# An array argument with the 'temp' attribute holds scratch data that the
+# caller does not read.  If it is not used outside of a run and the run
+# writes it before reading it, its stores are removed from the fused loop.
+# An array that the run reads first keeps its stores: the values may come
+# from before the run, or from the previous iteration of an enclosing loop.
+#
+# Usage:
+#
+#     fuse(funcdef, backend)  # before compiling funcdef with backend
+#
+
+import hashlib
+
+import llvm.core as lc
+from llvm import tbaa
+
+from mlvm.context import ConditionBranch, ParallelBranch, Return
+from mlvm.value import Call
+from mlvm.utils import ADDRESS_WIDTH
+from mlvm.llvm.ext.arraytype import (_elementwise_signatures,
+                                     elementwise_operator,
+                                     elementwise_element)
+
+FUSIBLE = frozenset(name for name, _ in _elementwise_signatures('double'))
+
+_PURE_OPERATIONS = frozenset(['add', 'sub', 'mul', 'div', 'rem'])
+
+def _is_fusible(op):
+    if not op.name.startswith('call.intr'):
+        return False
+    callee = op.callee
+    # array_min and array_max are also reductions, which return a value
+    return (callee.name in FUSIBLE and callee.return_type == 'void' and
+            callee.args[0].startswith('array_'))
+
+def _is_pure(op):
+    return (op.name in _PURE_OPERATIONS or op.name.startswith('cast.') or
+            op.name.startswith('cmp.'))
+
+def find_runs(block):
+    '''Returns the runs of fusible calls of a basic block as lists of
+    operations.  A run has at least two calls.
+    '''
+    runs = []
+    run = []
+    for op in block.operations:
+        if _is_fusible(op):
+            if run and op.operands[-1] is not run[-1].operands[-1]:
+                runs.append(run)    # a different count
+                run = []
+            run.append(op)
+        elif not _is_pure(op):
+            runs.append(run)
+            run = []
+    runs.append(run)
+    return [run for run in runs if len(run) > 1]
+
+def _uses_outside(impl, run):
+    '''Returns the ids of the values used by operations outside of a run.
+    '''
+    inside = set(id(op) for op in run)
+    used = set()
+    for block in impl.basic_blocks:
+        for op in block.operations:
+            if id(op) not in inside:
+                used.update(id(x) for x in op.operands)
+        term = block.terminator
+        if isinstance(term, ConditionBranch):
+            used.add(id(term.condition))
+        elif isinstance(term, ParallelBranch):
+            used.update([id(term.index), id(term.stop)])
+        elif isinstance(term, Return) and term.value is not None:
+            used.add(id(term.value))
+    return used
+
+def plan_run(impl, run):
+    '''Describe the fused loop of a run.
+
+    Returns (operands, steps, elided):
+    operands --- the distinct operands of the run, excluding the count.
+    steps    --- (intrinsic name, element type, operand indices,
+                 destination index) of each call.
+    elided   --- indices of the 'temp' arrays whose stores are removed;
+                 those first written by an out-of-place step.
+    '''
+    operands = []
+    def index(value):
+        for i, x in enumerate(operands):
+            if x is value:
+                return i
+        operands.append(value)
+        return len(operands) - 1
+
+    steps = []
+    written = set()     # written before any read
+    seen = set()
+    for op in run:
+        name = op.callee.name
+        elemtype = op.callee.args[0][len('array_'):]
+        indices = tuple(index(x) for x in op.operands[:-1])
+        inplace = name.startswith('array_i')
+        dest = indices[0] if inplace else indices[-1]
+        # the sources are read before the destination is written
+        seen.update(indices if inplace else indices[:-1])
+        if dest not in seen:
+            written.add(dest)
+            seen.add(dest)
+        steps.append((name, elemtype, indices, dest))
+
+    used = _uses_outside(impl, run)
+    elided = set(i for i in written
+                 if 'temp' in getattr(operands[i], 'attributes', ())
+                 and id(operands[i]) not in used)
+    return operands, steps, elided
+
+def fused_impl(argtys, steps, elided):
+    '''Implement the fused loop of a run.  See plan_run.
+    '''
+    operators = [elementwise_operator(name, elemtype)
+                 for name, elemtype, _, _ in steps]
+    def _fused_impl(lfunc):
+        intp = lc.Type.int(ADDRESS_WIDTH * 8)
+        ZERO = lc.Constant.int(intp, 0)
+        ONE = lc.Constant.int(intp, 1)
+
+        args = list(lfunc.args)
+        elemct = args.pop()
+        isarray = [ty.startswith('array_') for ty in argtys]
+        for arg, array in zip(args, isarray):
+            if array:
+                arg.add_attribute(lc.ATTR_NO_ALIAS)
+
+        tbaaroot = tbaa.TBAABuilder.new(lfunc.module, 'mlvm.tbaa')
+        tbaa_nodes = [array and tbaaroot.get_node(ty[len('array_'):])
+                      for ty, array in zip(argtys, isarray)]
+
+        bbentry = lfunc.append_basic_block('entry')
+        bbcond = lfunc.append_basic_block('cond')
+        bbbody = lfunc.append_basic_block('body')
+        bbexit = lfunc.append_basic_block('exit')
+
+        builder = lc.Builder.new(bbentry)
+        builder.branch(bbcond)
+
+        builder.position_at_end(bbcond)
+        idx = builder.phi(intp, name='idx')
+        idx.add_incoming(ZERO, bbentry)
+        pred = builder.icmp(lc.ICMP_ULT, idx, elemct)
+        builder.cbranch(pred, bbbody, bbexit)
+
+        builder.position_at_end(bbbody)
+        current = {}    # operand index -> element of this iteration
+        dirty = []
+        for operator, (name, _, indices, dest) in zip(operators, steps):
+            values = []
+            for i in indices:
+                if not isarray[i]:
+                    values.append(args[i])
+                    continue
+                if i not in current:
+                    value = builder.load(builder.gep(args[i], [idx]))
+                    value.set_metadata("tbaa", tbaa_nodes[i])
+                    current[i] = value
+                values.append(current[i])
+            current[dest] = elementwise_element(builder, operator, name,
+                                                values,
+                                                args[dest].type.pointee)
+            if dest not in dirty:
+                dirty.append(dest)
+
+        for i in dirty:
+            if i not in elided:
+                store = builder.store(current[i],
+                                      builder.gep(args[i], [idx]))
+                store.set_metadata("tbaa", tbaa_nodes[i])
+
+        idx_next = builder.add(idx, ONE, name='idx_next')
+        idx.add_incoming(idx_next, bbbody)
+        builder.branch(bbcond)
+
+        builder.position_at_end(bbexit)
+        builder.ret_void()
+    return _fused_impl
+
+def _get_fused_intrinsic(context, backend, argtys, steps, elided):
+    '''Returns the definition of the fused intrinsic of a plan.
+    Identical plans share an intrinsic.
+    '''
+    key = repr((argtys, steps, sorted(elided)))
+    name = 'array_fused_%s' % hashlib.md5(key.encode('utf8')).hexdigest()
+    intr = context.get_or_insert_intrinsic(name)
+    if intr.has_definition(argtys):
+        defn = intr.get_definition(argtys)
+    else:
+        defn = intr.add_definition('void', argtys)
+    try:
+        backend.get_intrinsic_implementation(name, argtys)
+    except KeyError:
+        backend.implement_intrinsic(name, 'void', argtys,
+                                    fused_impl(argtys, steps, elided))
+    return defn
+
+def fuse(funcdef, backend):
+    '''Fuse the runs of elementwise array intrinsics of a function
+    definition in place.  The fused intrinsics are added to the context of
+    the definition and implemented in the backend.
+
+    Returns the number of fused runs.
+    '''
+    impl = funcdef.implementation
+    context = funcdef.parent.context
+    count = 0
+    for block in impl.basic_blocks:
+        for run in find_runs(block):
+            operands, steps, elided = plan_run(impl, run)
+            argtys = tuple(x.type for x in operands) + ('address',)
+            defn = _get_fused_intrinsic(context, backend, argtys, steps,
+                                        elided)
+            fused = Call(defn, list(operands) + [run[-1].operands[-1]])
+
+            inside = set(id(op) for op in run)
+            ops = block.operations
+            ops[:] = [fused if op is run[-1] else op for op in ops
+                      if id(op) not in inside or op is run[-1]]
+            count += 1
+    return count
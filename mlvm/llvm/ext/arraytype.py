@@ -2,13 +2,24 @@
 # Array type extension for C arrays.
 # It does not do bound-check.
 #
+# array_T is a contiguous 1-D array passed as a pointer to its elements.
+# slice_T is a contiguous 1-D array that carries its length; it is passed
+# as a pointer to a descriptor {T *data; intp length}.
+# arrayNd_T (N = 2, 3) is a strided N-D array passed as a pointer to a
+# descriptor of its data pointer, shape and strides in bytes.
+#
 # For JIT'ed function, it accepts any object that provides a buffer-interface.
+# The buffer must be writable unless the argument has the 'in' attribute
+# and not the 'out' attribute.  Pointers and addresses are not checked.
 #
 # Use this module as an extension for context and backend.
 #
 
 from mlvm.backend import TypeImplementation
-from mlvm.utils import MEMORYVIEW_DATA_OFFSET, ADDRESS_WIDTH
+from mlvm.utils import (ADDRESS_WIDTH, PyBUF_C_CONTIGUOUS, PyBUF_WRITABLE,
+                        PyBUF_STRIDES, PyBUF_FORMAT, get_buffer_info,
+                        ctype_typestr, typestr_of_format,
+                        c_contiguous_strides)
 from mlvm.context import (_builtin_unsigned_int,
                           _builtin_signed_int,
                           _builtin_real)
@@ -16,32 +27,70 @@ import llvm.core as lc
 from llvm import tbaa
 from ctypes import *
 
+try:
+    _address_types = (int, long)
+except NameError:
+    _address_types = (int,)
+
 class ArrayType(TypeImplementation):
     def __init__(self, name, elemtype):
         super(ArrayType, self).__init__(name)
         self.__elemtype = elemtype
+        self.__ctypes = None
 
     @property
     def element(self):
         return self.__elemtype
 
+    def _get_ctypes(self, backend):
+        '''Returns (pointer class, element type string).
+        '''
+        if self.__ctypes is None:
+            typeimpl = backend.get_type_implementation(self.element)
+            c_elem_t = typeimpl.ctype(backend)
+            self.__ctypes = POINTER(c_elem_t), ctype_typestr(c_elem_t)
+        return self.__ctypes
+
     def ctype(self, backend):
-        typeimpl = backend.get_type_implementation(self.element)
-        c_elem_t = typeimpl.ctype(backend)
-        return POINTER(c_elem_t)
+        return self._get_ctypes(backend)[0]
+
+    def ctype_parameter(self, backend):
+        return c_void_p
+
+    def ctype_argument(self, backend, value, attrs=()):
+        '''Returns the address of the data of an array argument.
 
-    def ctype_argument(self, backend, value):
-        if isinstance(value, self.ctype(backend)):
+        Accepts instances of the ctype pointer, integer addresses,
+        objects with the NumPy array interface and objects providing a
+        C-contiguous buffer of matching items.  Raises ValueError for a
+        read-only buffer unless the argument is only read; see _is_input.
+        '''
+        pointer, typestr = self._get_ctypes(backend)
+        if isinstance(value, pointer) or isinstance(value, _address_types):
             return value
-        else:
-            view = memoryview(value)
-            assert view.ndim == 1
-            ctelem = self.ctype(backend)
-            address = cast(c_void_p(id(view) + MEMORYVIEW_DATA_OFFSET),
-                           POINTER(c_uint64))[0]
-            data = cast(c_void_p(address), ctelem)
-            return data
-        assert False
+
+        interface = getattr(value, '__array_interface__', None)
+        if interface is not None:
+            if interface['typestr'] != typestr:
+                raise TypeError("%s expects items of %s; got %s" %
+                                (self.name, typestr, interface['typestr']))
+            strides = interface.get('strides')
+            if strides is not None:
+                itemsize = sizeof(pointer._type_)
+                if not _is_c_contiguous(interface['shape'], strides,
+                                        itemsize):
+                    raise TypeError("%s expects a contiguous array" %
+                                    self.name)
+            _check_writable(self.name, interface['data'][1], attrs)
+            return interface['data'][0]
+
+        info = get_buffer_info(value)
+        got = typestr_of_format(info.format, info.itemsize)
+        if got != typestr:
+            raise TypeError("%s expects items of %s; got %s" %
+                            (self.name, typestr, got))
+        _check_writable(self.name, info.readonly, attrs)
+        return info.address
 
     def use(self, backend, builder, value):
         return builder.load(value)
@@ -64,14 +113,478 @@ class ArrayType(TypeImplementation):
     def prolog(self, backend, builder, value, attrs):
         return value
 
+    def unbox(self, backend, builder, api, obj, attrs):
+        '''Get the data pointer of an object that provides a contiguous
+        buffer.  The buffer must be writable unless the argument is only
+        read; see _is_input.
+        '''
+        i32 = lc.Type.int(32)
+        ssize = api.ssize_type
+        zero = lc.Constant.int(i32, 0)
+
+        flags = PyBUF_C_CONTIGUOUS
+        if not _is_input(attrs):
+            flags |= PyBUF_WRITABLE
+
+        view = builder.alloca(api.buffer_type)
+        rawview = builder.bitcast(view, api.object_type)
+        status = api.call(builder, 'PyObject_GetBuffer', obj, rawview,
+                          lc.Constant.int(i32, flags))
+
+        lfunc = builder.basic_block.function
+        bbcheck = lfunc.append_basic_block('buffer_check')
+        bbmismatch = lfunc.append_basic_block('buffer_mismatch')
+        bbdone = lfunc.append_basic_block('buffer_done')
+
+        builder.cbranch(builder.icmp(lc.ICMP_EQ, status, zero),
+                        bbcheck, bbdone)
+
+        builder.position_at_end(bbcheck)
+        itemsize = builder.load(builder.gep(view, [zero,
+                                                   lc.Constant.int(i32, 3)]))
+        expected = lc.Constant.int(ssize, sizeof(self._element_ctype(backend)))
+        builder.cbranch(builder.icmp(lc.ICMP_EQ, itemsize, expected),
+                        bbdone, bbmismatch)
+
+        builder.position_at_end(bbmismatch)
+        api.call(builder, 'PyBuffer_Release', rawview)
+        api.set_error(builder, 'PyExc_TypeError',
+                      "buffer item size does not match %s" % self.name)
+        builder.branch(bbdone)
+
+        builder.position_at_end(bbdone)
+        data = builder.load(builder.gep(view, [zero, zero]))
+        value = builder.bitcast(data, self.argument(backend))
+
+        def cleanup(builder):
+            api.call(builder, 'PyBuffer_Release', rawview)
+        return value, cleanup
+
+    def _element_ctype(self, backend):
+        return self.ctype(backend)._type_
+
+class SliceStruct(Structure):
+    _fields_ = [('data',   c_void_p),
+                ('length', c_ssize_t)]
+
+class SliceType(TypeImplementation):
+    '''A contiguous 1-D array that knows its length, passed as a pointer
+    to a descriptor {T *data; intp length}.  The length is filled in by the
+    wrapper of a JIT'ed function, so kernels need no count argument.
+    '''
+    def __init__(self, name, elemtype):
+        super(SliceType, self).__init__(name)
+        self.__elemtype = elemtype
+        self.__typestr = None
+
+    @property
+    def element(self):
+        return self.__elemtype
+
+    def _element_ctype(self, backend):
+        return backend.get_type_implementation(self.element).ctype(backend)
+
+    def _get_typestr(self, backend):
+        if self.__typestr is None:
+            self.__typestr = ctype_typestr(self._element_ctype(backend))
+        return self.__typestr
+
+    def ctype(self, backend):
+        return POINTER(SliceStruct)
+
+    def ctype_argument(self, backend, value, attrs=()):
+        '''Returns a descriptor of an array argument.
+
+        Accepts descriptors, ctypes arrays, objects with the NumPy array
+        interface and objects providing a C-contiguous buffer of matching
+        items.  Read-only buffers are rejected as for ArrayType.
+        '''
+        if isinstance(value, (SliceStruct, self.ctype(backend))):
+            return value
+
+        elemcty = self._element_ctype(backend)
+        typestr = self._get_typestr(backend)
+        if isinstance(value, Array) and value._type_ is elemcty:
+            return SliceStruct(addressof(value), len(value))
+
+        interface = getattr(value, '__array_interface__', None)
+        if interface is not None:
+            got = interface['typestr']
+            shape = interface['shape']
+            strides = interface.get('strides')
+            if len(shape) != 1:
+                raise TypeError("%s expects a 1-D array; got %d dimensions" %
+                                (self.name, len(shape)))
+            if (strides is not None and
+                    not _is_c_contiguous(shape, strides, sizeof(elemcty))):
+                raise TypeError("%s expects a contiguous array" % self.name)
+            address, length = interface['data'][0], shape[0]
+            readonly = interface['data'][1]
+        else:
+            info = get_buffer_info(value)
+            got = typestr_of_format(info.format, info.itemsize)
+            address, length = info.address, info.nbytes // info.itemsize
+            readonly = info.readonly
+
+        if got != typestr:
+            raise TypeError("%s expects items of %s; got %s" %
+                            (self.name, typestr, got))
+        _check_writable(self.name, readonly, attrs)
+        return SliceStruct(address, length)
+
+    def value(self, backend):
+        return lc.Type.pointer(self.descriptor(backend))
+
+    def descriptor(self, backend):
+        '''LLVM type of the descriptor.
+        '''
+        elemimpl = backend.get_type_implementation(self.element)
+        intp = lc.Type.int(ADDRESS_WIDTH * 8)
+        return lc.Type.struct([lc.Type.pointer(elemimpl.value(backend)),
+                               intp])
+
+    def argument(self, backend):
+        return self.value(backend)
+
+    def use(self, backend, builder, value):
+        return builder.load(value)
+
+    def allocate(self, backend, builder):
+        return builder.alloca(self.value(backend))
+
+    def assign(self, backend, builder, value, storage):
+        assert storage.type.pointee == value.type
+        builder.store(value, storage)
+
+    def prolog(self, backend, builder, value, attrs):
+        return value
+
+    def unbox(self, backend, builder, api, obj, attrs):
+        '''Fill a descriptor from the contiguous buffer of an object.
+        The buffer must be writable unless the argument is only read.
+        '''
+        i32 = lc.Type.int(32)
+        ssize = api.ssize_type
+        zero = lc.Constant.int(i32, 0)
+        field = lambda i: lc.Constant.int(i32, i)
+
+        flags = PyBUF_C_CONTIGUOUS
+        if not _is_input(attrs):
+            flags |= PyBUF_WRITABLE
+
+        view = builder.alloca(api.buffer_type)
+        rawview = builder.bitcast(view, api.object_type)
+        status = api.call(builder, 'PyObject_GetBuffer', obj, rawview,
+                          lc.Constant.int(i32, flags))
+
+        lfunc = builder.basic_block.function
+        bbcheck = lfunc.append_basic_block('buffer_check')
+        bbmismatch = lfunc.append_basic_block('buffer_mismatch')
+        bbfill = lfunc.append_basic_block('buffer_fill')
+        bbdone = lfunc.append_basic_block('buffer_done')
+
+        desc = builder.alloca(self.descriptor(backend))
+
+        builder.cbranch(builder.icmp(lc.ICMP_EQ, status, zero),
+                        bbcheck, bbdone)
+
+        builder.position_at_end(bbcheck)
+        itemsize = builder.load(builder.gep(view, [zero, field(3)]))
+        expected = lc.Constant.int(ssize,
+                                   sizeof(self._element_ctype(backend)))
+        builder.cbranch(builder.icmp(lc.ICMP_EQ, itemsize, expected),
+                        bbfill, bbmismatch)
+
+        builder.position_at_end(bbmismatch)
+        api.call(builder, 'PyBuffer_Release', rawview)
+        api.set_error(builder, 'PyExc_TypeError',
+                      "buffer item size does not match %s" % self.name)
+        builder.branch(bbdone)
+
+        builder.position_at_end(bbfill)
+        data = builder.load(builder.gep(view, [zero, zero]))
+        dataty = self.descriptor(backend).elements[0]
+        builder.store(builder.bitcast(data, dataty),
+                      builder.gep(desc, [zero, zero]))
+        nbytes = builder.load(builder.gep(view, [zero, field(2)]))
+        length = builder.sdiv(nbytes, expected)
+        intp = lc.Type.int(ADDRESS_WIDTH * 8)
+        if length.type != intp:
+            length = builder.trunc(length, intp)
+        builder.store(length, builder.gep(desc, [zero, field(1)]))
+        builder.branch(bbdone)
+
+        builder.position_at_end(bbdone)
+
+        def cleanup(builder):
+            api.call(builder, 'PyBuffer_Release', rawview)
+        return desc, cleanup
+
+_strided_structs = {}
+
+def strided_struct(ndim):
+    '''Returns the ctypes structure of a strided array descriptor of
+    `ndim` dimensions.  Strides are in bytes.
+    '''
+    try:
+        return _strided_structs[ndim]
+    except KeyError:
+        class StridedArray(Structure):
+            _fields_ = [('data',    c_void_p),
+                        ('shape',   c_ssize_t * ndim),
+                        ('strides', c_ssize_t * ndim)]
+        StridedArray.__name__ = 'StridedArray%dd' % ndim
+        _strided_structs[ndim] = StridedArray
+        return StridedArray
+
+class StridedArrayType(TypeImplementation):
+    '''A N-dimensional array passed as a pointer to a descriptor
+    {T *data; intp shape[N]; intp strides[N]}.  Strides are in bytes, so
+    that non-contiguous views such as slices and transposes are used
+    without copying.
+    '''
+    def __init__(self, name, elemtype, ndim):
+        super(StridedArrayType, self).__init__(name)
+        self.__elemtype = elemtype
+        self.__ndim = ndim
+        self.__typestr = None
+
+    @property
+    def element(self):
+        return self.__elemtype
+
+    @property
+    def ndim(self):
+        return self.__ndim
+
+    def _element_ctype(self, backend):
+        return backend.get_type_implementation(self.element).ctype(backend)
+
+    def _get_typestr(self, backend):
+        if self.__typestr is None:
+            self.__typestr = ctype_typestr(self._element_ctype(backend))
+        return self.__typestr
+
+    def ctype(self, backend):
+        return POINTER(strided_struct(self.ndim))
+
+    def ctype_argument(self, backend, value, attrs=()):
+        '''Returns a descriptor of an array argument.
+
+        Accepts descriptors, objects with the NumPy array interface and
+        objects providing a strided buffer of matching items.  Read-only
+        buffers are rejected as for ArrayType.
+        '''
+        struct = strided_struct(self.ndim)
+        if isinstance(value, (struct, self.ctype(backend))):
+            return value
+
+        typestr = self._get_typestr(backend)
+        interface = getattr(value, '__array_interface__', None)
+        if interface is not None:
+            got = interface['typestr']
+            address, readonly = interface['data']
+            shape = interface['shape']
+            strides = interface.get('strides')
+            if strides is None:
+                itemsize = sizeof(self._element_ctype(backend))
+                strides = c_contiguous_strides(shape, itemsize)
+        else:
+            info = get_buffer_info(value, PyBUF_STRIDES | PyBUF_FORMAT)
+            got = typestr_of_format(info.format, info.itemsize)
+            address, shape, strides = info.address, info.shape, info.strides
+            readonly = info.readonly
+
+        if got != typestr:
+            raise TypeError("%s expects items of %s; got %s" %
+                            (self.name, typestr, got))
+        if len(shape) != self.ndim:
+            raise TypeError("%s expects %d dimensions; got %d" %
+                            (self.name, self.ndim, len(shape)))
+        _check_writable(self.name, readonly, attrs)
+        return struct(address, tuple(shape), tuple(strides))
+
+    def value(self, backend):
+        return lc.Type.pointer(self.descriptor(backend))
+
+    def descriptor(self, backend):
+        '''LLVM type of the descriptor.
+        '''
+        elemimpl = backend.get_type_implementation(self.element)
+        intp = lc.Type.int(ADDRESS_WIDTH * 8)
+        return lc.Type.struct([lc.Type.pointer(elemimpl.value(backend)),
+                               lc.Type.array(intp, self.ndim),
+                               lc.Type.array(intp, self.ndim)])
+
+    def argument(self, backend):
+        return self.value(backend)
+
+    def use(self, backend, builder, value):
+        return builder.load(value)
+
+    def allocate(self, backend, builder):
+        return builder.alloca(self.value(backend))
+
+    def assign(self, backend, builder, value, storage):
+        assert storage.type.pointee == value.type
+        builder.store(value, storage)
+
+    def prolog(self, backend, builder, value, attrs):
+        return value
+
+    def unbox(self, backend, builder, api, obj, attrs):
+        '''Fill a descriptor from the strided buffer of an object.
+        The buffer must be writable unless the argument is only read.
+        '''
+        i32 = lc.Type.int(32)
+        ssize = api.ssize_type
+        zero = lc.Constant.int(i32, 0)
+        field = lambda i: lc.Constant.int(i32, i)
+
+        flags = PyBUF_STRIDES
+        if not _is_input(attrs):
+            flags |= PyBUF_WRITABLE
+
+        view = builder.alloca(api.buffer_type)
+        rawview = builder.bitcast(view, api.object_type)
+        status = api.call(builder, 'PyObject_GetBuffer', obj, rawview,
+                          lc.Constant.int(i32, flags))
+
+        lfunc = builder.basic_block.function
+        bbcheck = lfunc.append_basic_block('buffer_check')
+        bbmismatch = lfunc.append_basic_block('buffer_mismatch')
+        bbfill = lfunc.append_basic_block('buffer_fill')
+        bbdone = lfunc.append_basic_block('buffer_done')
+
+        desc = builder.alloca(self.descriptor(backend))
+
+        builder.cbranch(builder.icmp(lc.ICMP_EQ, status, zero),
+                        bbcheck, bbdone)
+
+        builder.position_at_end(bbcheck)
+        itemsize = builder.load(builder.gep(view, [zero, field(3)]))
+        ndim = builder.load(builder.gep(view, [zero, field(5)]))
+        expected = lc.Constant.int(ssize,
+                                   sizeof(self._element_ctype(backend)))
+        ok = builder.and_(builder.icmp(lc.ICMP_EQ, itemsize, expected),
+                          builder.icmp(lc.ICMP_EQ, ndim,
+                                       lc.Constant.int(i32, self.ndim)))
+        builder.cbranch(ok, bbfill, bbmismatch)
+
+        builder.position_at_end(bbmismatch)
+        api.call(builder, 'PyBuffer_Release', rawview)
+        api.set_error(builder, 'PyExc_TypeError',
+                      "buffer item size or dimensions do not match %s" %
+                      self.name)
+        builder.branch(bbdone)
+
+        builder.position_at_end(bbfill)
+        data = builder.load(builder.gep(view, [zero, zero]))
+        elemimpl = backend.get_type_implementation(self.element)
+        builder.store(builder.bitcast(data,
+                                      lc.Type.pointer(elemimpl.value(backend))),
+                      builder.gep(desc, [zero, zero]))
+        shape = builder.load(builder.gep(view, [zero, field(7)]))
+        strides = builder.load(builder.gep(view, [zero, field(8)]))
+        for k in range(self.ndim):
+            index = lc.Constant.int(ssize, k)
+            builder.store(builder.load(builder.gep(shape, [index])),
+                          builder.gep(desc, [zero, field(1), field(k)]))
+            builder.store(builder.load(builder.gep(strides, [index])),
+                          builder.gep(desc, [zero, field(2), field(k)]))
+        builder.branch(bbdone)
+
+        builder.position_at_end(bbdone)
+
+        def cleanup(builder):
+            api.call(builder, 'PyBuffer_Release', rawview)
+        return desc, cleanup
+
+def _is_input(attrs):
+    '''Whether the function only reads an argument: it has the 'in'
+    attribute and not the 'out' attribute.
+    '''
+    return 'in' in attrs and 'out' not in attrs
+
+def _check_writable(name, readonly, attrs):
+    if readonly and not _is_input(attrs):
+        raise ValueError("%s got a read-only buffer; the argument must "
+                         "have the 'in' attribute" % name)
+
+def _is_c_contiguous(shape, strides, itemsize):
+    expected = itemsize
+    for extent, stride in reversed(list(zip(shape, strides))):
+        if extent > 1 and stride != expected:
+            return False
+        expected *= extent
+    return True
+
 INTEGER_TYPES = _builtin_unsigned_int + _builtin_signed_int + ['address']
 REAL_TYPES = _builtin_real
 ELEMENT_TYPES = INTEGER_TYPES + REAL_TYPES
+STRIDED_DIMS = [2, 3]
+
+def strided_array_type(ndim, elemtype):
+    return 'array%dd_%s' % (ndim, elemtype)
+
+def slice_type(elemtype):
+    return 'slice_%s' % elemtype
+
+#
+# Elementwise intrinsics on array_T with an element count.
+#
+# array_<op>(A, B, C, n)    C[i] = A[i] <op> B[i]
+# array_<op>(A, s, C, n)    C[i] = A[i] <op> s
+# array_i<op>(A, B, n)      A[i] = A[i] <op> B[i]
+# array_i<op>(A, s, n)      A[i] = A[i] <op> s
+#
+# for <op> in add, sub, mul, div, min, max.  Also:
+#
+# array_abs(A, C, n)        C[i] = |A[i]|
+# array_iabs(A, n)          A[i] = |A[i]|
+# array_fma(A, B, C, D, n)  D[i] = A[i] * B[i] + C[i]
+# array_fma(A, s, C, D, n)  D[i] = A[i] * s + C[i]
+# array_ifma(D, A, B, n)    D[i] = A[i] * B[i] + D[i]
+# array_ifma(D, A, s, n)    D[i] = A[i] * s + D[i]
+# array_<cmp>(A, B, M, n)   M[i] = A[i] <cmp> B[i]
+# array_<cmp>(A, s, M, n)   M[i] = A[i] <cmp> s
+#
+# for <cmp> in lt, le, gt, ge, eq, ne; M is an array_uint8 of 0 and 1.
+#
+# The output of the out-of-place forms must not overlap the inputs.
+# The in-place forms allow the arrays to alias.
+#
+
+ARITHMETIC_OPS = ['add', 'sub', 'mul', 'div', 'min', 'max']
+COMPARE_OPS = ['lt', 'le', 'gt', 'ge', 'eq', 'ne']
+MASK_TYPE = 'array_uint8'
+
+def _elementwise_signatures(elemtype):
+    '''Yields (intrinsic name, operand types) of the elementwise
+    intrinsics of an element type.  The count is not included.
+    '''
+    A = 'array_%s' % elemtype
+    for op in ARITHMETIC_OPS:
+        for rhs in (A, elemtype):
+            yield 'array_%s' % op, (A, rhs, A)
+            yield 'array_i%s' % op, (A, rhs)
+    yield 'array_abs', (A, A)
+    yield 'array_iabs', (A,)
+    for rhs in (A, elemtype):
+        yield 'array_fma', (A, rhs, A, A)
+        yield 'array_ifma', (A, A, rhs)
+    for op in COMPARE_OPS:
+        for rhs in (A, elemtype):
+            yield 'array_%s' % op, (A, rhs, MASK_TYPE)
 
 def install_to_context(context):
     array_load = context.add_intrinsic("array_load")
     array_store = context.add_intrinsic("array_store")
-    array_add = context.add_intrinsic("array_add")
+    array_shape = context.add_intrinsic("array_shape")
+    array_stride = context.add_intrinsic("array_stride")
+    array_is_contiguous = context.add_intrinsic("array_is_contiguous")
+    array_data = context.add_intrinsic("array_data")
+    array_len = context.add_intrinsic("array_len")
 
     for elemtype in ELEMENT_TYPES:
         arraytype = 'array_%s' % elemtype
@@ -79,8 +592,43 @@ def install_to_context(context):
 
         array_load.add_definition(elemtype, [arraytype, 'address'])
         array_store.add_definition("void", [arraytype, elemtype, 'address'])
-        array_add.add_definition("void",
-                                 [arraytype, arraytype, arraytype, 'address'])
+
+        for name, operands in _elementwise_signatures(elemtype):
+            context.get_or_insert_intrinsic(name).add_definition(
+                                        "void", list(operands) + ['address'])
+
+        for name, retty, operands in _reduction_signatures(elemtype):
+            context.get_or_insert_intrinsic(name).add_definition(
+                                        retty, list(operands) + ['address'])
+
+        for name, operands in _memory_signatures(elemtype):
+            context.get_or_insert_intrinsic(name).add_definition(
+                                        "void", list(operands) + ['address'])
+
+        slicetype = slice_type(elemtype)
+        context.type_system.add_type(slicetype)
+        array_load.add_definition(elemtype, [slicetype, 'address'])
+        array_store.add_definition("void", [slicetype, elemtype, 'address'])
+        array_len.add_definition('address', [slicetype])
+        array_data.add_definition(arraytype, [slicetype])
+
+        for ndim in STRIDED_DIMS:
+            ndtype = strided_array_type(ndim, elemtype)
+            context.type_system.add_type(ndtype)
+            indices = ['address'] * ndim
+
+            array_load.add_definition(elemtype, [ndtype] + indices)
+            array_store.add_definition("void", [ndtype, elemtype] + indices)
+            array_shape.add_definition('address', [ndtype, 'address'])
+            array_stride.add_definition('address', [ndtype, 'address'])
+            array_is_contiguous.add_definition('pred', [ndtype])
+            array_data.add_definition(arraytype, [ndtype])
+
+    # the index arrays are defined by now
+    for elemtype in ELEMENT_TYPES:
+        for name, retty, operands in _indexed_signatures(elemtype):
+            context.get_or_insert_intrinsic(name).add_definition(
+                                                        retty, list(operands))
 
 def install_to_backend(backend):
     for elemtype in ELEMENT_TYPES:
@@ -95,21 +643,63 @@ def install_to_backend(backend):
                                     'void',
                                     (arraytype, elemtype, 'address'),
                                     array_store_impl)
-    for elemtype in INTEGER_TYPES:
-        arraytype = 'array_%s' % elemtype
-        backend.implement_intrinsic(
-                                'array_add',
-                                'void',
-                                (arraytype, arraytype, arraytype, 'address'),
-                                array_arith_impl(lc.Builder.add, elemtype))
 
-    for elemtype in REAL_TYPES:
-        arraytype = 'array_%s' % elemtype
-        backend.implement_intrinsic(
-                                'array_add',
-                                'void',
-                                (arraytype, arraytype, arraytype, 'address'),
-                                array_arith_impl(lc.Builder.fadd, elemtype))
+        slicetype = slice_type(elemtype)
+        backend.implement_type(SliceType(slicetype, elemtype))
+        backend.implement_intrinsic('array_load', elemtype,
+                                    (slicetype, 'address'),
+                                    slice_load_impl)
+        backend.implement_intrinsic('array_store', 'void',
+                                    (slicetype, elemtype, 'address'),
+                                    slice_store_impl)
+        backend.implement_intrinsic('array_len', 'address', (slicetype,),
+                                    slice_len_impl)
+        backend.implement_intrinsic('array_data', arraytype, (slicetype,),
+                                    strided_data_impl)
+
+        for ndim in STRIDED_DIMS:
+            ndtype = strided_array_type(ndim, elemtype)
+            indices = ('address',) * ndim
+
+            backend.implement_type(StridedArrayType(ndtype, elemtype, ndim))
+            backend.implement_intrinsic('array_load', elemtype,
+                                        (ndtype,) + indices,
+                                        strided_load_impl)
+            backend.implement_intrinsic('array_store', 'void',
+                                        (ndtype, elemtype) + indices,
+                                        strided_store_impl)
+            backend.implement_intrinsic('array_shape', 'address',
+                                        (ndtype, 'address'),
+                                        descriptor_field_impl(1))
+            backend.implement_intrinsic('array_stride', 'address',
+                                        (ndtype, 'address'),
+                                        descriptor_field_impl(2))
+            backend.implement_intrinsic('array_is_contiguous', 'pred',
+                                        (ndtype,),
+                                        strided_is_contiguous_impl(ndim))
+            backend.implement_intrinsic('array_data', arraytype, (ndtype,),
+                                        strided_data_impl)
+    for elemtype in ELEMENT_TYPES:
+        for name, operands in _elementwise_signatures(elemtype):
+            impl = elementwise_impl(name, elemtype, operands)
+            backend.implement_intrinsic(name, 'void',
+                                        tuple(operands) + ('address',),
+                                        impl)
+
+        for name, retty, operands in _reduction_signatures(elemtype):
+            backend.implement_intrinsic(name, retty,
+                                        tuple(operands) + ('address',),
+                                        reduction_impl(name, elemtype))
+
+        for name, operands in _memory_signatures(elemtype):
+            backend.implement_intrinsic(name, 'void',
+                                        tuple(operands) + ('address',),
+                                        memory_impl(name))
+
+        for name, retty, operands in _indexed_signatures(elemtype):
+            indices = operands[2 if name == 'array_put' else 1]
+            impl = _indexed_access_impl(name, indices[len('array_'):])
+            backend.implement_intrinsic(name, retty, operands, impl)
 
 def array_load_impl(lfunc):
     bb = lfunc.append_basic_block('entry')
@@ -127,53 +717,780 @@ def array_store_impl(lfunc):
     builder.ret_void()
 
 
-def array_arith_impl(operator, elemtype):
-    def _array_arith_impl(lfunc):
+def _slice_length(builder, array):
+    '''Load the length of a slice.  The load is annotated with the range
+    [0, INTP_MAX) so that loops bounded by the length have a non-negative
+    trip count.
+    '''
+    i32 = lc.Type.int(32)
+    length = builder.load(builder.gep(array, [lc.Constant.int(i32, 0),
+                                              lc.Constant.int(i32, 1)]))
+    intp = length.type
+    bits = ADDRESS_WIDTH * 8
+    bounds = [lc.Constant.int(intp, 0),
+              lc.Constant.int(intp, (1 << (bits - 1)) - 1)]
+    module = builder.basic_block.function.module
+    length.set_metadata('range', lc.MetaData.get(module, bounds))
+    return length
+
+def _slice_pointer(builder, array, idx):
+    zero = lc.Constant.int(lc.Type.int(32), 0)
+    data = builder.load(builder.gep(array, [zero, zero]))
+    return builder.gep(data, [idx])
+
+def slice_load_impl(lfunc):
+    bb = lfunc.append_basic_block('entry')
+    builder = lc.Builder.new(bb)
+    array, idx = lfunc.args
+    builder.ret(builder.load(_slice_pointer(builder, array, idx)))
+
+def slice_store_impl(lfunc):
+    bb = lfunc.append_basic_block('entry')
+    builder = lc.Builder.new(bb)
+    array, value, idx = lfunc.args
+    builder.store(value, _slice_pointer(builder, array, idx))
+    builder.ret_void()
+
+def slice_len_impl(lfunc):
+    bb = lfunc.append_basic_block('entry')
+    builder = lc.Builder.new(bb)
+    builder.ret(_slice_length(builder, lfunc.args[0]))
+
+def _strided_pointer(builder, array, indices):
+    '''Address of an element of a strided array.
+    '''
+    i32 = lc.Type.int(32)
+    zero = lc.Constant.int(i32, 0)
+    data = builder.load(builder.gep(array, [zero, zero]))
+    raw = builder.bitcast(data, lc.Type.pointer(lc.Type.int(8)))
+    offset = None
+    for k, idx in enumerate(indices):
+        stride = builder.load(builder.gep(array, [zero,
+                                                  lc.Constant.int(i32, 2),
+                                                  lc.Constant.int(i32, k)]))
+        term = builder.mul(idx, stride)
+        offset = term if offset is None else builder.add(offset, term)
+    return builder.bitcast(builder.gep(raw, [offset]), data.type)
+
+def strided_load_impl(lfunc):
+    bb = lfunc.append_basic_block('entry')
+    builder = lc.Builder.new(bb)
+    array = lfunc.args[0]
+    elem = _strided_pointer(builder, array, lfunc.args[1:])
+    builder.ret(builder.load(elem))
+
+def strided_store_impl(lfunc):
+    bb = lfunc.append_basic_block('entry')
+    builder = lc.Builder.new(bb)
+    array, value = lfunc.args[:2]
+    elem = _strided_pointer(builder, array, lfunc.args[2:])
+    builder.store(value, elem)
+    builder.ret_void()
+
+def descriptor_field_impl(field):
+    '''Load an element of the shape (1) or strides (2) of a descriptor.
+    '''
+    def _descriptor_field_impl(lfunc):
+        bb = lfunc.append_basic_block('entry')
+        builder = lc.Builder.new(bb)
+        array, dim = lfunc.args
+        i32 = lc.Type.int(32)
+        ptr = builder.gep(array, [lc.Constant.int(i32, 0),
+                                  lc.Constant.int(i32, field), dim])
+        builder.ret(builder.load(ptr))
+    return _descriptor_field_impl
+
+def strided_is_contiguous_impl(ndim):
+    def _strided_is_contiguous_impl(lfunc):
+        bb = lfunc.append_basic_block('entry')
+        builder = lc.Builder.new(bb)
+        array = lfunc.args[0]
+        i32 = lc.Type.int(32)
+        zero = lc.Constant.int(i32, 0)
+        elemty = array.type.pointee.elements[0].pointee
+        intp = lc.Type.int(ADDRESS_WIDTH * 8)
+        one = lc.Constant.int(intp, 1)
+
+        # C-contiguous: every dimension of extent > 1 has the stride of
+        # the product of the inner extents times the item size
+        expected = builder.ptrtoint(
+                        builder.gep(lc.Constant.null(lc.Type.pointer(elemty)),
+                                    [lc.Constant.int(i32, 1)]),
+                        intp)
+        result = lc.Constant.int(lc.Type.int(1), 1)
+        for k in reversed(range(ndim)):
+            dim = lc.Constant.int(i32, k)
+            extent = builder.load(builder.gep(array, [zero,
+                                              lc.Constant.int(i32, 1), dim]))
+            stride = builder.load(builder.gep(array, [zero,
+                                              lc.Constant.int(i32, 2), dim]))
+            ok = builder.or_(builder.icmp(lc.ICMP_SLE, extent, one),
+                             builder.icmp(lc.ICMP_EQ, stride, expected))
+            result = builder.and_(result, ok)
+            expected = builder.mul(expected, extent)
+
+        retty = lfunc.type.pointee.return_type
+        if retty.width != 1:
+            result = builder.zext(result, retty)
+        builder.ret(result)
+    return _strided_is_contiguous_impl
+
+def strided_data_impl(lfunc):
+    bb = lfunc.append_basic_block('entry')
+    builder = lc.Builder.new(bb)
+    array = lfunc.args[0]
+    zero = lc.Constant.int(lc.Type.int(32), 0)
+    data = builder.load(builder.gep(array, [zero, zero]))
+    builder.ret(builder.bitcast(data, lfunc.type.pointee.return_type))
+
+#
+# Reductions on array_T with an element count.
+#
+# array_sum(A, n)           sum of A[i]
+# array_dot(A, B, n)        sum of A[i] * B[i]
+# array_min(A, n)           smallest A[i]; the largest value if n == 0
+# array_max(A, n)           largest A[i]; the smallest value if n == 0
+# array_argmin(A, n)        first index of the smallest A[i]; n if n == 0
+# array_argmax(A, n)        first index of the largest A[i]; n if n == 0
+# array_sum_pairwise(A, n)  sum of A[i] by pairwise summation (real only)
+#
+# The loops keep REDUCTION_ACCUMULATORS vector accumulators of
+# REDUCTION_VECTOR_BYTES each, so that floating-point reductions are
+# vectorized without relying on reassociation.  The order of summation
+# therefore differs from a sequential loop.  The result of min, max,
+# argmin and argmax is unspecified if the array contains a NaN.
+#
+
+REDUCTION_VECTOR_BYTES = 16
+REDUCTION_ACCUMULATORS = 4
+PAIRWISE_BLOCK = 128
+
+def _reduction_signatures(elemtype):
+    '''Yields (intrinsic name, return type, operand types) of the
+    reductions of an element type.  The count is not included.
+    '''
+    A = 'array_%s' % elemtype
+    yield 'array_sum', elemtype, (A,)
+    yield 'array_dot', elemtype, (A, A)
+    yield 'array_min', elemtype, (A,)
+    yield 'array_max', elemtype, (A,)
+    yield 'array_argmin', 'address', (A,)
+    yield 'array_argmax', 'address', (A,)
+    if elemtype in REAL_TYPES:
+        yield 'array_sum_pairwise', elemtype, (A,)
+
+def _sizeof(ty):
+    if isinstance(ty, lc.IntegerType):
+        return ty.width // 8
+    elif ty == lc.Type.float():
+        return 4
+    elif ty == lc.Type.double():
+        return 8
+    raise TypeError(ty)
+
+def _splat(value, lanes):
+    return lc.Constant.vector([value] * lanes)
+
+def _reduction_identity(op, elemtype, ty):
+    '''The initial value of the accumulators of a reduction.
+    '''
+    if op in ('sum', 'dot'):
+        return lc.Constant.null(ty)
+    largest = op == 'min'
+    if elemtype in REAL_TYPES:
+        inf = float('inf')
+        return lc.Constant.real(ty, inf if largest else -inf)
+    bits = ty.width
+    if elemtype in _builtin_signed_int:
+        if largest:
+            return lc.Constant.int(ty, (1 << (bits - 1)) - 1)
+        return lc.Constant.int_signextend(ty, -(1 << (bits - 1)))
+    if largest:
+        return lc.Constant.int_signextend(ty, -1)
+    return lc.Constant.null(ty)
+
+def _reduction_combine(op, elemtype):
+    '''Returns a function (builder, acc, value) -> acc.  Works on
+    scalars and vectors.
+    '''
+    if op in ('sum', 'dot'):
+        return elementwise_operator('array_add', elemtype)
+    compare = _compare('lt' if op == 'min' else 'gt', elemtype)
+    def _combine(builder, acc, value):
+        return builder.select(compare(builder, acc, value), acc, value)
+    return _combine
+
+def _reduction_loop(builder, start, stop, step, inits, body):
+    '''Emit a loop of an index from `start` while it is less than `stop`
+    that carries the values of `inits`.  `body(builder, idx, values)`
+    returns the values of the next iteration.
+
+    Returns the values after the loop.
+    '''
+    lfunc = builder.basic_block.function
+    bbentry = builder.basic_block
+    bbcond = lfunc.append_basic_block('cond')
+    bbbody = lfunc.append_basic_block('body')
+    bbexit = lfunc.append_basic_block('exit')
+    builder.branch(bbcond)
+
+    builder.position_at_end(bbcond)
+    idx = builder.phi(start.type, name='idx')
+    idx.add_incoming(start, bbentry)
+    values = []
+    for init in inits:
+        phi = builder.phi(init.type)
+        phi.add_incoming(init, bbentry)
+        values.append(phi)
+    builder.cbranch(builder.icmp(lc.ICMP_ULT, idx, stop), bbbody, bbexit)
+
+    builder.position_at_end(bbbody)
+    results = body(builder, idx, values)
+    bblast = builder.basic_block
+    idx.add_incoming(builder.add(idx, step, name='idx_next'), bblast)
+    for phi, result in zip(values, results):
+        phi.add_incoming(result, bblast)
+    builder.branch(bbcond)
+
+    builder.position_at_end(bbexit)
+    return values
+
+def _emit_reduction(builder, op, elemtype, arrays, count):
+    '''Emit a multi-accumulator reduction of sum, dot, min or max.
+    Returns the scalar result.
+    '''
+    intp = lc.Type.int(ADDRESS_WIDTH * 8)
+    i32 = lc.Type.int(32)
+    elemty = arrays[0].type.pointee
+    itemsize = _sizeof(elemty)
+    lanes = max(1, REDUCTION_VECTOR_BYTES // itemsize)
+    vecty = lc.Type.vector(elemty, lanes)
+    step = lanes * REDUCTION_ACCUMULATORS
+
+    combine = _reduction_combine(op, elemtype)
+    multiply = elementwise_operator('array_mul', elemtype)
+    identity = _reduction_identity(op, elemtype, elemty)
+
+    def load(builder, idx, vector):
+        values = []
+        for array in arrays:
+            ptr = builder.gep(array, [idx])
+            if vector:
+                ptr = builder.bitcast(ptr, lc.Type.pointer(vecty))
+            values.append(builder.load(ptr, align=itemsize))
+        if op == 'dot':
+            return multiply(builder, *values)
+        return values[0]
+
+    # vector loop over the multiple of `step`
+    def vector_body(builder, idx, accs):
+        results = []
+        for k, acc in enumerate(accs):
+            offset = builder.add(idx, lc.Constant.int(intp, k * lanes))
+            results.append(combine(builder, acc, load(builder, offset, True)))
+        return results
+
+    ZERO = lc.Constant.int(intp, 0)
+    stop = builder.sub(count, builder.urem(count,
+                                           lc.Constant.int(intp, step)))
+    inits = [_splat(identity, lanes)] * REDUCTION_ACCUMULATORS
+    accs = _reduction_loop(builder, ZERO, stop, lc.Constant.int(intp, step),
+                           inits, vector_body)
+
+    # combine the accumulators and their lanes as a tree
+    while len(accs) > 1:
+        accs = [combine(builder, accs[i], accs[i + 1])
+                for i in range(0, len(accs), 2)]
+    values = [builder.extract_element(accs[0], lc.Constant.int(i32, k))
+              for k in range(lanes)]
+    while len(values) > 1:
+        values = [combine(builder, values[i], values[i + 1])
+                  for i in range(0, len(values), 2)]
+
+    # scalar loop over the remainder
+    def scalar_body(builder, idx, accs):
+        return [combine(builder, accs[0], load(builder, idx, False))]
+
+    result, = _reduction_loop(builder, stop, count, lc.Constant.int(intp, 1),
+                              values, scalar_body)
+    return result
+
+def _emit_find(builder, array, count, value):
+    '''Emit a search for the first index of `value`.  Returns the index
+    or `count` if it is not found.
+    '''
+    intp = count.type
+    lfunc = builder.basic_block.function
+    bbentry = builder.basic_block
+    bbcond = lfunc.append_basic_block('find_cond')
+    bbbody = lfunc.append_basic_block('find_body')
+    bbexit = lfunc.append_basic_block('find_exit')
+    builder.branch(bbcond)
+
+    builder.position_at_end(bbcond)
+    idx = builder.phi(intp, name='idx')
+    idx.add_incoming(lc.Constant.int(intp, 0), bbentry)
+    builder.cbranch(builder.icmp(lc.ICMP_ULT, idx, count), bbbody, bbexit)
+
+    builder.position_at_end(bbbody)
+    elem = builder.load(builder.gep(array, [idx]))
+    if isinstance(elem.type, lc.IntegerType):
+        found = builder.icmp(lc.ICMP_EQ, elem, value)
+    else:
+        found = builder.fcmp(lc.FCMP_OEQ, elem, value)
+    idx.add_incoming(builder.add(idx, lc.Constant.int(intp, 1)), bbbody)
+    builder.cbranch(found, bbexit, bbcond)
+
+    builder.position_at_end(bbexit)
+    return idx
+
+def _pairwise_helper(lfunc, elemtype):
+    '''Returns the recursive function of a pairwise summation.  Blocks of
+    up to PAIRWISE_BLOCK elements are summed with the multi-accumulator
+    loop.
+    '''
+    module = lfunc.module
+    name = '%s.recursive' % lfunc.name
+    helper = module.add_function(lfunc.type.pointee, name)
+    helper.linkage = lc.LINKAGE_LINKONCE_ODR
+    helper.visibility = lc.VISIBILITY_HIDDEN
+
+    array, count = helper.args
+    intp = count.type
+    step = REDUCTION_ACCUMULATORS * max(1, REDUCTION_VECTOR_BYTES //
+                                           _sizeof(array.type.pointee))
+
+    bbentry = helper.append_basic_block('entry')
+    bbblock = helper.append_basic_block('block')
+    bbsplit = helper.append_basic_block('split')
+    builder = lc.Builder.new(bbentry)
+    small = builder.icmp(lc.ICMP_ULE, count,
+                         lc.Constant.int(intp, PAIRWISE_BLOCK))
+    builder.cbranch(small, bbblock, bbsplit)
+
+    builder.position_at_end(bbblock)
+    builder.ret(_emit_reduction(builder, 'sum', elemtype, [array], count))
+
+    builder.position_at_end(bbsplit)
+    # split at a multiple of the vector loop step
+    half = builder.and_(builder.lshr(count, lc.Constant.int(intp, 1)),
+                        lc.Constant.int_signextend(intp, -step))
+    lhs = builder.call(helper, [array, half])
+    rhs = builder.call(helper, [builder.gep(array, [half]),
+                                builder.sub(count, half)])
+    builder.ret(builder.fadd(lhs, rhs))
+    return helper
+
+def reduction_impl(name, elemtype):
+    '''Implement a reduction intrinsic.  See the table above.
+    '''
+    op = name[len('array_'):]
+    def _reduction_impl(lfunc):
+        args = list(lfunc.args)
+        count = args.pop()
+        for arg in args:
+            arg.add_attribute(lc.ATTR_NO_ALIAS)
+        builder = lc.Builder.new(lfunc.append_basic_block('entry'))
+
+        if op == 'sum_pairwise':
+            helper = _pairwise_helper(lfunc, elemtype)
+            builder.ret(builder.call(helper, [args[0], count]))
+        elif op in ('argmin', 'argmax'):
+            best = _emit_reduction(builder, op[3:], elemtype, args, count)
+            builder.ret(_emit_find(builder, args[0], count, best))
+        else:
+            builder.ret(_emit_reduction(builder, op, elemtype, args, count))
+    return _reduction_impl
+
+_COMPARE_FLAGS = {
+    #       unsigned      signed        real
+    'lt': (lc.ICMP_ULT, lc.ICMP_SLT, lc.FCMP_OLT),
+    'le': (lc.ICMP_ULE, lc.ICMP_SLE, lc.FCMP_OLE),
+    'gt': (lc.ICMP_UGT, lc.ICMP_SGT, lc.FCMP_OGT),
+    'ge': (lc.ICMP_UGE, lc.ICMP_SGE, lc.FCMP_OGE),
+    'eq': (lc.ICMP_EQ,  lc.ICMP_EQ,  lc.FCMP_OEQ),
+    'ne': (lc.ICMP_NE,  lc.ICMP_NE,  lc.FCMP_ONE),
+}
+
+def _compare(op, elemtype):
+    unsigned, signed, real = _COMPARE_FLAGS[op]
+    if elemtype in REAL_TYPES:
+        return lambda builder, lhs, rhs: builder.fcmp(real, lhs, rhs)
+    flag = signed if elemtype in _builtin_signed_int else unsigned
+    return lambda builder, lhs, rhs: builder.icmp(flag, lhs, rhs)
+
+def _fmuladd(builder, a, b, c):
+    intr = getattr(lc, 'INTR_FMULADD', None)
+    if intr is None:
+        return builder.fadd(builder.fmul(a, b), c)
+    module = builder.basic_block.function.module
+    fn = lc.Function.intrinsic(module, intr, [a.type])
+    return builder.call(fn, [a, b, c])
+
+def _fabs(builder, value):
+    module = builder.basic_block.function.module
+    fn = lc.Function.intrinsic(module, lc.INTR_FABS, [value.type])
+    return builder.call(fn, [value])
+
+def _iabs(builder, value):
+    zero = lc.Constant.null(value.type)
+    negative = builder.icmp(lc.ICMP_SLT, value, zero)
+    return builder.select(negative, builder.sub(zero, value), value)
+
+def elementwise_operator(name, elemtype):
+    '''Returns a function (builder, *values) -> value that computes an
+    element of an elementwise intrinsic.
+    '''
+    real = elemtype in REAL_TYPES
+    signed = elemtype in _builtin_signed_int
+    op = name[len('array_'):]
+    if op.startswith('i') and op[1:] in ARITHMETIC_OPS + ['abs', 'fma']:
+        op = op[1:]
+
+    if op in ('add', 'sub', 'mul'):
+        method = getattr(lc.Builder, ('f' + op) if real else op)
+        return lambda builder, lhs, rhs: method(builder, lhs, rhs)
+    if op == 'div':
+        if real:
+            return lambda builder, lhs, rhs: builder.fdiv(lhs, rhs)
+        elif signed:
+            return lambda builder, lhs, rhs: builder.sdiv(lhs, rhs)
+        return lambda builder, lhs, rhs: builder.udiv(lhs, rhs)
+    if op in ('min', 'max'):
+        compare = _compare('lt' if op == 'min' else 'gt', elemtype)
+        def _select(builder, lhs, rhs):
+            return builder.select(compare(builder, lhs, rhs), lhs, rhs)
+        return _select
+    if op == 'abs':
+        if real:
+            return _fabs
+        elif signed:
+            return _iabs
+        return lambda builder, value: value
+    if op == 'fma':
+        if real:
+            return _fmuladd
+        return lambda builder, a, b, c: builder.add(builder.mul(a, b), c)
+    if op in COMPARE_OPS:
+        return _compare(op, elemtype)
+    raise NameError(name)
+
+def elementwise_element(builder, operator, name, values, elemty):
+    '''Compute an element of the destination of an elementwise intrinsic
+    from the values of its operands in argument order.
+
+    operator --- as returned by elementwise_operator.
+    elemty   --- LLVM type of the elements of the destination.
+    '''
+    if name.startswith('array_ifma'):
+        # D = A * B + D
+        values = values[1:] + values[:1]
+    res = operator(builder, *values)
+    if res.type != elemty:
+        res = builder.zext(res, elemty)     # comparison mask
+    return res
+
+def elementwise_impl(name, elemtype, operands):
+    '''Implement an elementwise intrinsic as a loop over the count.
+    See the table above for the arguments.
+    '''
+    operator = elementwise_operator(name, elemtype)
+    inplace = name.startswith('array_i')
+    def _elementwise_impl(lfunc):
         intp = lc.Type.int(ADDRESS_WIDTH * 8)
         ZERO = lc.Constant.int(intp, 0)
         ONE = lc.Constant.int(intp, 1)
 
+        args = list(lfunc.args)
+        elemct = args.pop()
+        if inplace:
+            # the destination is also the first operand
+            dary, inputs = args[0], args
+        else:
+            dary, inputs = args[-1], args[:-1]
+            for kind, arg in zip(operands, args):
+                if kind.startswith('array_'):
+                    arg.add_attribute(lc.ATTR_NO_ALIAS)
+
+        tbaaroot = tbaa.TBAABuilder.new(lfunc.module, 'mlvm.tbaa')
+        tbaa_type = tbaaroot.get_node(elemtype)
+        if inplace:
+            tbaa_load = tbaa_type
+        else:
+            tbaa_load = tbaaroot.get_node(' '.join(["const", elemtype]),
+                                          tbaa_type, const=True)
+        desttype = operands[0 if inplace else -1][len('array_'):]
+        tbaa_store = tbaaroot.get_node(desttype)
+
         bbentry = lfunc.append_basic_block('entry')
+        bbcond = lfunc.append_basic_block('cond')
         bbbody = lfunc.append_basic_block('body')
         bbexit = lfunc.append_basic_block('exit')
-        
-        builder = lc.Builder.new(bbentry)
-        step = ONE
 
-        builder.branch(bbbody)
+        builder = lc.Builder.new(bbentry)
+        builder.branch(bbcond)
 
-        builder.position_at_end(bbbody)
-        
+        builder.position_at_end(bbcond)
         idx = builder.phi(intp, name='idx')
         idx.add_incoming(ZERO, bbentry)
+        pred = builder.icmp(lc.ICMP_ULT, idx, elemct)
+        builder.cbranch(pred, bbbody, bbexit)
 
-        lary, rary, dary, elemct  = lfunc.args
-        lary.add_attribute(lc.ATTR_NO_ALIAS)
-        rary.add_attribute(lc.ATTR_NO_ALIAS)
-        dary.add_attribute(lc.ATTR_NO_ALIAS)
+        builder.position_at_end(bbbody)
+        values = []
+        for kind, arg in zip(operands, inputs):
+            if not kind.startswith('array_'):
+                values.append(arg)      # scalar operand
+                continue
+            value = builder.load(builder.gep(arg, [idx]))
+            value.set_metadata("tbaa", tbaa_load)
+            values.append(value)
 
-        tbaaroot = tbaa.TBAABuilder.new(lfunc.module, 'mlvm.tbaa')
-        tbaa_type = tbaaroot.get_node(elemtype)
-        tbaa_consttype = tbaaroot.get_node(' '.join(["const", elemtype]),
-                                           tbaa_type, const=True)
+        res = elementwise_element(builder, operator, name, values,
+                                  dary.type.pointee)
+        store = builder.store(res, builder.gep(dary, [idx]))
+        store.set_metadata("tbaa", tbaa_store)
 
-        lval = builder.load(builder.gep(lary, [idx]))
-        lval.set_metadata("tbaa", tbaa_consttype)
-        rval = builder.load(builder.gep(rary, [idx]))
-        rval.set_metadata("tbaa", tbaa_consttype)
+        idx_next = builder.add(idx, ONE, name='idx_next')
+        idx.add_incoming(idx_next, bbbody)
+        builder.branch(bbcond)
 
-        res = operator(builder, lval, rval)
+        builder.position_at_end(bbexit)
+        builder.ret_void()
+    return _elementwise_impl
 
-        store = builder.store(res, builder.gep(dary, [idx]))
-        store.set_metadata("tbaa", tbaa_type)
+#
+# Indexed access to array_T through an array of indices.
+#
+# array_take(A, I, i)                   A[I[i]]
+# array_put(A, x, I, i)                 A[I[i]] = x
+# array_gather(A, I, C, n)              C[i] = A[I[i]]
+# array_gather_masked(A, I, M, C, n)    C[i] = A[I[i]] where M[i]
+# array_scatter(B, I, A, n)             A[I[i]] = B[i]
+# array_scatter_masked(B, I, M, A, n)   A[I[i]] = B[i] where M[i]
+#
+# for I an array_int32, array_int64 or array_address and M an array_uint8.
+# Where M[i] is 0, A[I[i]] is neither read nor written and C[i] is kept.
+# If an index repeats in a scatter, the last write wins.  The arrays of a
+# gather or scatter must not overlap.
+#
+# The loop is unrolled by GATHER_LANES scalar accesses.
+#
 
+INDEX_TYPES = ['int32', 'int64', 'address']
+GATHER_LANES = 4
 
-        idx_next = builder.add(idx, step, name='idx_next')
-        idx.add_incoming(idx_next, bbbody)
+def _indexed_signatures(elemtype):
+    '''Yields (intrinsic name, return type, operand types) of the indexed
+    accesses of an element type.
+    '''
+    A = 'array_%s' % elemtype
+    for indextype in INDEX_TYPES:
+        I = 'array_%s' % indextype
+        yield 'array_take', elemtype, (A, I, 'address')
+        yield 'array_put', 'void', (A, elemtype, I, 'address')
+        yield 'array_gather', 'void', (A, I, A, 'address')
+        yield 'array_gather_masked', 'void', (A, I, MASK_TYPE, A, 'address')
+        yield 'array_scatter', 'void', (A, I, A, 'address')
+        yield 'array_scatter_masked', 'void', (A, I, MASK_TYPE, A, 'address')
 
-        pred = builder.icmp(lc.ICMP_ULT, idx, elemct)
-        builder.cbranch(pred, bbbody, bbexit)
+def _load_index(builder, indices, idx, indextype):
+    '''Load I[idx] as an address-sized integer.
+    '''
+    intp = lc.Type.int(ADDRESS_WIDTH * 8)
+    value = builder.load(builder.gep(indices, [idx]))
+    if value.type.width > intp.width:
+        return builder.trunc(value, intp)
+    elif value.type.width < intp.width:
+        if indextype in _builtin_signed_int:
+            return builder.sext(value, intp)
+        return builder.zext(value, intp)
+    return value
 
-        builder.position_at_end(bbexit)
+def take_impl(indextype):
+    def _take_impl(lfunc):
+        builder = lc.Builder.new(lfunc.append_basic_block('entry'))
+        array, indices, idx = lfunc.args
+        pos = _load_index(builder, indices, idx, indextype)
+        builder.ret(builder.load(builder.gep(array, [pos])))
+    return _take_impl
+
+def put_impl(indextype):
+    def _put_impl(lfunc):
+        builder = lc.Builder.new(lfunc.append_basic_block('entry'))
+        array, value, indices, idx = lfunc.args
+        pos = _load_index(builder, indices, idx, indextype)
+        builder.store(value, builder.gep(array, [pos]))
+        builder.ret_void()
+    return _put_impl
+
+def indexed_impl(name, indextype):
+    '''Implement a gather or scatter.  See _indexed_signatures.
+    '''
+    scatter = name.startswith('array_scatter')
+    masked = name.endswith('_masked')
+    def _indexed_impl(lfunc):
+        intp = lc.Type.int(ADDRESS_WIDTH * 8)
+        i8 = lc.Type.int(8)
+
+        args = list(lfunc.args)
+        count = args.pop()
+        for arg in args:
+            arg.add_attribute(lc.ATTR_NO_ALIAS)
+        if masked:
+            source, indices, mask, dest = args
+        else:
+            source, indices, dest = args
+        table = dest if scatter else source
+
+        def lane(builder, idx):
+            if masked:
+                flag = builder.load(builder.gep(mask, [idx]))
+                bbon = lfunc.append_basic_block('lane')
+                bbnext = lfunc.append_basic_block('next')
+                builder.cbranch(builder.icmp(lc.ICMP_NE, flag,
+                                             lc.Constant.null(i8)),
+                                bbon, bbnext)
+                builder.position_at_end(bbon)
+            pos = _load_index(builder, indices, idx, indextype)
+            if scatter:
+                builder.store(builder.load(builder.gep(source, [idx])),
+                              builder.gep(table, [pos]))
+            else:
+                builder.store(builder.load(builder.gep(table, [pos])),
+                              builder.gep(dest, [idx]))
+            if masked:
+                builder.branch(bbnext)
+                builder.position_at_end(bbnext)
+
+        def unrolled_group(builder, idx):
+            for k in range(GATHER_LANES):
+                lane(builder, builder.add(idx, lc.Constant.int(intp, k)))
+
+        def group_body(builder, idx, values):
+            unrolled_group(builder, idx)
+            return []
+
+        def lane_body(builder, idx, values):
+            lane(builder, idx)
+            return []
+
+        builder = lc.Builder.new(lfunc.append_basic_block('entry'))
+        ZERO = lc.Constant.int(intp, 0)
+        lanes = lc.Constant.int(intp, GATHER_LANES)
+        stop = builder.sub(count, builder.urem(count, lanes))
+        _reduction_loop(builder, ZERO, stop, lanes, [], group_body)
+        _reduction_loop(builder, stop, count, lc.Constant.int(intp, 1), [],
+                        lane_body)
+        builder.ret_void()
+    return _indexed_impl
+
+def _indexed_access_impl(name, indextype):
+    if name == 'array_take':
+        return take_impl(indextype)
+    elif name == 'array_put':
+        return put_impl(indextype)
+    return indexed_impl(name, indextype)
+
+#
+# Bulk memory intrinsics on array_T with an element count.
+#
+# array_copy(A, C, n)       C[i] = A[i]; A and C must not overlap
+# array_move(A, C, n)       C[i] = A[i]; A and C may overlap
+# array_fill(A, x, n)       A[i] = x
+# array_zero(A, n)          A[i] = 0
+#
+# They are lowered to llvm.memcpy, llvm.memmove and llvm.memset with the
+# alignment of the element type.  array_fill uses llvm.memset when every
+# byte of x is the same, as for 0 and -1, and a store loop otherwise.
+#
+
+def _memory_signatures(elemtype):
+    '''Yields (intrinsic name, operand types) of the bulk memory
+    intrinsics of an element type.  The count is not included.
+    '''
+    A = 'array_%s' % elemtype
+    yield 'array_copy', (A, A)
+    yield 'array_move', (A, A)
+    yield 'array_fill', (A, elemtype)
+    yield 'array_zero', (A,)
+
+def _emit_memory(builder, intr, dest, source, count):
+    '''Emit a call of llvm.memcpy, llvm.memmove or llvm.memset on `count`
+    elements of `dest`.  `source` is an array, or an i8 for llvm.memset.
+    '''
+    module = builder.basic_block.function.module
+    bytep = lc.Type.pointer(lc.Type.int(8))
+    itemsize = _sizeof(dest.type.pointee)
+    args = [builder.bitcast(dest, bytep)]
+    if intr == lc.INTR_MEMSET:
+        args.append(source)
+        fn = lc.Function.intrinsic(module, intr, [bytep, count.type])
+    else:
+        args.append(builder.bitcast(source, bytep))
+        fn = lc.Function.intrinsic(module, intr, [bytep, bytep, count.type])
+    args += [builder.mul(count, lc.Constant.int(count.type, itemsize)),
+             lc.Constant.int(lc.Type.int(32), itemsize),
+             lc.Constant.int(lc.Type.int(1), 0)]
+    builder.call(fn, args)
+
+def _emit_fill(builder, array, value, count):
+    i8 = lc.Type.int(8)
+    bits = _sizeof(value.type) * 8
+    if bits == 8:
+        _emit_memory(builder, lc.INTR_MEMSET, array, value, count)
+        return
+
+    # memset if the bits of value are its low byte repeated
+    intty = lc.Type.int(bits)
+    raw = value
+    if not isinstance(value.type, lc.IntegerType):
+        raw = builder.bitcast(value, intty)
+    byte = builder.trunc(raw, i8)
+    repeated = builder.mul(builder.zext(byte, intty),
+                           lc.Constant.int(intty, int('01' * (bits // 8), 16)))
+
+    lfunc = builder.basic_block.function
+    bbset = lfunc.append_basic_block('memset')
+    bbloop = lfunc.append_basic_block('fill')
+    bbexit = lfunc.append_basic_block('fill_exit')
+    builder.cbranch(builder.icmp(lc.ICMP_EQ, repeated, raw), bbset, bbloop)
+
+    builder.position_at_end(bbset)
+    _emit_memory(builder, lc.INTR_MEMSET, array, byte, count)
+    builder.branch(bbexit)
+
+    builder.position_at_end(bbloop)
+    def store_body(builder, idx, values):
+        builder.store(value, builder.gep(array, [idx]))
+        return []
+    _reduction_loop(builder, lc.Constant.int(count.type, 0), count,
+                    lc.Constant.int(count.type, 1), [], store_body)
+    builder.branch(bbexit)
+
+    builder.position_at_end(bbexit)
+
+def memory_impl(name):
+    '''Implement a bulk memory intrinsic.  See _memory_signatures.
+    '''
+    def _memory_impl(lfunc):
+        builder = lc.Builder.new(lfunc.append_basic_block('entry'))
+        args = list(lfunc.args)
+        count = args.pop()
+        if name == 'array_copy':
+            source, dest = args
+            source.add_attribute(lc.ATTR_NO_ALIAS)
+            dest.add_attribute(lc.ATTR_NO_ALIAS)
+            _emit_memory(builder, lc.INTR_MEMCPY, dest, source, count)
+        elif name == 'array_move':
+            source, dest = args
+            _emit_memory(builder, lc.INTR_MEMMOVE, dest, source, count)
+        elif name == 'array_fill':
+            array, value = args
+            _emit_fill(builder, array, value, count)
+        else:
+            array, = args
+            _emit_memory(builder, lc.INTR_MEMSET, array,
+                         lc.Constant.null(lc.Type.int(8)), count)
         builder.ret_void()
-    return _array_arith_impl
+    return _memory_impl
@@ -0,0 +1,386 @@
+#
+# Math intrinsics for float, double and the floating-point vector types
+# (float4, float8, double2, double4).
+#
+# math_<f>(T x)             for <f> in sqrt, fabs, floor, ceil, exp, expm1,
+#                           log, sin, cos, tanh
+# math_pow(T x, T y)        x ** y
+# math_fma(T a, T b, T c)   a * b + c with a single rounding
+#
+# sqrt, fabs, floor, ceil and fma are lowered to the LLVM intrinsics of
+# the same name, which are single instructions on most targets.  The
+# others are inline polynomial approximations made of arithmetic, casts
+# and selects only, so that loops calling them are vectorized and make no
+# library call.  Their error is a few ulp, except that:
+#
+# - sin and cos reduce the argument by pi/2 in three parts, which is
+#   accurate for |x| < 2**20 (2**13 for float);
+# - pow is exp(y * log(x)), which loses about log2|y * log(x)| bits;
+# - errno is never set and NaN payloads are not preserved.
+#
+# Use this module as an extension for context and backend.
+#
+
+import math
+
+from mlvm.context import _builtin_real, _builtin_vector
+import llvm.core as lc
+
+NATIVE_FUNCTIONS = ['sqrt', 'fabs', 'floor', 'ceil']
+POLYNOMIAL_FUNCTIONS = ['exp', 'expm1', 'log', 'sin', 'cos', 'tanh']
+MATH_TYPES = _builtin_real + sorted(name for name, (elemtype, _)
+                                    in _builtin_vector.items()
+                                    if elemtype in _builtin_real)
+
+def _signatures(mathtype):
+    '''Yields (intrinsic name, operand types) of the intrinsics of a type.
+    The return type is the type of the operands.
+    '''
+    T = mathtype
+    for name in NATIVE_FUNCTIONS + POLYNOMIAL_FUNCTIONS:
+        yield 'math_%s' % name, (T,)
+    yield 'math_pow', (T, T)
+    yield 'math_fma', (T, T, T)
+
+def install_to_context(context):
+    for mathtype in MATH_TYPES:
+        for name, operands in _signatures(mathtype):
+            context.get_or_insert_intrinsic(name).add_definition(
+                                                    mathtype, list(operands))
+
+def install_to_backend(backend):
+    for mathtype in MATH_TYPES:
+        for name, operands in _signatures(mathtype):
+            backend.implement_intrinsic(name, mathtype, operands,
+                                        math_intrinsic_impl(name, mathtype))
+
+class _Format(object):
+    '''The types and constants of a float or double, or of a vector of
+    them.  Constants are splatted to the lanes of a vector.
+    '''
+    def __init__(self, ty):
+        if isinstance(ty, lc.VectorType):
+            self.lanes = ty.count
+            self.element = ty.element
+        else:
+            self.lanes = None
+            self.element = ty
+        self.type = ty
+        self.double = self.element == lc.Type.double()
+        self.bits = 64 if self.double else 32
+        self.mantissa = 52 if self.double else 23
+        self.bias = 1023 if self.double else 127
+        self.inttype = self._vector(lc.Type.int(self.bits))
+
+    def _vector(self, ty):
+        if self.lanes is None:
+            return ty
+        return lc.Type.vector(ty, self.lanes)
+
+    def _splat(self, value):
+        if self.lanes is None:
+            return value
+        return lc.Constant.vector([value] * self.lanes)
+
+    def real(self, value):
+        return self._splat(lc.Constant.real(self.element, value))
+
+    def int(self, value):
+        ty = lc.Type.int(self.bits)
+        if value < 0:
+            return self._splat(lc.Constant.int_signextend(ty, value))
+        return self._splat(lc.Constant.int(ty, value))
+
+    def pick(self, double, single):
+        return double if self.double else single
+
+def _intrinsic(builder, intr, value):
+    module = builder.basic_block.function.module
+    return lc.Function.intrinsic(module, intr, [value.type])
+
+def _fabs(builder, x):
+    return builder.call(_intrinsic(builder, lc.INTR_FABS, x), [x])
+
+def _select_lt(builder, a, b):
+    return builder.select(builder.fcmp(lc.FCMP_OLT, a, b), a, b)
+
+def _select_gt(builder, a, b):
+    return builder.select(builder.fcmp(lc.FCMP_OGT, a, b), a, b)
+
+def _nan_through(builder, x, result):
+    '''A NaN argument is the result.'''
+    return builder.select(builder.fcmp(lc.FCMP_UNO, x, x), x, result)
+
+def _negate(builder, fmt, x):
+    return builder.fsub(fmt.real(-0.0), x)
+
+def _copysign(builder, fmt, x, sign):
+    signbit = fmt.int(-(1 << (fmt.bits - 1)))
+    bits = builder.or_(builder.bitcast(_fabs(builder, x), fmt.inttype),
+                       builder.and_(builder.bitcast(sign, fmt.inttype),
+                                    signbit))
+    return builder.bitcast(bits, fmt.type)
+
+def _round_to_int(builder, fmt, x):
+    '''Round half away from zero to an integer of the width of x.'''
+    half = builder.select(builder.fcmp(lc.FCMP_OLT, x, fmt.real(0)),
+                          fmt.real(-0.5), fmt.real(0.5))
+    return builder.fptosi(builder.fadd(x, half), fmt.inttype)
+
+def _horner(builder, fmt, x, coeffs):
+    '''coeffs[0] + x * (coeffs[1] + x * (...))'''
+    result = fmt.real(coeffs[-1])
+    for coeff in reversed(coeffs[:-1]):
+        result = builder.fadd(builder.fmul(result, x), fmt.real(coeff))
+    return result
+
+def _pow2(builder, fmt, n):
+    '''2 ** n for an integer n of a normal exponent.'''
+    bits = builder.shl(builder.add(n, fmt.int(fmt.bias)),
+                       fmt.int(fmt.mantissa))
+    return builder.bitcast(bits, fmt.type)
+
+#
+# exp and expm1
+#
+# x = n * ln2 + r with |r| <= ln2 / 2, so that exp(x) = 2**n * exp(r).
+# exp(r) - 1 is its Taylor series.  2**n is applied as 2**h * 2**(n - h)
+# with h = n >> 1, one factor at a time: neither factor overflows at the
+# upper limit, and subnormal results are rounded instead of flushed.
+#
+
+_EXP_TERMS = {True: 13, False: 7}
+_EXP_LIMITS = {True: (-745.2, 709.782712893384),
+               False: (-104.0, 88.72283905206835)}
+_LN2_PARTS = {True: (6.93147180369123816490e-01, 1.90821492927058770002e-10),
+              False: (0.693359375, -2.12194440e-4)}
+
+def _exp_parts(builder, fmt, x):
+    '''Returns (h, n - h, exp(r) - 1) of an x within the limits.'''
+    ln2_hi, ln2_lo = _LN2_PARTS[fmt.double]
+    n = _round_to_int(builder, fmt, builder.fmul(x, fmt.real(1 / math.log(2))))
+    nf = builder.sitofp(n, fmt.type)
+    r = builder.fsub(builder.fsub(x, builder.fmul(nf, fmt.real(ln2_hi))),
+                     builder.fmul(nf, fmt.real(ln2_lo)))
+    coeffs = [1.0 / math.factorial(k)
+              for k in range(2, _EXP_TERMS[fmt.double] + 1)]
+    expm1r = builder.fadd(r, builder.fmul(builder.fmul(r, r),
+                                          _horner(builder, fmt, r, coeffs)))
+    half = builder.ashr(n, fmt.int(1))
+    return half, builder.sub(n, half), expm1r
+
+def _exp_limited(builder, fmt, x, expm1):
+    low, high = _EXP_LIMITS[fmt.double]
+    clamped = _select_lt(builder, _select_gt(builder, x, fmt.real(low)),
+                         fmt.real(high))
+    half, rest, expm1r = _exp_parts(builder, fmt, clamped)
+    first = _pow2(builder, fmt, half)
+    if expm1:
+        # (2**h * (exp(r) - 1) + (2**h - 2**-(n-h))) * 2**(n-h)
+        # is exact for n == 0
+        inverse = _pow2(builder, fmt, builder.sub(fmt.int(0), rest))
+        result = builder.fadd(builder.fmul(expm1r, first),
+                              builder.fsub(first, inverse))
+    else:
+        result = builder.fmul(builder.fadd(expm1r, fmt.real(1)), first)
+    result = builder.fmul(result, _pow2(builder, fmt, rest))
+    if not expm1:
+        result = builder.select(builder.fcmp(lc.FCMP_OLT, x, fmt.real(low)),
+                                fmt.real(0), result)
+    result = builder.select(builder.fcmp(lc.FCMP_OGT, x, fmt.real(high)),
+                            fmt.real(float('inf')), result)
+    return _nan_through(builder, x, result)
+
+def _exp(builder, fmt, x):
+    return _exp_limited(builder, fmt, x, False)
+
+def _expm1(builder, fmt, x):
+    return _exp_limited(builder, fmt, x, True)
+
+#
+# log
+#
+# x = 2**e * m with sqrt(1/2) <= m < sqrt(2).  With s = (m - 1) / (m + 1),
+# log(m) = 2 * atanh(s) = 2 * (s + s**3 / 3 + s**5 / 5 + ...).
+#
+
+_LOG_TERMS = {True: 11, False: 6}
+
+def _log(builder, fmt, x):
+    # scale subnormals to normals
+    tiny = builder.fcmp(lc.FCMP_OLT, x,
+                        fmt.real(fmt.pick(2.2250738585072014e-308,
+                                          1.1754943508222875e-38)))
+    shift = fmt.mantissa + 2
+    xn = builder.select(tiny, builder.fmul(x, fmt.real(2.0 ** shift)), x)
+
+    bits = builder.bitcast(xn, fmt.inttype)
+    e = builder.sub(builder.and_(builder.lshr(bits, fmt.int(fmt.mantissa)),
+                                 fmt.int(2 * fmt.bias + 1)),
+                    fmt.int(fmt.bias))
+    e = builder.select(tiny, builder.sub(e, fmt.int(shift)), e)
+    m = builder.or_(builder.and_(bits, fmt.int((1 << fmt.mantissa) - 1)),
+                    fmt.int(fmt.bias << fmt.mantissa))
+    m = builder.bitcast(m, fmt.type)    # in [1, 2)
+
+    big = builder.fcmp(lc.FCMP_OGT, m, fmt.real(math.sqrt(2)))
+    m = builder.select(big, builder.fmul(m, fmt.real(0.5)), m)
+    e = builder.select(big, builder.add(e, fmt.int(1)), e)
+
+    f = builder.fsub(m, fmt.real(1))
+    s = builder.fdiv(f, builder.fadd(f, fmt.real(2)))
+    z = builder.fmul(s, s)
+    coeffs = [1.0 / (2 * k + 1) for k in range(1, _LOG_TERMS[fmt.double])]
+    twos = builder.fadd(s, s)
+    logm = builder.fadd(twos, builder.fmul(builder.fmul(twos, z),
+                                           _horner(builder, fmt, z, coeffs)))
+
+    ln2_hi, ln2_lo = _LN2_PARTS[fmt.double]
+    ef = builder.sitofp(e, fmt.type)
+    result = builder.fadd(builder.fmul(ef, fmt.real(ln2_hi)),
+                          builder.fadd(logm,
+                                       builder.fmul(ef, fmt.real(ln2_lo))))
+
+    inf = fmt.real(float('inf'))
+    result = builder.select(builder.fcmp(lc.FCMP_OEQ, x, inf), inf, result)
+    result = builder.select(builder.fcmp(lc.FCMP_OEQ, x, fmt.real(0)),
+                            fmt.real(float('-inf')), result)
+    result = builder.select(builder.fcmp(lc.FCMP_OLT, x, fmt.real(0)),
+                            fmt.real(float('nan')), result)
+    return _nan_through(builder, x, result)
+
+#
+# sin and cos
+#
+# x = q * pi / 2 + r with |r| <= pi / 4.  pi / 2 is split in three parts
+# whose products with q are exact.  sin(r) and cos(r) are Taylor series;
+# the quadrant q selects and negates them.
+#
+
+_PIO2_PARTS = {True: (1.57079632673412561417e+00, 6.07710050630396597660e-11,
+                      2.02226624879595063154e-21),
+               False: (1.5703125, 4.837512969970703125e-4,
+                       7.54978995489188216e-8)}
+_SIN_TERMS = {True: 8, False: 5}
+_COS_TERMS = {True: 9, False: 6}
+
+def _sincos(builder, fmt, x, quadrant):
+    '''sin(x) for quadrant 0 and cos(x) for quadrant 1.'''
+    q = _round_to_int(builder, fmt, builder.fmul(x, fmt.real(2 / math.pi)))
+    qf = builder.sitofp(q, fmt.type)
+    r = x
+    for part in _PIO2_PARTS[fmt.double]:
+        r = builder.fsub(r, builder.fmul(qf, fmt.real(part)))
+    z = builder.fmul(r, r)
+
+    sincoeffs = [(-1.0) ** k / math.factorial(2 * k + 1)
+                 for k in range(1, _SIN_TERMS[fmt.double])]
+    sinr = builder.fadd(r, builder.fmul(builder.fmul(r, z),
+                                        _horner(builder, fmt, z, sincoeffs)))
+    coscoeffs = [(-1.0) ** k / math.factorial(2 * k)
+                 for k in range(1, _COS_TERMS[fmt.double])]
+    cosr = builder.fadd(fmt.real(1),
+                        builder.fmul(z, _horner(builder, fmt, z, coscoeffs)))
+
+    k = builder.add(q, fmt.int(quadrant))
+    zero = fmt.int(0)
+    odd = builder.icmp(lc.ICMP_NE, builder.and_(k, fmt.int(1)), zero)
+    result = builder.select(odd, cosr, sinr)
+    negative = builder.icmp(lc.ICMP_NE, builder.and_(k, fmt.int(2)), zero)
+    result = builder.select(negative, _negate(builder, fmt, result), result)
+
+    inf = builder.fcmp(lc.FCMP_OEQ, _fabs(builder, x),
+                       fmt.real(float('inf')))
+    result = builder.select(inf, fmt.real(float('nan')), result)
+    return _nan_through(builder, x, result)
+
+def _sin(builder, fmt, x):
+    return _sincos(builder, fmt, x, 0)
+
+def _cos(builder, fmt, x):
+    return _sincos(builder, fmt, x, 1)
+
+#
+# tanh(x) = sign(x) * t / (t + 2) with t = expm1(2 * |x|)
+#
+
+def _tanh(builder, fmt, x):
+    limit = fmt.real(fmt.pick(22.0, 9.0))    # tanh is 1 from here
+    ax = _select_lt(builder, _fabs(builder, x), limit)
+    t = _expm1(builder, fmt, builder.fadd(ax, ax))
+    result = builder.fdiv(t, builder.fadd(t, fmt.real(2)))
+    return _nan_through(builder, x, _copysign(builder, fmt, result, x))
+
+#
+# pow(x, y) = exp(y * log|x|), negated for x < 0 and an odd integer y.
+# It is NaN for x < 0 and a non-integer y, and 1 for x == 1 or y == 0.
+#
+
+def _pow(builder, fmt, x, y):
+    result = _exp(builder, fmt,
+                  builder.fmul(y, _log(builder, fmt, _fabs(builder, x))))
+
+    # every float of at least 2**mantissa is an even integer
+    exact = builder.fcmp(lc.FCMP_OLT, _fabs(builder, y),
+                         fmt.real(2.0 ** fmt.mantissa))
+    yi = builder.fptosi(builder.select(exact, y, fmt.real(0)), fmt.inttype)
+    integer = builder.or_(builder.not_(exact),
+                          builder.fcmp(lc.FCMP_OEQ,
+                                       builder.sitofp(yi, fmt.type), y))
+    odd = builder.icmp(lc.ICMP_NE, builder.and_(yi, fmt.int(1)), fmt.int(0))
+
+    negative = builder.fcmp(lc.FCMP_OLT, x, fmt.real(0))
+    result = builder.select(builder.and_(negative, odd),
+                            _negate(builder, fmt, result), result)
+    result = builder.select(builder.and_(negative, builder.not_(integer)),
+                            fmt.real(float('nan')), result)
+    one = fmt.real(1)
+    result = builder.select(builder.fcmp(lc.FCMP_OEQ, y, fmt.real(0)),
+                            one, result)
+    return builder.select(builder.fcmp(lc.FCMP_OEQ, x, one), one, result)
+
+_POLYNOMIALS = {'exp': _exp, 'expm1': _expm1, 'log': _log, 'sin': _sin,
+                'cos': _cos, 'tanh': _tanh, 'pow': _pow}
+
+def math_operator(name):
+    '''Returns a function (builder, *values) -> value of an intrinsic.
+    It works on scalars and vectors.
+    '''
+    op = name[len('math_'):]
+    if op in NATIVE_FUNCTIONS:
+        intr = getattr(lc, 'INTR_%s' % op.upper())
+        def _native(builder, value):
+            return builder.call(_intrinsic(builder, intr, value), [value])
+        return _native
+    if op == 'fma':
+        def _fma(builder, a, b, c):
+            intr = getattr(lc, 'INTR_FMA', None)
+            if intr is None:
+                return builder.fadd(builder.fmul(a, b), c)
+            return builder.call(_intrinsic(builder, intr, a), [a, b, c])
+        return _fma
+    polynomial = _POLYNOMIALS[op]
+    def _polynomial(builder, *values):
+        return polynomial(builder, _Format(values[0].type), *values)
+    return _polynomial
+
+def math_intrinsic_impl(name, mathtype):
+    '''Implement an intrinsic.  Vector arguments are passed as pointers
+    to their elements and loaded before use.
+    '''
+    operator = math_operator(name)
+    def _math_intrinsic_impl(lfunc):
+        builder = lc.Builder.new(lfunc.append_basic_block('entry'))
+        values = []
+        for arg in lfunc.args:
+            if mathtype in _builtin_vector:
+                lanes = _builtin_vector[mathtype][1]
+                elemty = arg.type.pointee
+                ptr = builder.bitcast(arg, lc.Type.pointer(
+                                                lc.Type.vector(elemty, lanes)))
+                align = 8 if elemty == lc.Type.double() else 4
+                values.append(builder.load(ptr, align=align))
+            else:
+                values.append(arg)
+        builder.ret(operator(builder, *values))
+    return _math_intrinsic_impl
@@ -0,0 +1,226 @@
+#
+# Intrinsics for the builtin SIMD vector types (float4, float8, double2,
+# double4, int32x4, int32x8, int64x2, int64x4).
+#
+# The types and their lane-wise add, sub, mul, div and rem are builtin.
+# This extension adds construction, loads and stores from the arrays of
+# mlvm.llvm.ext.arraytype, comparison, selection, shuffles and horizontal
+# reductions.  Install it after the array extension.
+#
+# A comparison returns a mask: an integer vector of the same lanes and
+# width (int32x4 for float4, int64x2 for double2) with all bits set in
+# the lanes where the comparison holds.
+#
+# <V>_splat(T x)                        every lane is x
+# <V>_load(array_T A, address i)        A[i:i+N]; unaligned
+# <V>_load_aligned(array_T A, address i)
+#                                       A[i:i+N]; aligned to the vector size
+# vector_store(V v, array_T A, address i)
+# vector_store_aligned(V v, array_T A, address i)
+# vector_extract(V v, address k)        lane k
+# vector_insert(V v, T x, address k)    v with lane k replaced by x
+# vector_shuffle(V v, M idx)            lane k is v[idx[k]]
+# vector_select(M m, V a, V b)          lane k is m[k] ? a[k] : b[k]
+# vector_<cmp>(V a, V b)                mask of a[k] <cmp> b[k]
+#                                       for <cmp> in lt, le, gt, ge, eq, ne
+# vector_min(V a, V b), vector_max(V a, V b)
+#                                       lane-wise minimum and maximum
+# vector_abs(V v), vector_fma(V a, V b, V c)
+#                                       |v| and a * b + c lane-wise
+# vector_sum(V v), vector_min(V v), vector_max(V v)
+#                                       horizontal reductions to T
+#
+# Use this module as an extension for context and backend.
+#
+
+from mlvm.context import _builtin_vector
+from mlvm.llvm.ext.arraytype import COMPARE_OPS, elementwise_operator
+import llvm.core as lc
+
+def mask_type(vectype):
+    '''Returns the integer vector type of the masks of a vector type.
+    '''
+    elemtype, lanes = _builtin_vector[vectype]
+    if elemtype == 'float':
+        elemtype = 'int32'
+    elif elemtype == 'double':
+        elemtype = 'int64'
+    return '%sx%d' % (elemtype, lanes)
+
+def _signatures(vectype):
+    '''Yields (intrinsic name, return type, operand types) of the
+    intrinsics of a vector type.
+    '''
+    T, lanes = _builtin_vector[vectype]
+    V = vectype
+    M = mask_type(vectype)
+    A = 'array_%s' % T
+    yield '%s_splat' % V, V, (T,)
+    yield '%s_load' % V, V, (A, 'address')
+    yield '%s_load_aligned' % V, V, (A, 'address')
+    yield 'vector_store', 'void', (V, A, 'address')
+    yield 'vector_store_aligned', 'void', (V, A, 'address')
+    yield 'vector_extract', T, (V, 'address')
+    yield 'vector_insert', V, (V, T, 'address')
+    yield 'vector_shuffle', V, (V, M)
+    yield 'vector_select', V, (M, V, V)
+    for op in COMPARE_OPS:
+        yield 'vector_%s' % op, M, (V, V)
+    yield 'vector_min', V, (V, V)
+    yield 'vector_max', V, (V, V)
+    yield 'vector_abs', V, (V,)
+    yield 'vector_fma', V, (V, V, V)
+    yield 'vector_sum', T, (V,)
+    yield 'vector_min', T, (V,)
+    yield 'vector_max', T, (V,)
+
+def install_to_context(context):
+    types = context.type_system.types
+    for vectype in sorted(_builtin_vector):
+        elemtype = _builtin_vector[vectype][0]
+        if 'array_%s' % elemtype not in types:
+            raise TypeError("Install mlvm.llvm.ext.arraytype before the "
+                            "vector extension")
+        for name, retty, operands in _signatures(vectype):
+            context.get_or_insert_intrinsic(name).add_definition(
+                                                        retty, list(operands))
+
+def install_to_backend(backend):
+    for vectype in sorted(_builtin_vector):
+        for name, retty, operands in _signatures(vectype):
+            impl = vector_intrinsic_impl(name, vectype, retty, operands)
+            backend.implement_intrinsic(name, retty, operands, impl)
+
+def _element_type(elemtype):
+    if elemtype == 'float':
+        return lc.Type.float()
+    elif elemtype == 'double':
+        return lc.Type.double()
+    return lc.Type.int(int(elemtype[len('int'):]))
+
+def _sizeof(ty):
+    if isinstance(ty, lc.IntegerType):
+        return ty.width // 8
+    elif ty == lc.Type.float():
+        return 4
+    return 8
+
+def _index(builder, idx):
+    '''Lane indices of extractelement and insertelement are i32.
+    '''
+    i32 = lc.Type.int(32)
+    if idx.type.width > 32:
+        return builder.trunc(idx, i32)
+    elif idx.type.width < 32:
+        return builder.zext(idx, i32)
+    return idx
+
+def _reduce(builder, combine, vector, lanes):
+    i32 = lc.Type.int(32)
+    values = [builder.extract_element(vector, lc.Constant.int(i32, k))
+              for k in range(lanes)]
+    while len(values) > 1:
+        values = [combine(builder, values[i], values[i + 1])
+                  for i in range(0, len(values), 2)]
+    return values[0]
+
+def vector_operator(name, vectype, retty, operands):
+    '''Returns a function (builder, *values) -> value of an intrinsic.
+    Vector operands are given as vector values.
+    '''
+    elemtype, lanes = _builtin_vector[vectype]
+    elemty = _element_type(elemtype)
+    vecty = lc.Type.vector(elemty, lanes)
+    itemsize = _sizeof(elemty)
+    op = name.split('_', 1)[1]
+    horizontal = retty == elemtype and len(operands) == 1
+
+    if op == 'splat':
+        def _splat(builder, value):
+            vector = lc.Constant.undef(vecty)
+            for k in range(lanes):
+                vector = builder.insert_element(vector, value,
+                                        lc.Constant.int(lc.Type.int(32), k))
+            return vector
+        return _splat
+    if op in ('load', 'load_aligned'):
+        align = itemsize if op == 'load' else itemsize * lanes
+        def _load(builder, array, idx):
+            ptr = builder.bitcast(builder.gep(array, [idx]),
+                                  lc.Type.pointer(vecty))
+            return builder.load(ptr, align=align)
+        return _load
+    if op in ('store', 'store_aligned'):
+        align = itemsize if op == 'store' else itemsize * lanes
+        def _store(builder, vector, array, idx):
+            ptr = builder.bitcast(builder.gep(array, [idx]),
+                                  lc.Type.pointer(vecty))
+            builder.store(vector, ptr, align=align)
+        return _store
+    if op == 'extract':
+        def _extract(builder, vector, idx):
+            return builder.extract_element(vector, _index(builder, idx))
+        return _extract
+    if op == 'insert':
+        def _insert(builder, vector, value, idx):
+            return builder.insert_element(vector, value,
+                                          _index(builder, idx))
+        return _insert
+    if op == 'shuffle':
+        # constant indices are folded into a shufflevector
+        def _shuffle(builder, vector, indices):
+            i32 = lc.Type.int(32)
+            result = lc.Constant.undef(vecty)
+            for k in range(lanes):
+                lane = lc.Constant.int(i32, k)
+                src = _index(builder, builder.extract_element(indices, lane))
+                value = builder.extract_element(vector, src)
+                result = builder.insert_element(result, value, lane)
+            return result
+        return _shuffle
+    if op == 'select':
+        def _select(builder, mask, lhs, rhs):
+            cond = builder.icmp(lc.ICMP_NE, mask, lc.Constant.null(mask.type))
+            return builder.select(cond, lhs, rhs)
+        return _select
+    if op in COMPARE_OPS:
+        compare = elementwise_operator('array_%s' % op, elemtype)
+        masklanes = lc.Type.vector(lc.Type.int(itemsize * 8), lanes)
+        def _compare(builder, lhs, rhs):
+            return builder.sext(compare(builder, lhs, rhs), masklanes)
+        return _compare
+    if op == 'sum':
+        combine = elementwise_operator('array_add', elemtype)
+        return lambda builder, vector: _reduce(builder, combine, vector,
+                                               lanes)
+    if op in ('min', 'max') and horizontal:
+        combine = elementwise_operator('array_%s' % op, elemtype)
+        return lambda builder, vector: _reduce(builder, combine, vector,
+                                               lanes)
+    if op in ('min', 'max', 'abs', 'fma'):
+        return elementwise_operator('array_%s' % op, elemtype)
+    raise NameError(name)
+
+def vector_intrinsic_impl(name, vectype, retty, operands):
+    '''Implement an intrinsic.  Vector arguments are passed as pointers
+    to their elements and loaded before use.
+    '''
+    operator = vector_operator(name, vectype, retty, operands)
+    def _vector_intrinsic_impl(lfunc):
+        builder = lc.Builder.new(lfunc.append_basic_block('entry'))
+        values = []
+        for ty, arg in zip(operands, lfunc.args):
+            if ty in _builtin_vector:
+                lanes = _builtin_vector[ty][1]
+                elemty = arg.type.pointee
+                ptr = builder.bitcast(arg, lc.Type.pointer(
+                                                lc.Type.vector(elemty, lanes)))
+                values.append(builder.load(ptr, align=_sizeof(elemty)))
+            else:
+                values.append(arg)
+        result = operator(builder, *values)
+        if retty == 'void':
+            builder.ret_void()
+        else:
+            builder.ret(result)
+    return _vector_intrinsic_impl
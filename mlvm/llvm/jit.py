@@ -1,31 +1,88 @@
 __all__ = ['LLVMExecutionManager']
 
 from mlvm.jit import *
+from mlvm.backend import TypeImplementation, argument_attributes
+from mlvm.llvm.trampoline import build_trampoline, make_builtin
+from mlvm.llvm.batch import build_batch_loop, BatchLoop
+from mlvm.llvm import threadpool
 
-from ctypes import CFUNCTYPE, PYFUNCTYPE
+import threading
+import weakref
+from collections import OrderedDict
+from ctypes import CFUNCTYPE, PYFUNCTYPE, c_void_p, addressof
 from llvm.ee import EngineBuilder
-from llvm.core import Module
+from llvm.core import Module, Type, Builder
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import BytesIO as StringIO
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 class LLVMExecutionManager(ExecutionManagerInterface):
+    '''Each built function and each auxiliary entry point is a segment: a
+    module with its own execution engine.  Calls between segments are
+    resolved with global mappings.
+
+    The segments form a code cache.  When it exceeds `max_bytes` of bitcode
+    or `max_segments`, the least recently used segments that are
+    unreferenced are evicted, freeing their IR and machine code.  A segment
+    is referenced while the wrapper or ctype function of its function, or
+    the object made for its entry point, such as the builtin function of a
+    trampoline, is alive; or while a segment that calls it is cached.
+    Entry points cached as plain addresses, such as dispatch stubs and
+    ufunc loops, cannot be weakly referenced and are never evicted.  The
+    JIT builds the evicted callees of a function again before the function.
+
+    For a backend with indirect calls, the address of each function is
+    stored in a slot that callers load, and Python calls go through a
+    native dispatch stub that loads the slot too.  replace_function swaps
+    in a new version of a function for all callers.  Functions installed in
+    a slot are not evicted.  Replaced versions are retired and freed by
+    release_retired.
+    '''
     OPT_NONE = 0
     OPT_LESS = 1
     OPT_NORMAL = 2
     OPT_AGRESSIVE = 3
     OPT_MAXIMUM = OPT_AGRESSIVE
 
-    def __init__(self, opt=OPT_NORMAL):
+    def __init__(self, opt=OPT_NORMAL, max_bytes=None, max_segments=None):
+        '''
+        max_bytes    --- (optional) bound of the total bitcode size of the
+                         cached segments.  Defaults to unbounded.
+        max_segments --- (optional) bound of the number of cached segments.
+                         Defaults to unbounded.
+        '''
         self.__opt = opt
-        self.__fatmod = Module.new('mlvm.jit.%X' % id(self))
-        self.__engine = EngineBuilder.new(self.__fatmod).opt(opt).create()
-        self.__symlib = {} # stores (name, argtys) -> (wrapper, callable)
+        self.__max_bytes = max_bytes
+        self.__max_segments = max_segments
+        self.__symlib = {} # stores (name, argtys) -> segment
+        self.__entries = {} # stores key -> segment of an entry point
+        self.__symbols = {} # stores function name -> defining segment
+        self.__lru = OrderedDict() # segments; most recently used last
+        self.__slots = {} # stores slot name -> c_void_p
+        self.__retired = [] # replaced segments
+        self.__nbytes = 0
+        # guards the segments and the tables above
+        self.__lock = threading.RLock()
 
     @property
     def opt(self):
-        return self.opt
+        return self.__opt
+
+    @property
+    def nbytes(self):
+        '''Total bitcode size of the cached segments.
+        '''
+        return self.__nbytes
+
+    @property
+    def segment_count(self):
+        return len(self.__lru)
 
     def has_function(self, funcdef):
         k = (funcdef.name, tuple(funcdef.args))
@@ -33,7 +90,10 @@ class LLVMExecutionManager(ExecutionManagerInterface):
 
     def get_function(self, funcdef):
         k = (funcdef.name, tuple(funcdef.args))
-        return self.__symlib[k]
+        with self.__lock:
+            segment = self.__symlib[k]
+            self._touch(segment)
+            return segment.get_function()
 
     def build_function(self, backend, funcdef, lfunc, attrs, gil):
         '''Returns a wrapper and a ctype CFUNCTYPE.
@@ -41,29 +101,330 @@ class LLVMExecutionManager(ExecutionManagerInterface):
             lfunc --- Ownership of lfunc is obtained.
             Callee should no longer use this object.
             '''
-        retty = funcdef.return_type
-        argtys = funcdef.args
-        # link function's module to fat module
-        self.__fatmod.link_in(lfunc.module)
-        # lfunc's module is invalidated
-
-        # get function by name
-        func = self.__fatmod.get_function_named(lfunc.name)
-        # build wrapper
-        wrapper, callable = build_wrapper(self.__engine,
-                                          backend,
-                                          funcdef.return_type,
-                                          funcdef.args,
-                                          func,
-                                          gil)
-
-        # remember JIT'ed functions
-        self.__symlib[(funcdef.name, tuple(argtys))] = wrapper, callable
+        k = (funcdef.name, tuple(funcdef.args))
+        with self.__lock:
+            if k in self.__symlib:
+                # built by another thread
+                return self.get_function(funcdef)
+            segment = self._add_function_segment(backend, funcdef, lfunc,
+                                                 gil)
+            result = segment.get_function()
+            self.evict()
+            return result
+
+    def replace_function(self, backend, funcdef, lfunc, attrs, gil):
+        '''Build a new version of a function and swap it in for all callers,
+        including existing wrappers.  The backend must use indirect calls.
+
+        Returns a wrapper and a ctype CFUNCTYPE.
+        '''
+        if not getattr(backend, 'indirect', False):
+            raise ValueError("Functions can only be replaced with a backend "
+                             "that uses indirect calls")
+        k = (funcdef.name, tuple(funcdef.args))
+        with self.__lock:
+            old = self.__symlib.get(k)
+            segment = self._add_function_segment(backend, funcdef, lfunc,
+                                                 gil)
+            if old is not None:
+                # threads may still run the old version
+                self.__retired.append(old)
+            result = segment.get_function()
+            self.evict()
+            return result
+
+    def release_retired(self):
+        '''Free the replaced versions of functions that are not called
+        by cached segments.  The caller must guarantee that no thread is
+        running them.
+
+        Returns the number of freed segments.
+        '''
+        count = 0
+        with self.__lock:
+            for segment in list(self.__retired):
+                if segment.dependents == 0:
+                    self.__retired.remove(segment)
+                    self._remove_segment(segment)
+                    count += 1
+        return count
+
+    def _add_function_segment(self, backend, funcdef, lfunc, gil):
+        k = (funcdef.name, tuple(funcdef.args))
+        segment = self._add_segment(lfunc.module, lfunc.name, {})
+        # lfunc's module is owned by the segment
+        address = segment.address
+        if getattr(backend, 'indirect', False):
+            slot = self._get_slot(backend.slot_name(lfunc.name))
+            slot.value = address
+            segment.held = True
+            key = ('dispatch', funcdef.name, tuple(funcdef.args))
+            build = lambda: build_dispatch(backend, funcdef)
+            address = self.get_entry(key, build)
+        segment.set_function(k, backend, funcdef.return_type, funcdef.args,
+                             gil, address, argument_attributes(funcdef))
+        self.__symlib[k] = segment
+        return segment
+
+    def _get_slot(self, name):
+        try:
+            return self.__slots[name]
+        except KeyError:
+            slot = self.__slots[name] = c_void_p(0)
+            return slot
+
+    def get_entry(self, key, build, make=None):
+        '''Returns an auxiliary entry point of JIT'ed functions;
+        e.g. a trampoline.  It is built on the first request and cached.
+
+        key   --- a hashable key of the entry point.
+        build --- a callable that returns (module, name, externals).
+                  `name` is the name of the entry function in the module.
+                  `externals` maps the names of external functions to
+                  their addresses.  Ownership of the module is obtained.
+        make  --- (optional) a callable that makes the cached object from
+                  the address of the entry function.  Defaults to
+                  caching the address.
+        '''
+        with self.__lock:
+            segment = self.__entries.get(key)
+            if segment is None:
+                module, name, externals = build()
+                segment = self._add_segment(module, name, externals)
+                segment.set_entry(key, make)
+                self.__entries[key] = segment
+                entry = segment.get_entry()
+                self.evict()
+                return entry
+            self._touch(segment)
+            return segment.get_entry()
+
+    def get_trampoline(self, backend, funcdef, gil=True):
+        '''Returns a builtin function object that calls a JIT'ed function
+        through a native trampoline.
+        '''
+        key = ('trampoline', funcdef.name, tuple(funcdef.args), gil)
+        build = lambda: build_trampoline(backend, funcdef, gil)
+        make = lambda address: make_builtin(address, funcdef.name,
+                                            str(funcdef))
+        return self.get_entry(key, build, make)
+
+    def get_batch(self, backend, funcdef):
+        '''Returns a BatchLoop that calls a JIT'ed function over arrays
+        in a native loop.
+        '''
+        key = ('batch', funcdef.name, tuple(funcdef.args))
+        build = lambda: build_batch_loop(backend, funcdef)
+        def make(address):
+            get_ctype = lambda x: backend.get_type_implementation(x).ctype(
+                                                                    backend)
+            return BatchLoop(address,
+                             [get_ctype(x) for x in funcdef.args],
+                             get_ctype(funcdef.return_type))
+        return self.get_entry(key, build, make)
+
+    def evict(self):
+        '''Evict the least recently used unreferenced segments until the
+        cache is within its bounds.
+
+        Returns the number of evicted segments.
+        '''
+        count = 0
+        with self.__lock:
+            while self._over_bound():
+                for segment in self.__lru.values():
+                    if segment.evictable:
+                        break
+                else:
+                    break
+                self._remove_segment(segment)
+                count += 1
+        return count
+
+    def _over_bound(self):
+        return ((self.__max_bytes is not None and
+                 self.__nbytes > self.__max_bytes) or
+                (self.__max_segments is not None and
+                 len(self.__lru) > self.__max_segments))
+
+    def _touch(self, segment):
+        del self.__lru[id(segment)]
+        self.__lru[id(segment)] = segment
+
+    def _add_segment(self, module, name, externals):
+        externals = dict(externals)
+        for gv in module.global_variables:
+            if gv.is_declaration and gv.name.endswith('.slot'):
+                externals[gv.name] = addressof(self._get_slot(gv.name))
+        for func in module.functions:
+            if func.is_declaration and func.name in threadpool.SYMBOLS:
+                externals[func.name] = threadpool.get_address(func.name)
+        segment = _Segment(module, name, self.__opt, self.__symbols,
+                           externals)
+        self.__symbols[name] = segment
+        self.__lru[id(segment)] = segment
+        self.__nbytes += segment.nbytes
+        return segment
+
+    def _remove_segment(self, segment):
+        logger.debug("evict %s (%d bytes)", segment.name, segment.nbytes)
+        del self.__lru[id(segment)]
+        if self.__symbols.get(segment.name) is segment:
+            del self.__symbols[segment.name]
+        table = self.__symlib if segment.is_function else self.__entries
+        if table.get(segment.key) is segment:
+            del table[segment.key]
+        self.__nbytes -= segment.nbytes
+        segment.release()
+
+class _Segment(object):
+    '''A module with its own execution engine that defines one
+    function or entry point.
+    '''
+    def __init__(self, module, name, opt, symbols, externals):
+        '''
+        symbols   --- maps names of functions to the defining segments.
+        externals --- maps names of external functions to their addresses.
+        '''
+        self.name = name
+        self.nbytes = _bitcode_size(module)
+        self.module = module
+        self.engine = EngineBuilder.new(module).opt(opt).create()
+        # module is owned by the engine
+        self.dependencies = []
+        self.dependents = 0
+        self.key = None
+        self.is_function = False
+        self.held = False # not evictable if set
+        self.__ref = None
+        self.__pinned = None
+
+        for func in module.functions:
+            if not func.is_declaration:
+                continue
+            if func.name in externals:
+                address = externals[func.name]
+            elif func.name in symbols:
+                callee = symbols[func.name]
+                address = callee.address
+                callee.dependents += 1
+                self.dependencies.append(callee)
+            else:
+                continue # resolved by the engine
+            self.engine.add_global_mapping(func, address)
+
+        for gv in module.global_variables:
+            if gv.is_declaration and gv.name in externals:
+                self.engine.add_global_mapping(gv, externals[gv.name])
+
+        func = module.get_function_named(name)
+        self.address = self.engine.get_pointer_to_function(func)
+
+    @property
+    def evictable(self):
+        return (self.__pinned is None and not self.held and
+                self.dependents == 0 and
+                (self.__ref is None or self.__ref() is None))
+
+    def set_function(self, key, backend, return_type, args, gil,
+                     address=None, attrs=None):
+        '''
+        address --- (optional) the address called by the wrappers.
+                    Defaults to the address of the function.
+        attrs   --- (optional) the attribute set of each argument.
+        '''
+        self.key = key
+        self.is_function = True
+        self.__call_address = address or self.address
+        self.__signature = backend, return_type, args, gil, attrs
+        self.__wrapper = None
+
+    def get_function(self):
+        '''Returns (wrapper, callable).  They are made again if they are
+        no longer referenced.
+        '''
+        callable = self.__ref() if self.__ref is not None else None
+        wrapper = self.__wrapper() if self.__wrapper is not None else None
+        if callable is None:
+            wrapper, callable = wrap_address(self.__call_address,
+                                             *self.__signature)
+        elif wrapper is None:
+            backend, return_type, args, gil, attrs = self.__signature
+            get_ty_impl = backend.get_type_implementation
+            wrapper = generate_wrapper(backend, get_ty_impl(return_type),
+                                       [get_ty_impl(x) for x in args],
+                                       callable, attrs)
+        self.__ref = weakref.ref(callable)
+        self.__wrapper = weakref.ref(wrapper)
         return wrapper, callable
 
+    def set_entry(self, key, make):
+        self.key = key
+        self.__make = make
+
+    def get_entry(self):
+        '''Returns the object made from the address of the entry point.
+        Objects that cannot be weakly referenced pin the segment.
+        '''
+        if self.__pinned is not None:
+            return self.__pinned
+        entry = self.__ref() if self.__ref is not None else None
+        if entry is None:
+            entry = (self.__make(self.address) if self.__make is not None
+                     else self.address)
+            try:
+                self.__ref = weakref.ref(entry)
+            except TypeError:
+                self.__pinned = entry
+        return entry
+
+    def release(self):
+        for callee in self.dependencies:
+            callee.dependents -= 1
+        self.dependencies = []
+        self.engine = self.module = None
+
+def build_dispatch(backend, funcdef):
+    '''Build a stub with the signature of a function that calls it
+    through its slot.  The backend must use indirect calls.
+
+    Returns (module, name, externals).
+    '''
+    get_ty_impl = backend.get_type_implementation
+    lretty = get_ty_impl(funcdef.return_type).return_type(backend)
+    largtys = [get_ty_impl(x).argument(backend) for x in funcdef.args]
+
+    mangled = backend.mangle_function(funcdef.name, funcdef.args)
+    module = Module.new('mlvm.dispatch.%s' % mangled)
+    name = '%s.dispatch' % mangled
+    lfunc = module.add_function(Type.function(lretty, largtys), name)
+    builder = Builder.new(lfunc.append_basic_block('entry'))
+    call = backend._build_definition_call(funcdef)
+    result = call(builder, *lfunc.args)
+    if funcdef.return_type == 'void':
+        builder.ret_void()
+    else:
+        builder.ret(result)
+    lfunc.verify()
+    return module, name, {}
+
+def _bitcode_size(module):
+    sio = StringIO()
+    module.to_bitcode(sio)
+    return len(sio.getvalue())
+
 def build_wrapper(engine, backend, return_type, args, callee, gil=True):
     # get address of funciton; forces JIT
     address = engine.get_pointer_to_function(callee)
+    return wrap_address(address, backend, return_type, args, gil)
+
+def wrap_address(address, backend, return_type, args, gil=True,
+                 attrs=None):
+    '''Returns a wrapper and a ctype function for the address of a JIT'ed
+    function.
+
+    attrs --- (optional) the attribute set of each argument.
+    '''
     # get ctypes of retty and argtys
     get_ty_impl = backend.get_type_implementation
 
@@ -71,7 +432,7 @@ def build_wrapper(engine, backend, return_type, args, callee, gil=True):
     argtyimpls = [get_ty_impl(x) for x in args]
     
     cretty = rettyimpl.ctype(backend)
-    cargtys = [x.ctype(backend) for x in argtyimpls]
+    cargtys = [x.ctype_parameter(backend) for x in argtyimpls]
 
     if gil:
         ffi = PYFUNCTYPE
@@ -80,21 +441,84 @@ def build_wrapper(engine, backend, return_type, args, callee, gil=True):
 
     callable = ffi(cretty, *cargtys)(address)
 
-    def _wrapper(*args):
-        actual_args = []
-        if len(argtyimpls) != len(args):
-            raise TypeError("Function takes exactly %d arguments; but got %d" %\
-                            (len(argtyimpls), len(args)))
-        for i, (ty, arg) in enumerate(zip(argtyimpls, args)):
-            try:
-                prepared = ty.ctype_argument(backend, arg)
-            except:
-                logger.debug("Error at argument %d: %s %s", i, ty, arg)
-                raise
-            actual_args.append(prepared)
-        retval = callable(*actual_args)
-        return rettyimpl.ctype_return(backend, retval)
+    wrapper = generate_wrapper(backend, rettyimpl, argtyimpls, callable,
+                               attrs)
+    return wrapper, callable
+
+def generate_wrapper(backend, rettyimpl, argtyimpls, callable, attrs=None):
+    '''Generate a wrapper specialized for a signature.  attrs is the
+    attribute set of each argument, passed to the conversions.
 
+    The argument conversions are unrolled into the source of the wrapper.
+    Conversions that are inherited unchanged from TypeImplementation are
+    identities and are omitted.
 
-    return _wrapper, callable
+    The returned wrapper checks the argument count and logs the index of
+    the argument that fails to convert.  An unchecked variant without these
+    checks is available as the `unchecked` attribute of the wrapper.  If no
+    conversion is necessary, the unchecked variant is the ctype callable.
+    '''
+    argct = len(argtyimpls)
+    namespace = {
+        'backend'  : backend,
+        'callable' : callable,
+        'argct'    : argct,
+        'logger'   : logger,
+    }
+    params = ['a%d' % i for i in range(argct)]
+    if attrs is None:
+        attrs = [frozenset()] * argct
+    converts = []
+    for i, ty in enumerate(argtyimpls):
+        if not _is_identity(ty, 'ctype_argument'):
+            namespace['ty%d' % i] = ty
+            namespace['conv%d' % i] = ty.ctype_argument
+            namespace['attrs%d' % i] = frozenset(attrs[i])
+            converts.append(i)
+
+    callexpr = 'callable(%s)' % ', '.join(params)
+    if not _is_identity(rettyimpl, 'ctype_return'):
+        namespace['ret'] = rettyimpl.ctype_return
+        callexpr = 'ret(backend, %s)' % callexpr
+
+    checked = ['def _wrapper(*args):',
+               '    if len(args) != argct:',
+               '        raise TypeError("Function takes exactly %d arguments; '
+               'but got %d" % (argct, len(args)))']
+    if params:
+        checked.append('    %s, = args' % ', '.join(params))
+    for i in converts:
+        checked += ['    try:',
+                    '        a%d = conv%d(backend, a%d, attrs%d)' %
+                    (i, i, i, i),
+                    '    except:',
+                    '        logger.debug("Error at argument %%d: %%s %%s", '
+                    '%d, ty%d, a%d)' % (i, i, i),
+                    '        raise']
+    checked.append('    return %s' % callexpr)
+
+    unchecked = ['def _unchecked(%s):' % ', '.join(params)]
+    for i in converts:
+        unchecked.append('    a%d = conv%d(backend, a%d, attrs%d)' %
+                         (i, i, i, i))
+    unchecked.append('    return %s' % callexpr)
+
+    source = '\n'.join(checked + unchecked) + '\n'
+    logger.debug("generated wrapper:\n%s", source)
+    exec(compile(source, '<mlvm wrapper>', 'exec'), namespace)
+
+    wrapper = namespace['_wrapper']
+    if not converts and 'ret' not in namespace:
+        wrapper.unchecked = callable
+    else:
+        wrapper.unchecked = namespace['_unchecked']
+    return wrapper
 
+def _is_identity(tyimpl, method):
+    '''Test if a conversion method of a type implementation is the
+    default one of TypeImplementation, which returns the value unchanged.
+    '''
+    impl = getattr(type(tyimpl), method)
+    default = getattr(TypeImplementation, method)
+    return getattr(impl, '__func__', impl) is getattr(default, '__func__',
+                                                      default)
@@ -0,0 +1,367 @@
+#
+# Multi-process execution of JIT'ed array kernels.
+#
+# A kernel and its callees are linked into one module whose LLVM bitcode
+# is written to a file once; worker processes load it by name the first
+# time they see the key of the kernel and JIT it locally.  Arrays live in
+# shared memory mapped from files so that the workers read and write them
+# in place; a worker receives the name of the file and an offset instead
+# of the data.
+#
+# Unlike the thread pool of mlvm.parallel, kernels need not release the GIL.
+# The parallel loops of a kernel (mlvm.irutil.parallel_range) run serially
+# in a worker; the processes already use the CPUs.
+#
+
+import os
+import mmap
+import ctypes
+import hashlib
+import tempfile
+import pickle
+import threading
+import weakref
+from collections import OrderedDict
+from ctypes import CFUNCTYPE, c_void_p, sizeof
+from multiprocessing import Pool, cpu_count
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import BytesIO as StringIO
+
+import llvm.core as lc
+from llvm.ee import EngineBuilder
+
+from mlvm.parallel import (DEFAULT_GRAIN, split_range, is_pointer_ctype,
+                           find_count_argument, address_of)
+from mlvm.backend import argument_attributes
+from mlvm.utils import ctype_typestr
+from mlvm.llvm import threadpool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if os.path.isdir('/dev/shm'):
+    _SHARED_DIR = '/dev/shm'
+else:
+    _SHARED_DIR = None  # default temporary directory
+
+#
+# Shared memory
+#
+
+_shared_buffers = weakref.WeakValueDictionary() # name -> SharedBuffer
+_shared_lock = threading.Lock()
+
+class SharedBuffer(object):
+    '''A block of memory mapped from a file.  Other processes map the
+    same memory by the name of the file.
+
+    The file is removed when the buffer is garbage collected.
+    '''
+    def __init__(self, nbytes):
+        size = max(nbytes, 1)
+        self.__file = tempfile.NamedTemporaryFile(prefix='mlvm-',
+                                                  dir=_SHARED_DIR)
+        self.__file.truncate(size)
+        self.__map = mmap.mmap(self.__file.fileno(), size)
+        self.__raw = (ctypes.c_char * size).from_buffer(self.__map)
+        self.__nbytes = nbytes
+        with _shared_lock:
+            _shared_buffers[self.name] = self
+
+    @property
+    def name(self):
+        return self.__file.name
+
+    @property
+    def nbytes(self):
+        return self.__nbytes
+
+    @property
+    def address(self):
+        return ctypes.addressof(self.__raw)
+
+    def as_array(self, cty, count):
+        '''Returns a ctypes array of `count` elements of `cty` that owns
+        this buffer.
+        '''
+        assert sizeof(cty) * count <= self.__nbytes
+        array = (cty * count).from_buffer(self.__map)
+        array.shared_buffer = self # keep alive
+        return array
+
+def shared_empty(count, cty):
+    '''Allocate an uninitialized array of `count` elements of `cty` in
+    shared memory.
+
+    Returns a NumPy array, or a ctypes array if NumPy is not available.
+    '''
+    array = SharedBuffer(sizeof(cty) * count).as_array(cty, count)
+    if numpy is not None:
+        return numpy.frombuffer(array, dtype=ctype_typestr(cty))
+    return array
+
+def find_shared(address, nbytes):
+    '''Returns (name, offset) of the shared buffer that contains the
+    memory range or None.
+    '''
+    with _shared_lock:
+        buffers = list(_shared_buffers.values())
+    for buf in buffers:
+        offset = address - buf.address
+        if 0 <= offset and offset + nbytes <= buf.nbytes:
+            return buf.name, offset
+
+#
+# Kernel description
+#
+
+_SIMPLE_CTYPES = dict((cty._type_, cty) for cty in [
+    ctypes.c_byte, ctypes.c_ubyte, ctypes.c_short, ctypes.c_ushort,
+    ctypes.c_int, ctypes.c_uint, ctypes.c_long, ctypes.c_ulong,
+    ctypes.c_longlong, ctypes.c_ulonglong, ctypes.c_float, ctypes.c_double,
+    ctypes.c_bool])
+
+def _encode_ctype(cty):
+    if cty is None:
+        return None
+    if is_pointer_ctype(cty) or cty is c_void_p:
+        return 'P'
+    code = getattr(cty, '_type_', None)
+    if code in _SIMPLE_CTYPES and sizeof(_SIMPLE_CTYPES[code]) == sizeof(cty):
+        return code
+    raise TypeError("Cannot pass %s to a worker process" % cty)
+
+def _decode_ctype(code):
+    if code is None:
+        return None
+    if code == 'P':
+        return c_void_p
+    return _SIMPLE_CTYPES[code]
+
+def _to_bitcode(module):
+    sio = StringIO()
+    module.to_bitcode(sio)
+    return sio.getvalue()
+
+def _implemented_callees(funcdef):
+    '''List the implemented function-definitions that funcdef calls,
+    directly or indirectly.
+    '''
+    found = []
+    pending = [funcdef]
+    while pending:
+        defn = pending.pop()
+        for bb in defn.implementation.basic_blocks:
+            for op in bb.operations:
+                if not op.name.startswith('call.func'):
+                    continue
+                callee = op.callee
+                if callee.is_declaration or callee is funcdef:
+                    continue
+                if any(callee is x for x in found):
+                    continue
+                found.append(callee)
+                pending.append(callee)
+    return found
+
+def _resolve_slots(module):
+    '''Initialize the function slots of an indirect backend with the
+    functions of the module; a worker has no JIT to fill them.
+    '''
+    functions = dict((func.name, func) for func in module.functions
+                     if not func.is_declaration)
+    for gv in module.global_variables:
+        if not (gv.is_declaration and gv.name.endswith('.slot')):
+            continue
+        func = functions.get(gv.name[:-len('.slot')])
+        if func is None:
+            raise TypeError("Cannot resolve %s in a worker process" % gv.name)
+        gv.initializer = func
+        gv.global_constant = True
+        gv.linkage = lc.LINKAGE_INTERNAL
+
+def describe_kernel(backend, funcdef, opt=2):
+    '''Compile a kernel and its callees into a module for worker processes.
+    The intrinsics and extra libraries of the backend are linked once.
+
+    Returns a picklable description:
+    (key, bitcode, name, restype code, argument type codes, opt).
+    '''
+    llfunc = backend.compile(funcdef)
+    module = llfunc.module
+    for defn in _implemented_callees(funcdef):
+        module.link_in(backend.compile(defn).module)
+    _resolve_slots(module)
+    if threadpool.is_used(module):
+        module.link_in(threadpool.build_module(threads=1))
+    backend.link(llfunc)
+    bitcode = _to_bitcode(module)
+
+    get_ty_impl = backend.get_type_implementation
+    restype = _encode_ctype(get_ty_impl(funcdef.return_type).ctype(backend))
+    argtypes = tuple(_encode_ctype(get_ty_impl(x).ctype(backend))
+                     for x in funcdef.args)
+    key = hashlib.md5(bitcode).hexdigest()
+    return key, bitcode, llfunc.name, restype, argtypes, opt
+
+def _write_kernel(kernel):
+    '''Store a kernel description in a temporary file for the workers.
+    The file is removed when the returned file object is closed.
+    '''
+    file = tempfile.NamedTemporaryFile(prefix='mlvm-kernel-',
+                                       dir=_SHARED_DIR)
+    pickle.dump(kernel, file, pickle.HIGHEST_PROTOCOL)
+    file.flush()
+    return file
+
+#
+# Worker side
+#
+
+_MAX_WORKER_MAPS = 64
+
+_worker_kernels = {}            # key -> (engine, callable)
+_worker_maps = OrderedDict()    # name -> raw array of the mapping
+
+def _worker_kernel(key, path):
+    try:
+        return _worker_kernels[key][1]
+    except KeyError:
+        pass
+    with open(path, 'rb') as file:
+        _, bitcode, name, restype, argtypes, opt = pickle.load(file)
+    module = lc.Module.from_bitcode(StringIO(bitcode))
+    engine = EngineBuilder.new(module).opt(opt).create()
+    address = engine.get_pointer_to_function(module.get_function_named(name))
+    callable = CFUNCTYPE(_decode_ctype(restype),
+                         *map(_decode_ctype, argtypes))(address)
+    _worker_kernels[key] = engine, callable
+    return callable
+
+def _worker_address(name, offset):
+    try:
+        raw = _worker_maps.pop(name)
+    except KeyError:
+        with open(name, 'r+b') as file:
+            size = os.fstat(file.fileno()).st_size
+            mapping = mmap.mmap(file.fileno(), size)
+        raw = (ctypes.c_char * size).from_buffer(mapping)
+        while len(_worker_maps) >= _MAX_WORKER_MAPS:
+            _worker_maps.popitem(last=False)
+    _worker_maps[name] = raw # most recently used last
+    return ctypes.addressof(raw) + offset
+
+def _worker_run(task):
+    (key, path), values, pointers, count, start, stop = task
+    callable = _worker_kernel(key, path)
+    actual = list(values)
+    for i, name, offset, itemsize in pointers:
+        actual[i] = _worker_address(name, offset + start * itemsize)
+    actual[count] = stop - start
+    return callable(*actual)
+
+#
+# Executor
+#
+
+class ProcessExecutor(object):
+    '''A pool of worker processes that run chunks of kernels on arrays in
+    shared memory.
+
+    Use with JITFunction.parallel or call run_kernel directly.  Every
+    array argument must be allocated with `empty` or `shared_empty`.
+    '''
+    def __init__(self, processes=None, opt=2):
+        '''
+        processes --- (optional) number of processes.
+                      Defaults to the number of CPUs.
+        opt       --- (optional) optimization-level of the workers' JIT.
+        '''
+        self.__processes = processes or cpu_count()
+        self.__opt = opt
+        self.__pool = None
+        # backend -> {(name, argtys) -> (key, file of the description)}
+        self.__kernels = weakref.WeakKeyDictionary()
+        self.__lock = threading.Lock()
+
+    @property
+    def processes(self):
+        return self.__processes
+
+    def empty(self, count, cty):
+        '''Allocate an array in shared memory.  See shared_empty.
+        '''
+        return shared_empty(count, cty)
+
+    def _get_pool(self):
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = Pool(self.__processes)
+            return self.__pool
+
+    def _get_kernel(self, backend, funcdef):
+        '''Returns (key, path) of the description of a kernel.
+        '''
+        cachekey = (funcdef.name, tuple(funcdef.args))
+        with self.__lock:
+            kernels = self.__kernels.setdefault(backend, {})
+            try:
+                key, file = kernels[cachekey]
+            except KeyError:
+                kernel = describe_kernel(backend, funcdef, self.__opt)
+                key, file = kernels[cachekey] = (kernel[0],
+                                                 _write_kernel(kernel))
+            return key, file.name
+
+    def run_kernel(self, backend, funcdef, callable, args, count=None,
+                   grain=DEFAULT_GRAIN):
+        '''Run a kernel on chunks of its index range in the workers.
+        See mlvm.parallel.parallel_call.
+
+        callable is unused; the workers JIT the kernel themselves.
+        '''
+        if len(args) != len(funcdef.args):
+            raise TypeError("Function takes exactly %d arguments; but got %d"
+                            % (len(funcdef.args), len(args)))
+
+        kernel = self._get_kernel(backend, funcdef)
+        rettyimpl = backend.get_type_implementation(funcdef.return_type)
+        tyimpls = [backend.get_type_implementation(x) for x in funcdef.args]
+        ctypes_ = [x.ctype(backend) for x in tyimpls]
+        if count is None:
+            count = find_count_argument(ctypes_)
+        total = int(args[count])
+
+        attrs = argument_attributes(funcdef)
+        values = []
+        pointers = []
+        for i, (ty, cty, arg) in enumerate(zip(tyimpls, ctypes_, args)):
+            converted = ty.ctype_argument(backend, arg, attrs[i])
+            if not is_pointer_ctype(cty):
+                values.append(getattr(converted, 'value', converted))
+                continue
+            itemsize = sizeof(cty._type_)
+            shared = find_shared(address_of(converted), total * itemsize)
+            if shared is None:
+                raise ValueError("Argument %d is not in shared memory" % i)
+            name, offset = shared
+            pointers.append((i, name, offset, itemsize))
+            values.append(None)
+
+        chunks = split_range(total, self.__processes, grain)
+        tasks = [(kernel, values, pointers, count, start, stop)
+                 for start, stop in chunks]
+        results = self._get_pool().map(_worker_run, tasks)
+        return [rettyimpl.ctype_return(backend, x) for x in results]
+
+    def close(self):
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.close()
+                self.__pool.join()
+                self.__pool = None
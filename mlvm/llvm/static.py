@@ -1,5 +1,6 @@
 import llvm.core as lc
 from mlvm.static import CompilerInterface
+from mlvm.llvm import threadpool
 from ctypes import *
 
 try:
@@ -13,9 +14,14 @@ logger = logging.getLogger(__name__)
 class LLVMCompiler(CompilerInterface):
     def __init__(self):
         self.__fatmod = lc.Module.new("static.%X" % id(self))
+        self.__has_threadpool = False
 
     def add_function(self, llfunc):
         self.__fatmod.link_in(llfunc.module)
+        if not self.__has_threadpool and threadpool.is_used(self.__fatmod):
+            # the runtime of parallel loops
+            self.__fatmod.link_in(threadpool.build_module())
+            self.__has_threadpool = True
         return llfunc.name
 
     def write_assembly(self, file):
@@ -0,0 +1,395 @@
+#
+# Native thread pool for the parallel loops of mlvm.irutil.parallel_range.
+#
+# The runtime is generated as LLVM IR over POSIX threads and JIT'ed once per
+# process.  The translator outlines the body of a parallel loop into a
+# function that runs the iterations [lo, hi) and calls
+#
+#     void mlvm_parallel_for(void (*body)(i8 *ctx, intp lo, intp hi),
+#                            i8 *ctx, intp start, intp stop,
+#                            i32 schedule, intp chunk)
+#
+# which runs body over chunks of [start, stop) on the calling thread and
+# the persistent workers, and returns when all chunks are done.
+#
+#   static  (0) --- thread k runs the chunks k, k + T, k + 2T, ... for T
+#                   threads; the default chunk gives one chunk per thread.
+#   dynamic (1) --- threads take the next chunk from a shared counter; the
+#                   default chunk gives 8 chunks per thread.
+#
+# One loop runs on the pool at a time.  A loop that starts while the pool is
+# busy, such as a parallel loop nested in another one, runs serially on its
+# thread.
+#
+# The workers start on the first parallel loop and live until the process
+# exits.  There are MLVM_NUM_THREADS - 1 workers, or the number of CPUs - 1,
+# counted when the runtime is built.  A process forked from one with
+# workers has none: its first parallel loop sees another process id and
+# starts a new pool.  If the pool was busy at the fork, the loops of the
+# child run serially.
+#
+# The static compiler and the process executor link the runtime into their
+# modules; the JIT resolves mlvm_parallel_for to a shared instance.
+#
+
+import os
+import threading
+from multiprocessing import cpu_count
+
+import llvm.core as lc
+from llvm.ee import EngineBuilder
+
+from mlvm.utils import ADDRESS_WIDTH
+
+PARALLEL_FOR = 'mlvm_parallel_for'
+SYMBOLS = (PARALLEL_FOR,)
+
+SCHEDULES = {'static': 0, 'dynamic': 1}
+
+DYNAMIC_CHUNKS_PER_THREAD = 8
+
+# opaque storage of a pthread_mutex_t or a pthread_cond_t
+_SYNC_BYTES = 128
+
+def default_threads():
+    '''Number of threads of the pool, including the calling thread.
+    '''
+    try:
+        return max(1, int(os.environ['MLVM_NUM_THREADS']))
+    except (KeyError, ValueError):
+        return cpu_count()
+
+def body_type():
+    intp = lc.Type.int(ADDRESS_WIDTH * 8)
+    i8p = lc.Type.pointer(lc.Type.int(8))
+    return lc.Type.function(lc.Type.void(), [i8p, intp, intp])
+
+def parallel_for_type():
+    intp = lc.Type.int(ADDRESS_WIDTH * 8)
+    i8p = lc.Type.pointer(lc.Type.int(8))
+    return lc.Type.function(lc.Type.void(),
+                            [lc.Type.pointer(body_type()), i8p, intp, intp,
+                             lc.Type.int(32), intp])
+
+def is_used(module):
+    '''Whether a module declares a function of the runtime.
+    '''
+    return any(func.is_declaration and func.name in SYMBOLS
+               for func in module.functions)
+
+def _minimum(builder, lhs, rhs):
+    return builder.select(builder.icmp(lc.ICMP_SLT, lhs, rhs), lhs, rhs)
+
+def build_module(threads=None):
+    '''Returns a new module that defines mlvm_parallel_for.
+
+    threads --- (optional) number of threads including the calling thread.
+                Defaults to default_threads().
+    '''
+    threads = threads or default_threads()
+    module = lc.Module.new('mlvm.threadpool')
+    void = lc.Type.void()
+    i8p = lc.Type.pointer(lc.Type.int(8))
+    i32 = lc.Type.int(32)
+    intp = lc.Type.int(ADDRESS_WIDTH * 8)
+    bodyptr = lc.Type.pointer(body_type())
+    ZERO = lc.Constant.int(intp, 0)
+    ONE = lc.Constant.int(intp, 1)
+    ZERO32 = lc.Constant.int(i32, 0)
+    ONE32 = lc.Constant.int(i32, 1)
+    NULL = lc.Constant.null(i8p)
+
+    def define_global(name, ty, init=None, align=None):
+        gv = module.add_global_variable(ty, 'mlvm.threadpool.%s' % name)
+        gv.initializer = init if init is not None else lc.Constant.null(ty)
+        gv.linkage = lc.LINKAGE_INTERNAL
+        if align:
+            gv.alignment = align
+        return gv
+
+    def declare(name, retty, argtys):
+        fnty = lc.Type.function(retty, argtys)
+        return module.get_or_insert_function(fnty, name)
+
+    def define(name, fnty):
+        func = module.add_function(fnty, 'mlvm.threadpool.%s' % name)
+        func.linkage = lc.LINKAGE_INTERNAL
+        return func
+
+    # pool state; the job is protected by the lock
+    syncty = lc.Type.array(lc.Type.int(8), _SYNC_BYTES)
+    g_lock = define_global('lock', syncty, align=16)
+    g_work = define_global('work', syncty, align=16)    # a job is posted
+    g_done = define_global('done', syncty, align=16)    # a job is finished
+    g_threads = define_global('threads', i32, lc.Constant.int(i32, threads))
+    g_started = define_global('started', i32)
+    g_pid = define_global('pid', i32)           # of the started pool
+    g_busy = define_global('busy', i32)
+    g_generation = define_global('generation', intp)
+    g_pending = define_global('pending', i32)
+    g_body = define_global('body', bodyptr)
+    g_ctx = define_global('ctx', i8p)
+    g_start = define_global('start', intp)
+    g_stop = define_global('stop', intp)
+    g_schedule = define_global('schedule', i32)
+    g_chunk = define_global('chunk', intp)
+    g_next = define_global('next', intp)
+
+    mutex_init = declare('pthread_mutex_init', i32, [i8p, i8p])
+    mutex_lock = declare('pthread_mutex_lock', i32, [i8p])
+    mutex_unlock = declare('pthread_mutex_unlock', i32, [i8p])
+    cond_init = declare('pthread_cond_init', i32, [i8p, i8p])
+    cond_wait = declare('pthread_cond_wait', i32, [i8p, i8p])
+    cond_broadcast = declare('pthread_cond_broadcast', i32, [i8p])
+    getpid = declare('getpid', i32, [])
+    startty = lc.Type.function(i8p, [i8p])
+    thread_create = declare('pthread_create', i32,
+                            [i8p, i8p, lc.Type.pointer(startty), i8p])
+
+    def sync(builder, gv):
+        return builder.bitcast(gv, i8p)
+
+    # void run(i32 tid, i32 nthreads): the chunks of a thread
+    run = define('run', lc.Type.function(void, [i32, i32]))
+    tid, nthreads = run.args
+    bbentry = run.append_basic_block('entry')
+    bbstatic = run.append_basic_block('static')
+    bbsloop = run.append_basic_block('static.loop')
+    bbsbody = run.append_basic_block('static.body')
+    bbdloop = run.append_basic_block('dynamic.loop')
+    bbdbody = run.append_basic_block('dynamic.body')
+    bbexit = run.append_basic_block('exit')
+
+    builder = lc.Builder.new(bbentry)
+    body = builder.load(g_body)
+    ctx = builder.load(g_ctx)
+    stop = builder.load(g_stop)
+    chunk = builder.load(g_chunk)
+    dynamic = builder.icmp(lc.ICMP_EQ, builder.load(g_schedule),
+                           lc.Constant.int(i32, SCHEDULES['dynamic']))
+    builder.cbranch(dynamic, bbdloop, bbstatic)
+
+    builder.position_at_end(bbstatic)
+    first = builder.add(builder.load(g_start),
+                        builder.mul(builder.zext(tid, intp), chunk))
+    stride = builder.mul(builder.zext(nthreads, intp), chunk)
+    builder.branch(bbsloop)
+
+    builder.position_at_end(bbsloop)
+    lo = builder.phi(intp)
+    lo.add_incoming(first, bbstatic)
+    builder.cbranch(builder.icmp(lc.ICMP_SLT, lo, stop), bbsbody, bbexit)
+
+    builder.position_at_end(bbsbody)
+    builder.call(body, [ctx, lo, _minimum(builder, builder.add(lo, chunk),
+                                          stop)])
+    lo.add_incoming(builder.add(lo, stride), bbsbody)
+    builder.branch(bbsloop)
+
+    builder.position_at_end(bbdloop)
+    lo = builder.atomic_add(g_next, chunk, 'monotonic')
+    builder.cbranch(builder.icmp(lc.ICMP_SLT, lo, stop), bbdbody, bbexit)
+
+    builder.position_at_end(bbdbody)
+    builder.call(body, [ctx, lo, _minimum(builder, builder.add(lo, chunk),
+                                          stop)])
+    builder.branch(bbdloop)
+
+    builder.position_at_end(bbexit)
+    builder.ret_void()
+
+    # i8* worker(i8* tid): wait for a job, run it, repeat
+    worker = define('worker', startty)
+    bbentry = worker.append_basic_block('entry')
+    bbtop = worker.append_basic_block('top')
+    bbcheck = worker.append_basic_block('check')
+    bbwait = worker.append_basic_block('wait')
+    bbgo = worker.append_basic_block('go')
+    bbnotify = worker.append_basic_block('notify')
+    bbrelease = worker.append_basic_block('release')
+
+    builder = lc.Builder.new(bbentry)
+    tid = builder.trunc(builder.ptrtoint(worker.args[0], intp), i32)
+    seen = builder.alloca(intp)
+    builder.store(ZERO, seen)   # workers start before the first job
+    builder.branch(bbtop)
+
+    builder.position_at_end(bbtop)
+    builder.call(mutex_lock, [sync(builder, g_lock)])
+    builder.branch(bbcheck)
+
+    builder.position_at_end(bbcheck)
+    generation = builder.load(g_generation)
+    idle = builder.icmp(lc.ICMP_EQ, generation, builder.load(seen))
+    builder.cbranch(idle, bbwait, bbgo)
+
+    builder.position_at_end(bbwait)
+    builder.call(cond_wait, [sync(builder, g_work), sync(builder, g_lock)])
+    builder.branch(bbcheck)
+
+    builder.position_at_end(bbgo)
+    builder.store(generation, seen)
+    builder.call(mutex_unlock, [sync(builder, g_lock)])
+    builder.call(run, [tid, builder.load(g_threads)])
+    builder.call(mutex_lock, [sync(builder, g_lock)])
+    pending = builder.sub(builder.load(g_pending), ONE32)
+    builder.store(pending, g_pending)
+    builder.cbranch(builder.icmp(lc.ICMP_EQ, pending, ZERO32),
+                    bbnotify, bbrelease)
+
+    builder.position_at_end(bbnotify)
+    builder.call(cond_broadcast, [sync(builder, g_done)])
+    builder.branch(bbrelease)
+
+    builder.position_at_end(bbrelease)
+    builder.call(mutex_unlock, [sync(builder, g_lock)])
+    builder.branch(bbtop)
+
+    # mlvm_parallel_for
+    pfor = module.add_function(parallel_for_type(), PARALLEL_FOR)
+    body, ctx, start, stop, schedule, chunk = pfor.args
+    bbentry = pfor.append_basic_block('entry')
+    bbthreads = pfor.append_basic_block('threads')
+    bbacquire = pfor.append_basic_block('acquire')
+    bbserial = pfor.append_basic_block('serial')
+    bbacquired = pfor.append_basic_block('acquired')
+    bbstartup = pfor.append_basic_block('startup')
+    bbspawn = pfor.append_basic_block('spawn')
+    bbcreate = pfor.append_basic_block('create')
+    bbcreated = pfor.append_basic_block('created')
+    bbstarted = pfor.append_basic_block('started')
+    bbpost = pfor.append_basic_block('post')
+    bbjoin = pfor.append_basic_block('join')
+    bbjoinwait = pfor.append_basic_block('join.wait')
+    bbjoined = pfor.append_basic_block('joined')
+    bbexit = pfor.append_basic_block('exit')
+
+    builder = lc.Builder.new(bbentry)
+    thread = builder.bitcast(builder.alloca(lc.Type.array(lc.Type.int(8),
+                                                          16)), i8p)
+    empty = builder.icmp(lc.ICMP_SLE, stop, start)
+    builder.cbranch(empty, bbexit, bbthreads)
+
+    builder.position_at_end(bbthreads)
+    single = builder.icmp(lc.ICMP_SLE, builder.load(g_threads), ONE32)
+    builder.cbranch(single, bbserial, bbacquire)
+
+    builder.position_at_end(bbacquire)
+    old = builder.atomic_cmpxchg(g_busy, ZERO32, ONE32, 'seq_cst')
+    builder.cbranch(builder.icmp(lc.ICMP_NE, old, ZERO32), bbserial,
+                    bbacquired)
+
+    builder.position_at_end(bbserial)
+    builder.call(body, [ctx, start, stop])
+    builder.ret_void()
+
+    builder.position_at_end(bbacquired)
+    pid = builder.call(getpid, [])
+    started = builder.and_(builder.icmp(lc.ICMP_NE, builder.load(g_started),
+                                        ZERO32),
+                           builder.icmp(lc.ICMP_EQ, builder.load(g_pid), pid))
+    builder.cbranch(started, bbpost, bbstartup)
+
+    # also after a fork: the locks may be held and the workers are gone
+    builder.position_at_end(bbstartup)
+    builder.store(ZERO, g_generation)
+    builder.call(mutex_init, [sync(builder, g_lock), NULL])
+    builder.call(cond_init, [sync(builder, g_work), NULL])
+    builder.call(cond_init, [sync(builder, g_done), NULL])
+    builder.branch(bbspawn)
+
+    # thread k = 1, 2, ... until `threads` or a failure
+    builder.position_at_end(bbspawn)
+    k = builder.phi(i32)
+    k.add_incoming(ONE32, bbstartup)
+    more = builder.icmp(lc.ICMP_SLT, k, lc.Constant.int(i32, threads))
+    builder.cbranch(more, bbcreate, bbstarted)
+
+    builder.position_at_end(bbcreate)
+    arg = builder.inttoptr(builder.zext(k, intp), i8p)
+    status = builder.call(thread_create, [thread, NULL, worker, arg])
+    builder.cbranch(builder.icmp(lc.ICMP_EQ, status, ZERO32), bbcreated,
+                    bbstarted)
+
+    builder.position_at_end(bbcreated)
+    k.add_incoming(builder.add(k, ONE32), bbcreated)
+    builder.branch(bbspawn)
+
+    builder.position_at_end(bbstarted)
+    builder.store(k, g_threads)
+    builder.store(pid, g_pid)
+    builder.store(ONE32, g_started)
+    builder.branch(bbpost)
+
+    builder.position_at_end(bbpost)
+    nthreads = builder.load(g_threads)
+    count = builder.sub(stop, start)
+    wide = builder.zext(nthreads, intp)
+    per_thread = builder.sdiv(builder.sub(builder.add(count, wide), ONE),
+                              wide)
+    tasks = builder.mul(wide, lc.Constant.int(intp,
+                                              DYNAMIC_CHUNKS_PER_THREAD))
+    per_task = builder.sdiv(count, tasks)
+    per_task = builder.select(builder.icmp(lc.ICMP_EQ, per_task, ZERO),
+                              ONE, per_task)
+    dynamic = builder.icmp(lc.ICMP_EQ, schedule,
+                           lc.Constant.int(i32, SCHEDULES['dynamic']))
+    default = builder.select(dynamic, per_task, per_thread)
+    chunk = builder.select(builder.icmp(lc.ICMP_SLE, chunk, ZERO), default,
+                           chunk)
+
+    builder.call(mutex_lock, [sync(builder, g_lock)])
+    builder.store(body, g_body)
+    builder.store(ctx, g_ctx)
+    builder.store(start, g_start)
+    builder.store(stop, g_stop)
+    builder.store(schedule, g_schedule)
+    builder.store(chunk, g_chunk)
+    builder.store(start, g_next)
+    builder.store(builder.sub(nthreads, ONE32), g_pending)
+    builder.store(builder.add(builder.load(g_generation), ONE), g_generation)
+    builder.call(cond_broadcast, [sync(builder, g_work)])
+    builder.call(mutex_unlock, [sync(builder, g_lock)])
+
+    builder.call(run, [ZERO32, nthreads])
+
+    builder.call(mutex_lock, [sync(builder, g_lock)])
+    builder.branch(bbjoin)
+
+    builder.position_at_end(bbjoin)
+    done = builder.icmp(lc.ICMP_EQ, builder.load(g_pending), ZERO32)
+    builder.cbranch(done, bbjoined, bbjoinwait)
+
+    builder.position_at_end(bbjoinwait)
+    builder.call(cond_wait, [sync(builder, g_done), sync(builder, g_lock)])
+    builder.branch(bbjoin)
+
+    builder.position_at_end(bbjoined)
+    builder.call(mutex_unlock, [sync(builder, g_lock)])
+    builder.atomic_cmpxchg(g_busy, ONE32, ZERO32, 'seq_cst')
+    builder.branch(bbexit)
+
+    builder.position_at_end(bbexit)
+    builder.ret_void()
+
+    module.verify()
+    return module
+
+_engine = None
+_addresses = {}
+_lock = threading.Lock()
+
+def get_address(name):
+    '''Returns the address of a runtime function in this process.
+    The runtime is built on the first call.
+    '''
+    global _engine
+    with _lock:
+        if _engine is None:
+            module = build_module()
+            engine = EngineBuilder.new(module).opt(2).create()
+            for fname in SYMBOLS:
+                func = module.get_function_named(fname)
+                _addresses[fname] = engine.get_pointer_to_function(func)
+            _engine = engine    # owns the module
+        return _addresses[name]
@@ -0,0 +1,310 @@
+#
+# Native entry trampolines with the CPython calling convention.
+#
+# A trampoline unboxes the arguments from Python objects, calls the JIT'ed
+# function and boxes the return value in machine code.  It is exposed to
+# Python as a builtin function object so that calling it does not go
+# through ctypes.
+#
+
+import sys
+import ctypes
+from ctypes import pythonapi, c_void_p, c_int, py_object
+
+import llvm.core as lc
+
+from mlvm.backend import argument_attributes
+from mlvm.utils import (ADDRESS_WIDTH, PyBuffer, PyMethodDef,
+                        METH_CALLCONV, METH_FASTCALL)
+
+PY3 = sys.version_info[0] >= 3
+
+#
+# Signatures of the used CPython API functions.
+#
+_SIGNATURES = {
+    'PyErr_Occurred'                : ('obj',    ()),
+    'PyErr_SetString'               : ('void',   ('obj', 'ptr')),
+    'PyFloat_AsDouble'              : ('double', ('obj',)),
+    'PyFloat_FromDouble'            : ('obj',    ('double',)),
+    'PyLong_AsLongLong'             : ('i64',    ('obj',)),
+    'PyLong_AsUnsignedLongLongMask' : ('i64',    ('obj',)),
+    'PyInt_AsUnsignedLongLongMask'  : ('i64',    ('obj',)),
+    'PyLong_FromLongLong'           : ('obj',    ('i64',)),
+    'PyLong_FromUnsignedLongLong'   : ('obj',    ('i64',)),
+    'PyInt_FromSsize_t'             : ('obj',    ('ssize',)),
+    'PyInt_FromSize_t'              : ('obj',    ('ssize',)),
+    'PyBool_FromLong'               : ('obj',    ('ssize',)),
+    'PyTuple_Size'                  : ('ssize',  ('obj',)),
+    'PyTuple_GetItem'               : ('obj',    ('obj', 'ssize')),
+    'PyObject_GetBuffer'            : ('i32',    ('obj', 'ptr', 'i32')),
+    'PyBuffer_Release'              : ('void',   ('ptr',)),
+    'PyEval_SaveThread'             : ('ptr',    ()),
+    'PyEval_RestoreThread'          : ('void',   ('ptr',)),
+    'Py_IncRef'                     : ('void',   ('obj',)),
+}
+
+def _api_address(name):
+    return ctypes.cast(getattr(pythonapi, name), c_void_p).value
+
+class PythonAPI(object):
+    '''Access to the CPython API from a LLVM module.
+
+    Every API function used is recorded in `externals` with its address
+    in the running interpreter so that the execution engine can resolve it.
+    '''
+    def __init__(self, module):
+        self.__module = module
+        self.__externals = {}
+        self.__strings = {}
+
+    @property
+    def module(self):
+        return self.__module
+
+    @property
+    def externals(self):
+        return dict(self.__externals)
+
+    @property
+    def object_type(self):
+        return lc.Type.pointer(lc.Type.int(8))
+
+    @property
+    def ssize_type(self):
+        return lc.Type.int(ADDRESS_WIDTH * 8)
+
+    @property
+    def null(self):
+        return lc.Constant.null(self.object_type)
+
+    @property
+    def buffer_type(self):
+        '''LLVM type of Py_buffer.
+
+        Fields after `suboffsets` are opaque.
+        '''
+        ssize = self.ssize_type
+        pssize = lc.Type.pointer(ssize)
+        ptr = self.object_type
+        i32 = lc.Type.int(32)
+        tail = (ctypes.sizeof(PyBuffer) - PyBuffer.suboffsets.offset
+                - ADDRESS_WIDTH)
+        return lc.Type.struct([ptr, ptr, ssize, ssize, i32, i32, ptr,
+                               pssize, pssize, pssize,
+                               lc.Type.array(lc.Type.int(8), tail)])
+
+    def _to_llvm_type(self, code):
+        return {
+            'obj'    : self.object_type,
+            'ptr'    : self.object_type,
+            'ssize'  : self.ssize_type,
+            'i32'    : lc.Type.int(32),
+            'i64'    : lc.Type.int(64),
+            'double' : lc.Type.double(),
+            'void'   : lc.Type.void(),
+        }[code]
+
+    def declare(self, name):
+        retty, argtys = _SIGNATURES[name]
+        fnty = lc.Type.function(self._to_llvm_type(retty),
+                                [self._to_llvm_type(x) for x in argtys])
+        if name not in self.__externals:
+            self.__externals[name] = _api_address(name)
+        return self.module.get_or_insert_function(fnty, name)
+
+    def call(self, builder, name, *args):
+        return builder.call(self.declare(name), args)
+
+    def constant_object(self, address):
+        '''A borrowed reference to an object at a known address.
+        '''
+        addr = lc.Constant.int(self.ssize_type, address)
+        return addr.inttoptr(self.object_type)
+
+    def exception(self, name):
+        '''The exception object of a PyExc_* variable.
+        '''
+        return self.constant_object(c_void_p.in_dll(pythonapi, name).value)
+
+    def string(self, text):
+        '''A pointer to a NUL-terminated constant string.
+        '''
+        try:
+            gv = self.__strings[text]
+        except KeyError:
+            init = lc.Constant.stringz(text)
+            name = 'mlvm.string.%d' % len(self.__strings)
+            gv = self.module.add_global_variable(init.type, name)
+            gv.initializer = init
+            gv.global_constant = True
+            gv.linkage = lc.LINKAGE_INTERNAL
+            self.__strings[text] = gv
+        zero = lc.Constant.int(lc.Type.int(32), 0)
+        return gv.gep([zero, zero])
+
+    def set_error(self, builder, exc, text):
+        self.call(builder, 'PyErr_SetString', self.exception(exc),
+                  self.string(text))
+
+    def none(self, builder):
+        '''A new reference to None.
+        '''
+        obj = self.constant_object(id(None))
+        self.call(builder, 'Py_IncRef', obj)
+        return obj
+
+    #
+    # Scalar conversion.  Integers are converted through 64-bit values.
+    #
+
+    def as_signed(self, builder, obj):
+        return self.call(builder, 'PyLong_AsLongLong', obj)
+
+    def as_unsigned(self, builder, obj):
+        if PY3:
+            return self.call(builder, 'PyLong_AsUnsignedLongLongMask', obj)
+        else:
+            return self.call(builder, 'PyInt_AsUnsignedLongLongMask', obj)
+
+    def from_signed(self, builder, value):
+        if PY3 or ADDRESS_WIDTH < 8:
+            return self.call(builder, 'PyLong_FromLongLong', value)
+        else:
+            return self.call(builder, 'PyInt_FromSsize_t', value)
+
+    def from_unsigned(self, builder, value):
+        if PY3 or ADDRESS_WIDTH < 8:
+            return self.call(builder, 'PyLong_FromUnsignedLongLong', value)
+        else:
+            return self.call(builder, 'PyInt_FromSize_t', value)
+
+    def from_bool(self, builder, value):
+        value = builder.zext(value, self.ssize_type)
+        return self.call(builder, 'PyBool_FromLong', value)
+
+    def as_double(self, builder, obj):
+        return self.call(builder, 'PyFloat_AsDouble', obj)
+
+    def from_double(self, builder, value):
+        return self.call(builder, 'PyFloat_FromDouble', value)
+
+def build_trampoline(backend, funcdef, gil=True):
+    '''Build a trampoline for a JIT'ed function.
+
+    gil --- If False, the GIL is released while the function runs.
+
+    Returns (module, name, externals) where `name` is the name of the
+    trampoline in `module` and `externals` maps the names of the used
+    CPython API functions to their addresses.
+    '''
+    get_ty_impl = backend.get_type_implementation
+    rettyimpl = get_ty_impl(funcdef.return_type)
+    argtyimpls = [get_ty_impl(x) for x in funcdef.args]
+    attrs = argument_attributes(funcdef)
+
+    mangled = backend.mangle_function(funcdef.name, funcdef.args)
+    module = lc.Module.new('mlvm.trampoline.%s' % mangled)
+    api = PythonAPI(module)
+
+    pyobj = api.object_type
+    ssize = api.ssize_type
+    fastcall = METH_CALLCONV == METH_FASTCALL
+    if fastcall:
+        fnty = lc.Type.function(pyobj, [pyobj, lc.Type.pointer(pyobj), ssize])
+    else:
+        fnty = lc.Type.function(pyobj, [pyobj, pyobj])
+    name = '%s.trampoline' % mangled
+    lfunc = module.add_function(fnty, name)
+
+    bbentry = lfunc.append_basic_block('entry')
+    bbbadargs = lfunc.append_basic_block('badargs')
+    bbunbox = lfunc.append_basic_block('unbox')
+
+    builder = lc.Builder.new(bbentry)
+
+    if fastcall:
+        _, args, nargs = lfunc.args
+        def getitem(i):
+            index = lc.Constant.int(ssize, i)
+            return builder.load(builder.gep(args, [index]))
+    else:
+        _, args = lfunc.args
+        nargs = api.call(builder, 'PyTuple_Size', args)
+        def getitem(i):
+            index = lc.Constant.int(ssize, i)
+            return api.call(builder, 'PyTuple_GetItem', args, index)
+
+    expected = lc.Constant.int(ssize, len(argtyimpls))
+    builder.cbranch(builder.icmp(lc.ICMP_EQ, nargs, expected),
+                    bbunbox, bbbadargs)
+
+    builder.position_at_end(bbbadargs)
+    api.set_error(builder, 'PyExc_TypeError',
+                  "%s() takes exactly %d arguments" % (funcdef.name,
+                                                       len(argtyimpls)))
+    builder.ret(api.null)
+
+    # unbox arguments; on error, run cleanups of the unboxed arguments
+    builder.position_at_end(bbunbox)
+    values = []
+    cleanups = []
+    for i, (ty, attr) in enumerate(zip(argtyimpls, attrs)):
+        value, cleanup = ty.unbox(backend, builder, api, getitem(i), attr)
+
+        bbfail = lfunc.append_basic_block('fail_%d' % i)
+        bbnext = lfunc.append_basic_block('unboxed_%d' % i)
+        err = api.call(builder, 'PyErr_Occurred')
+        builder.cbranch(builder.icmp(lc.ICMP_NE, err, api.null),
+                        bbfail, bbnext)
+
+        builder.position_at_end(bbfail)
+        _run_cleanups(builder, cleanups)
+        builder.ret(api.null)
+
+        builder.position_at_end(bbnext)
+        values.append(value)
+        if cleanup is not None:
+            cleanups.append(cleanup)
+
+    # call
+    if not gil:
+        state = api.call(builder, 'PyEval_SaveThread')
+    call = backend._build_definition_call(funcdef)
+    result = call(builder, *values)
+    if not gil:
+        api.call(builder, 'PyEval_RestoreThread', state)
+
+    _run_cleanups(builder, cleanups)
+    builder.ret(rettyimpl.box(backend, builder, api, result))
+
+    lfunc.verify()
+    return module, name, api.externals
+
+def _run_cleanups(builder, cleanups):
+    for cleanup in reversed(cleanups):
+        cleanup(builder)
+
+class _BuiltinHolder(object):
+    '''Owns the PyMethodDef of a builtin function.
+
+    It is used as the `self` of the builtin function so that the
+    method definition lives as long as the function.
+    '''
+    def __init__(self, name, address, doc):
+        if not isinstance(name, bytes):
+            name = name.encode('ascii')
+        if not isinstance(doc, bytes):
+            doc = doc.encode('ascii')
+        self.methoddef = PyMethodDef(name, address, METH_CALLCONV, doc)
+
+_PyCFunction_NewEx = pythonapi.PyCFunction_NewEx
+_PyCFunction_NewEx.restype = py_object
+_PyCFunction_NewEx.argtypes = [c_void_p, py_object, py_object]
+
+def make_builtin(address, name, doc=''):
+    '''Make a builtin function object from the address of a trampoline.
+    '''
+    holder = _BuiltinHolder(name, address, doc)
+    methoddef = ctypes.addressof(holder.methoddef)
+    return _PyCFunction_NewEx(methoddef, holder, None)
@@ -0,0 +1,309 @@
+#
+# NumPy universal functions from JIT'ed MLVM definitions.
+#
+# An inner loop with the signature of PyUFuncGenericFunction is generated
+# in LLVM for each definition.  It calls the JIT'ed definition for every
+# element.  The loops are registered with the NumPy C API so that NumPy
+# performs broadcasting, type dispatch, casting, `out=` and reductions.
+#
+# A ufunc is made from scalar definitions; e.g.
+#
+#     float foo(float, float)
+#
+# A generalized ufunc is made from kernels on the core dimensions of a
+# layout signature; e.g. "(n),(n)->()".  Every operand is passed as an array
+# type argument pointing at its first element, inputs before outputs.
+# The sizes of the core dimensions follow in order of first appearance,
+# then the strides, in elements, of every core dimension of every operand:
+#
+#     void dot(array_double a, array_double b, array_double out,
+#              address n, address stride_a, address stride_b)
+#
+
+import re
+import ctypes
+import hashlib
+from ctypes import PYFUNCTYPE, py_object, c_void_p, c_char_p, c_int, sizeof
+
+import numpy
+import llvm.core as lc
+
+from mlvm.utils import ADDRESS_WIDTH, ctype_typestr
+from mlvm.llvm.batch import _scalar_ctype
+
+PyUFunc_None = -1
+PyUFunc_Zero = 0
+PyUFunc_One = 1
+
+# indices in the C API table of the umath module
+_FromFuncAndData = 1
+_FromFuncAndDataAndSignature = 31
+
+_keepalive = [] # memory referenced by ufunc objects
+
+def _ufunc_api():
+    from numpy.core import umath
+    capsule = py_object(umath._UFUNC_API)
+    if type(umath._UFUNC_API).__name__ == 'PyCapsule':
+        get = ctypes.pythonapi.PyCapsule_GetPointer
+        get.restype = c_void_p
+        get.argtypes = [py_object, c_char_p]
+        table = get(capsule, None)
+    else:
+        get = ctypes.pythonapi.PyCObject_AsVoidPtr
+        get.restype = c_void_p
+        get.argtypes = [py_object]
+        table = get(capsule)
+    return ctypes.cast(table, ctypes.POINTER(c_void_p))
+
+def _dtype_num(cty):
+    return numpy.dtype(ctype_typestr(cty)).num
+
+def parse_layout(layout):
+    '''Parse a layout signature; e.g. "(m,n),(n)->(m)".
+
+    Returns (inputs, outputs) where each is a list of the tuples of core
+    dimension names of each operand.
+    '''
+    parts = layout.replace(' ', '').split('->')
+    if len(parts) != 2:
+        raise ValueError("Invalid layout: %s" % layout)
+    operand = re.compile(r'\(([^()]*)\)')
+    def parse(text):
+        groups = operand.findall(text)
+        if ','.join('(%s)' % x for x in groups) != text:
+            raise ValueError("Invalid layout: %s" % layout)
+        return [tuple(x for x in g.split(',') if x) for g in groups]
+    return parse(parts[0]), parse(parts[1])
+
+def _loop_signature():
+    intp = lc.Type.int(ADDRESS_WIDTH * 8)
+    charp = lc.Type.pointer(lc.Type.int(8))
+    return lc.Type.function(lc.Type.void(),
+                            [lc.Type.pointer(charp), lc.Type.pointer(intp),
+                             lc.Type.pointer(intp), charp])
+
+def _convert_int(builder, value, ty):
+    if ty.width < value.type.width:
+        return builder.trunc(value, ty)
+    elif ty.width > value.type.width:
+        return builder.sext(value, ty)
+    return value
+
+class _Loop(object):
+    '''Skeleton of an inner loop over dimension 0.
+    '''
+    def __init__(self, module, name):
+        self.intp = lc.Type.int(ADDRESS_WIDTH * 8)
+        self.function = module.add_function(_loop_signature(), name)
+        self.args, self.dims, self.steps, _ = self.function.args
+        bbentry = self.function.append_basic_block('entry')
+        self.builder = lc.Builder.new(bbentry)
+
+    def load_arg(self, i):
+        return self.builder.load(self.builder.gep(self.args, [self._int(i)]))
+
+    def load_dim(self, i):
+        return self.builder.load(self.builder.gep(self.dims, [self._int(i)]))
+
+    def load_step(self, i):
+        return self.builder.load(self.builder.gep(self.steps, [self._int(i)]))
+
+    def _int(self, i):
+        return lc.Constant.int(self.intp, i)
+
+    def build(self, body):
+        '''Emit the loop.  body(builder, idx) emits the loop body.
+        '''
+        builder = self.builder
+        count = self.load_dim(0)
+        bbentry = builder.basic_block
+        bbcond = self.function.append_basic_block('cond')
+        bbbody = self.function.append_basic_block('body')
+        bbexit = self.function.append_basic_block('exit')
+        builder.branch(bbcond)
+
+        builder.position_at_end(bbcond)
+        idx = builder.phi(self.intp, name='idx')
+        idx.add_incoming(self._int(0), bbentry)
+        builder.cbranch(builder.icmp(lc.ICMP_SLT, idx, count), bbbody, bbexit)
+
+        builder.position_at_end(bbbody)
+        body(builder, idx)
+        idx_next = builder.add(idx, self._int(1), name='idx_next')
+        idx.add_incoming(idx_next, builder.basic_block)
+        builder.branch(bbcond)
+
+        builder.position_at_end(bbexit)
+        builder.ret_void()
+        self.function.verify()
+
+def build_ufunc_loop(backend, funcdef):
+    '''Build the inner loop of a ufunc for a scalar definition.
+
+    Returns (module, name, externals).
+    '''
+    get_ty_impl = backend.get_type_implementation
+    rettyimpl = get_ty_impl(funcdef.return_type)
+    argtyimpls = [get_ty_impl(x) for x in funcdef.args]
+    for ty in argtyimpls + [rettyimpl]:
+        _scalar_ctype(backend, ty)
+
+    mangled = backend.mangle_function(funcdef.name, funcdef.args)
+    module = lc.Module.new('mlvm.ufunc.%s' % mangled)
+    name = '%s.ufunc' % mangled
+    loop = _Loop(module, name)
+
+    nin = len(argtyimpls)
+    bases = [loop.load_arg(i) for i in range(nin + 1)]
+    steps = [loop.load_step(i) for i in range(nin + 1)]
+    types = ([ty.argument(backend) for ty in argtyimpls] +
+             [rettyimpl.return_type(backend)])
+    call = backend._build_definition_call(funcdef)
+
+    def body(builder, idx):
+        ptrs = [builder.bitcast(builder.gep(base, [builder.mul(idx, step)]),
+                                lc.Type.pointer(ty))
+                for base, step, ty in zip(bases, steps, types)]
+        values = [builder.load(ptr) for ptr in ptrs[:-1]]
+        builder.store(call(builder, *values), ptrs[-1])
+
+    loop.build(body)
+    return module, name, {}
+
+def build_gufunc_loop(backend, funcdef, layout):
+    '''Build the inner loop of a generalized ufunc for a kernel on the
+    core dimensions of `layout`.
+
+    Returns (module, name, externals).
+    '''
+    inputs, outputs = parse_layout(layout)
+    operands = inputs + outputs
+    dimnames = []
+    for dims in operands:
+        for dim in dims:
+            if dim not in dimnames:
+                dimnames.append(dim)
+    ncore = sum(len(x) for x in operands)
+    nops = len(operands)
+    if len(funcdef.args) != nops + len(dimnames) + ncore:
+        raise TypeError("%s does not match the layout %s" %
+                        (funcdef, layout))
+
+    get_ty_impl = backend.get_type_implementation
+    argtyimpls = [get_ty_impl(x) for x in funcdef.args]
+    itemsizes = [sizeof(ty.ctype(backend)._type_)
+                 for ty in argtyimpls[:nops]]
+    largtys = [ty.argument(backend) for ty in argtyimpls]
+
+    mangled = backend.mangle_function(funcdef.name, funcdef.args)
+    module = lc.Module.new('mlvm.gufunc.%s' % mangled)
+    name = '%s.gufunc.%s' % (mangled,
+                             hashlib.md5(layout.encode('ascii')).hexdigest())
+    loop = _Loop(module, name)
+    builder = loop.builder
+
+    bases = [loop.load_arg(i) for i in range(nops)]
+    steps = [loop.load_step(i) for i in range(nops)]
+
+    sizes = [_convert_int(builder, loop.load_dim(1 + i), ty)
+             for i, ty in enumerate(largtys[nops:nops + len(dimnames)])]
+
+    strides = []
+    stridetys = largtys[nops + len(dimnames):]
+    k = 0
+    for op, dims in enumerate(operands):
+        for _ in dims:
+            step = loop.load_step(nops + k)
+            stride = builder.sdiv(step, loop._int(itemsizes[op]))
+            strides.append(_convert_int(builder, stride, stridetys[k]))
+            k += 1
+
+    call = backend._build_definition_call(funcdef)
+
+    def body(builder, idx):
+        ptrs = [builder.bitcast(builder.gep(base, [builder.mul(idx, step)]),
+                                ty)
+                for base, step, ty in zip(bases, steps, largtys)]
+        call(builder, *(ptrs + sizes + strides))
+
+    loop.build(body)
+    return module, name, {}
+
+def _register(loops, types, nin, nout, name, doc, identity, layout=None):
+    count = len(loops)
+    funcs = (c_void_p * count)(*loops)
+    data = (c_void_p * count)()
+    typecodes = ctypes.create_string_buffer(bytes(bytearray(types)),
+                                            len(types))
+    name = ctypes.create_string_buffer(name.encode('ascii'))
+    doc = ctypes.create_string_buffer(doc.encode('ascii'))
+    api = _ufunc_api()
+    args = [funcs, data, typecodes, count, nin, nout, identity, name, doc, 0]
+    protos = [c_void_p, c_void_p, c_void_p, c_int, c_int, c_int, c_int,
+              c_void_p, c_void_p, c_int]
+    if layout is None:
+        fn = PYFUNCTYPE(py_object, *protos)(api[_FromFuncAndData])
+    else:
+        layout = ctypes.create_string_buffer(layout.encode('ascii'))
+        args.append(layout)
+        protos.append(c_void_p)
+        fn = PYFUNCTYPE(py_object, *protos)(api[_FromFuncAndDataAndSignature])
+    _keepalive.append((funcs, data, typecodes, name, doc, layout))
+    return fn(*args)
+
+def make_ufunc(jit, funcdefs, name=None, doc='', identity=PyUFunc_None,
+               backend=''):
+    '''Make a NumPy ufunc from scalar definitions with different types.
+
+    jit      --- a JIT with a LLVMExecutionManager.
+    funcdefs --- definitions taking the same number of scalar arguments.
+                 They are tried by NumPy in order.
+    name     --- (optional) name of the ufunc.  Defaults to the name of the
+                 first definition.
+    identity --- (optional) PyUFunc_None, PyUFunc_Zero or PyUFunc_One.
+    '''
+    codegen = jit.get_backend(backend)
+    nin = len(funcdefs[0].args)
+    loops = []
+    types = []
+    for funcdef in funcdefs:
+        if len(funcdef.args) != nin:
+            raise TypeError("Definitions take different number of arguments")
+        jit.compile(funcdef, backend)
+        key = ('ufunc', funcdef.name, tuple(funcdef.args))
+        build = lambda: build_ufunc_loop(codegen, funcdef)
+        loops.append(jit.manager.get_entry(key, build))
+        for ty in list(funcdef.args) + [funcdef.return_type]:
+            tyimpl = codegen.get_type_implementation(ty)
+            types.append(_dtype_num(tyimpl.ctype(codegen)))
+    return _register(loops, types, nin, 1, name or funcdefs[0].name, doc,
+                     identity)
+
+def make_gufunc(jit, funcdefs, layout, name=None, doc='',
+                identity=PyUFunc_None, backend=''):
+    '''Make a NumPy generalized ufunc from kernels on the core dimensions
+    of a layout signature; e.g. "(n),(n)->()".
+
+    jit      --- a JIT with a LLVMExecutionManager.
+    funcdefs --- kernels with different element types.
+    layout   --- the layout signature.
+    name     --- (optional) name of the ufunc.  Defaults to the name of the
+                 first definition.
+    identity --- (optional) PyUFunc_None, PyUFunc_Zero or PyUFunc_One.
+    '''
+    codegen = jit.get_backend(backend)
+    inputs, outputs = parse_layout(layout)
+    nops = len(inputs) + len(outputs)
+    loops = []
+    types = []
+    for funcdef in funcdefs:
+        jit.compile(funcdef, backend)
+        key = ('gufunc', funcdef.name, tuple(funcdef.args), layout)
+        build = lambda: build_gufunc_loop(codegen, funcdef, layout)
+        loops.append(jit.manager.get_entry(key, build))
+        for ty in funcdef.args[:nops]:
+            tyimpl = codegen.get_type_implementation(ty)
+            types.append(_dtype_num(tyimpl.ctype(codegen)._type_))
+    return _register(loops, types, len(inputs), len(outputs),
+                     name or funcdefs[0].name, doc, identity, layout)
@@ -0,0 +1,177 @@
+#
+# Multi-threaded execution of JIT'ed array kernels.
+#
+# A kernel takes arrays and an element count.  The index range is split
+# into chunks; each chunk calls the kernel with the array pointers offset
+# to the start of the chunk and the count set to the chunk length.
+# The kernel must be compiled with gil=False so that the chunks run
+# concurrently.  See mlvm.llvm.process for a pool of processes.
+#
+
+import ctypes
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from mlvm.backend import argument_attributes
+
+DEFAULT_GRAIN = 1024
+
+_INTEGER_CODES = 'bhilqBHILQ'
+
+def split_range(count, parts, grain=DEFAULT_GRAIN):
+    '''Split range(count) into at most `parts` chunks of at least `grain`
+    elements, except for a smaller range.
+
+    Returns a list of (start, stop).
+    '''
+    grain = max(1, grain)
+    size = max(grain, -(-count // max(1, parts)))
+    return [(start, min(start + size, count))
+            for start in range(0, count, size)] or [(0, 0)]
+
+class ParallelExecutor(object):
+    '''A persistent pool of threads for running chunks of GIL-free
+    kernels.
+    '''
+    def __init__(self, threads=None):
+        '''
+        threads --- (optional) number of threads.
+                    Defaults to the number of CPUs.
+        '''
+        self.__threads = threads or cpu_count()
+        self.__pool = None
+        self.__lock = threading.Lock()
+
+    @property
+    def threads(self):
+        return self.__threads
+
+    def map(self, fn, chunks):
+        '''Run fn on every chunk.  Returns the results in order.
+        A single chunk runs in the calling thread.
+        '''
+        if len(chunks) == 1:
+            return [fn(chunks[0])]
+        return self._get_pool().map(fn, chunks)
+
+    def _get_pool(self):
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = ThreadPool(self.__threads)
+            return self.__pool
+
+    def run_kernel(self, backend, funcdef, callable, args, count=None,
+                   grain=DEFAULT_GRAIN):
+        '''Run a GIL-free kernel on chunks of its index range in the
+        threads.  See parallel_call.
+        '''
+        if callable._flags_ & ctypes._FUNCFLAG_PYTHONAPI:
+            raise ValueError("%s must be compiled with gil=False to run in "
+                             "parallel" % funcdef.name)
+        if len(args) != len(funcdef.args):
+            raise TypeError("Function takes exactly %d arguments; but got %d"
+                            % (len(funcdef.args), len(args)))
+
+        rettyimpl = backend.get_type_implementation(funcdef.return_type)
+        tyimpls = [backend.get_type_implementation(x) for x in funcdef.args]
+        ctypes_ = [x.ctype(backend) for x in tyimpls]
+        params = [x.ctype_parameter(backend) for x in tyimpls]
+        if count is None:
+            count = find_count_argument(ctypes_)
+
+        attrs = argument_attributes(funcdef)
+        converted = [ty.ctype_argument(backend, arg, attr)
+                     for ty, arg, attr in zip(tyimpls, args, attrs)]
+
+        # (index, base address, element size, parameter type) of arrays
+        arrays = [(i, address_of(converted[i]), ctypes.sizeof(cty._type_),
+                   params[i])
+                  for i, cty in enumerate(ctypes_) if is_pointer_ctype(cty)]
+
+        chunks = split_range(int(args[count]), self.__threads, grain)
+
+        def run(chunk):
+            start, stop = chunk
+            actual = list(converted)
+            for i, base, itemsize, param in arrays:
+                address = base + start * itemsize
+                if param is ctypes.c_void_p:
+                    actual[i] = address
+                else:
+                    actual[i] = ctypes.cast(address, param)
+            actual[count] = stop - start
+            return rettyimpl.ctype_return(backend, callable(*actual))
+
+        return self.map(run, chunks)
+
+    def close(self):
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.close()
+                self.__pool.join()
+                self.__pool = None
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+def get_default_executor():
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = ParallelExecutor()
+        return _default_executor
+
+def is_pointer_ctype(cty):
+    return isinstance(cty, type) and issubclass(cty, ctypes._Pointer)
+
+def is_integer_ctype(cty):
+    return (isinstance(cty, type) and issubclass(cty, ctypes._SimpleCData)
+            and cty._type_ in _INTEGER_CODES)
+
+def find_count_argument(ctypes_):
+    '''Returns the index of the last integer argument.
+    '''
+    for i in reversed(range(len(ctypes_))):
+        if is_integer_ctype(ctypes_[i]):
+            return i
+    raise TypeError("Kernel has no integer argument for the element count")
+
+def address_of(value):
+    '''Returns the address held by a converted pointer argument.
+    '''
+    if value is None:
+        return 0
+    if isinstance(value, ctypes._Pointer):
+        return ctypes.cast(value, ctypes.c_void_p).value or 0
+    if isinstance(value, ctypes.Array):
+        return ctypes.addressof(value)
+    if isinstance(value, ctypes.c_void_p):
+        return value.value or 0
+    try:
+        return int(value)
+    except TypeError:
+        raise TypeError("Cannot offset array argument %r" % (value,))
+
+def parallel_call(backend, funcdef, callable, args, count=None,
+                  grain=DEFAULT_GRAIN, executor=None):
+    '''Call a JIT'ed kernel on chunks of its index range.
+
+    backend  --- backend that compiled the kernel.
+    funcdef  --- definition of the kernel.
+    callable --- the ctypes function of the kernel.
+    args     --- arguments as accepted by the kernel.
+    count    --- (optional) index of the element count argument.
+                 Defaults to the last integer argument.
+    grain    --- minimum number of elements per chunk.
+    executor --- (optional) an executor that implements run_kernel;
+                 e.g. ParallelExecutor or
+                 mlvm.llvm.process.ProcessExecutor.
+
+    Every pointer argument is an array of elements indexed by the kernel.
+
+    Returns the list of results of each chunk.
+    '''
+    executor = executor or get_default_executor()
+    return executor.run_kernel(backend, funcdef, callable, args, count,
+                               grain)
@@ -1,13 +1,16 @@
 from mlvm.ir import *
+from mlvm import irutil
 from mlvm.jit import *
 from mlvm.llvm.jit import *
 from mlvm.llvm.backend import *
 from mlvm.llvm.ext import arraytype as ext_arraytype
+from mlvm.llvm.ext import arrayfusion
 
 import numpy as np
 from ctypes import *
 from .support import sample_array_function_1, sample_array_function_2
 import unittest
+import warnings
 import logging
 logger = logging.getLogger(__name__)
 
@@ -68,6 +71,51 @@ class TestArrayExtension(unittest.TestCase):
         Gold = (A + B) * 3.14
         self.assertTrue(np.allclose(Gold, C))
 
+        # call with an address
+        C = np.zeros_like(A)
+        function(A.ctypes.data, B.ctypes.data, C.ctypes.data, A.shape[0])
+        self.assertTrue(np.allclose(Gold, C))
+
+        # call with a buffer object
+        C = np.zeros_like(A)
+        function(memoryview(A), memoryview(B), memoryview(C), A.shape[0])
+        self.assertTrue(np.allclose(Gold, C))
+
+        # read-only buffers are only accepted for the 'in' arguments
+        R = np.frombuffer(A.tobytes(), dtype=dtype)
+        S = np.frombuffer(B.tobytes(), dtype=dtype)
+        C = np.zeros_like(A)
+        function(R, memoryview(S), C, A.shape[0])
+        self.assertTrue(np.allclose(Gold, C))
+        self.assertRaises(ValueError, function, A, B, R, A.shape[0])
+        self.assertRaises(ValueError, function, A, B, memoryview(R),
+                          A.shape[0])
+
+        # element type must match
+        self.assertRaises(TypeError, function, A.astype(np.int8), B, C,
+                          A.shape[0])
+
+        # array must be contiguous
+        self.assertRaises(TypeError, function, A[::2], B[::2], C[::2],
+                          A.shape[0] // 2)
+
+        # call with numpy array through a trampoline
+        native = jit.compile(funcdef, trampoline=True)
+        C = np.zeros_like(A)
+
+        n = native(A, B, C, A.shape[0])
+        self.assertTrue(n == A.shape[0])
+        self.assertTrue(np.allclose(Gold, C))
+
+        # output array must be writable
+        C.flags.writeable = False
+        self.assertRaises((BufferError, ValueError), native, A, B, C,
+                          A.shape[0])
+
+        # element size must match
+        self.assertRaises(TypeError, native, A.astype(np.int8), B, C,
+                          A.shape[0])
+
     def _test_template_2(self, arraytype, dtype, ctype):
         context = Context(TypeSystem())
         context.install(ext_arraytype)
@@ -151,6 +199,573 @@ class TestArrayExtension(unittest.TestCase):
 
         
 
+    def test_elementwise(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # void kernel(A, B, C, D, M, N)
+        func = context.add_function("kernel")
+        funcdef = func.add_definition("void", ("array_double",) * 4 +
+                                              ("array_uint8", "address"))
+        impl = funcdef.implement()
+        A, B, C, D, M, N = impl.args
+        b = Builder(impl.append_basic_block())
+        two = b.const('double', 2)
+        b.array_sub(A, B, C, N)             # C = A - B
+        b.array_imul(C, two, N)             # C *= 2
+        b.array_imax(C, A, N)               # C = max(C, A)
+        b.array_fma(A, two, C, D, N)        # D = A * 2 + C
+        b.array_iabs(D, N)                  # D = |D|
+        b.array_lt(A, B, M, N)              # M = A < B
+        b.ret()
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        function = jit.compile(funcdef)
+
+        n = 1001
+        A = np.random.randn(n)
+        B = np.random.randn(n)
+        C = np.zeros(n)
+        D = np.zeros(n)
+        M = np.zeros(n, dtype=np.uint8)
+        # the last element is beyond the count and must stay untouched
+        function(A, B, C, D, M, n - 1)
+
+        GoldC = np.maximum((A - B) * 2, A)
+        GoldD = np.abs(A * 2 + GoldC)
+        self.assertTrue(np.allclose(GoldC[:-1], C[:-1]))
+        self.assertTrue(np.allclose(GoldD[:-1], D[:-1]))
+        self.assertTrue(np.all((A < B)[:-1] == M[:-1]))
+        self.assertEqual(C[-1], 0)
+        self.assertEqual(D[-1], 0)
+        self.assertEqual(M[-1], 0)
+
+    def test_argument_attributes(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        func = context.add_function("scale")
+        funcdef = func.add_definition("void", ("array_float", "array_float",
+                                               "address"))
+        impl = funcdef.implement()
+        A, B, N = impl.args
+        A.attributes.add('in')
+        A.attributes.add('noalias')
+        B.attributes.add('out')
+        B.attributes.add('align(16)')
+        N.attributes.add('in')
+        b = Builder(impl.append_basic_block())
+        b.array_imul(B, b.const('float', 2), N)
+        b.ret()
+
+        backend = LLVMBackend()
+        backend.install(ext_arraytype)
+        lfunc = backend.compile(funcdef)
+        header = str(lfunc).split('{')[0]
+        first, second = header.split(',')[:2]
+        self.assertIn('noalias', first)
+        self.assertIn('nocapture', first)
+        self.assertIn('nocapture', second)
+        self.assertIn('align 16', second)
+        self.assertNotIn('readonly', second)
+
+        B.attributes.add('align(3)')
+        self.assertRaises(ValueError, backend.compile, funcdef)
+
+    def test_fusion(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # void chain(A, B, T, U, C, N)
+        # { T = A + B; T *= 2; U = T - A; C = max(U, A) }
+        func = context.add_function("chain")
+        funcdef = func.add_definition("void", ("array_double",) * 5 +
+                                              ("address",))
+        impl = funcdef.implement()
+        A, B, T, U, C, N = impl.args
+        T.attributes.add('temp')
+        b = Builder(impl.append_basic_block())
+        b.array_add(A, B, T, N)
+        b.array_imul(T, b.const('double', 2), N)
+        b.array_sub(T, A, U, N)
+        b.array_max(U, A, C, N)
+        b.ret()
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        self.assertEqual(arrayfusion.fuse(funcdef, backend), 1)
+        ops = impl.basic_blocks[0].operations
+        self.assertEqual(len(ops), 1)
+
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        function = jit.compile(funcdef)
+
+        n = 1000
+        A, B = np.random.randn(n), np.random.randn(n)
+        T, U, C = np.zeros(n), np.zeros(n), np.zeros(n)
+        function(A, B, T, U, C, n)
+
+        GoldU = (A + B) * 2 - A
+        self.assertTrue(np.allclose(GoldU, U))
+        self.assertTrue(np.allclose(np.maximum(GoldU, A), C))
+        # the stores of the temporary are removed
+        self.assertTrue(np.all(T == 0))
+
+        # void accumulate(X, Y, Z, M) { Y += X; Z = Y * 2 }
+        func = context.add_function("accumulate")
+        accdef = func.add_definition("void", ("array_double",) * 3 +
+                                             ("address",))
+        impl = accdef.implement()
+        X, Y, Z, M = impl.args
+        Y.attributes.add('temp')
+        b = Builder(impl.append_basic_block())
+        b.array_iadd(Y, X, M)
+        b.array_mul(Y, b.const('double', 2), Z, M)
+        b.ret()
+        self.assertEqual(arrayfusion.fuse(accdef, backend), 1)
+        function = jit.compile(accdef)
+
+        # the temporary is read before it is written; its stores are kept
+        T = np.ones(n)
+        function(A, T, C, n)
+        self.assertTrue(np.allclose(T, 1 + A))
+        self.assertTrue(np.allclose(C, (1 + A) * 2))
+
+    def _compile_reduction(self, name, elemtype, retty, nargs):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        func = context.add_function(name)
+        arraytype = 'array_%s' % elemtype
+        funcdef = func.add_definition(retty,
+                                      (arraytype,) * nargs + ('address',))
+        impl = funcdef.implement()
+        b = Builder(impl.append_basic_block())
+        b.ret(getattr(b, name)(*impl.args))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        return jit.compile(funcdef)
+
+    def test_reduction(self):
+        A = np.random.randn(1003)
+        B = np.random.randn(1003)
+        I = np.random.randint(-1000, 1000, size=1003).astype(np.int32)
+
+        array_sum = self._compile_reduction('array_sum', 'double', 'double', 1)
+        array_dot = self._compile_reduction('array_dot', 'double', 'double', 2)
+        array_min = self._compile_reduction('array_min', 'int32', 'int32', 1)
+        array_argmax = self._compile_reduction('array_argmax', 'double',
+                                               'address', 1)
+        array_pairwise = self._compile_reduction('array_sum_pairwise',
+                                                 'double', 'double', 1)
+
+        # lengths around the vector step and the pairwise block
+        for n in [0, 1, 7, 8, 9, 31, 128, 129, 1003]:
+            self.assertAlmostEqual(array_sum(A, n), A[:n].sum())
+            self.assertAlmostEqual(array_dot(A, B, n), A[:n].dot(B[:n]))
+            self.assertAlmostEqual(array_pairwise(A, n), A[:n].sum())
+            if n:
+                self.assertEqual(array_min(I, n), I[:n].min())
+                self.assertEqual(array_argmax(A, n), A[:n].argmax())
+
+        self.assertEqual(array_min(I, 0), np.iinfo(np.int32).max)
+        self.assertEqual(array_argmax(A, 0), 0)
+
+        # the first of equal elements
+        self.assertEqual(array_argmax(np.ones(100), 100), 0)
+
+    def test_strided_array(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # void scale(array2d_double A, array2d_double C)
+        # { C[i, j] = A[i, j] * 2 }
+        func = context.add_function("scale")
+        funcdef = func.add_definition("void", ("array2d_double",
+                                               "array2d_double"))
+        impl = funcdef.implement()
+        A, C = impl.args
+        A.attributes.add('in')
+        C.attributes.add('out')
+        b = Builder(impl.append_basic_block())
+        zero = b.const('address', 0)
+        i = b.var('address')
+        i.initializer = zero
+        j = b.var('address')
+        m = b.array_shape(A, zero)
+        n = b.array_shape(A, b.const('address', 1))
+        with irutil.for_range(b, i, m):
+            b.assign(zero, j)
+            with irutil.for_range(b, j, n):
+                value = b.array_load(A, i, j)
+                b.array_store(C, b.mul(value, b.const('double', 2)), i, j)
+        b.ret()
+
+        # uint8 contiguous(array2d_double A); a pred zero-extends to uint8
+        func = context.add_function("contiguous")
+        contigdef = func.add_definition("uint8", ("array2d_double",))
+        impl = contigdef.implement()
+        b = Builder(impl.append_basic_block())
+        b.ret(b.array_is_contiguous(impl.args[0]))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        function = jit.compile(funcdef)
+        contiguous = jit.compile(contigdef)
+
+        X = np.arange(60, dtype=np.float64).reshape(6, 10)
+        for view in [X, X.T, X[1:5, ::3], X[::-2, 2:7]]:
+            out = np.zeros(view.shape)
+            function(view, out)
+            self.assertTrue(np.allclose(view * 2, out))
+
+            # write into a non-contiguous view through a trampoline
+            native = jit.compile(funcdef, trampoline=True)
+            out = np.zeros(view.shape[::-1]).T
+            native(view, out)
+            self.assertTrue(np.allclose(view * 2, out))
+
+        self.assertEqual(contiguous(X), 1)
+        self.assertEqual(contiguous(X[:, :1]), 0)
+        self.assertEqual(contiguous(X[::2, :]), 0)
+        self.assertEqual(contiguous(X.T), 0)
+        self.assertEqual(contiguous(X[1:3]), 1)
+
+        # dimensions and element type must match
+        self.assertRaises(TypeError, function, X[0], X[0])
+        self.assertRaises(TypeError, function, X.astype(np.float32), X)
+
+    def test_slice_array(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # double total(slice_double A)
+        func = context.add_function("total")
+        funcdef = func.add_definition("double", ("slice_double",))
+        impl = funcdef.implement()
+        A, = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('address')
+        acc = b.var('double')
+        acc.initializer = b.const('double', 0)
+        with irutil.for_slice(b, i, A):
+            b.assign(b.add(acc, b.array_load(A, i)), acc)
+        b.ret(acc)
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        function = jit.compile(funcdef)
+        native = jit.compile(funcdef, trampoline=True)
+
+        X = np.arange(1000, dtype=np.float64)
+        for array in [X, X[10:500], X[:0], (c_double * 7)(*range(7))]:
+            expect = sum(array)
+            self.assertAlmostEqual(function(array), expect)
+        self.assertAlmostEqual(native(X[3:17]), X[3:17].sum())
+
+        self.assertRaises(TypeError, function, X[::2])
+        self.assertRaises(TypeError, function, X.astype(np.float32))
+        self.assertRaises(TypeError, function, X.reshape(10, 100))
+
+    def test_loop_hints(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # void shift(array_double A, array_double B, address n)
+        # { B[i] = A[i] + 1 }
+        func = context.add_function("shift")
+        funcdef = func.add_definition("void", ("array_double",
+                                               "array_double", "address"))
+        impl = funcdef.implement()
+        A, B, N = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('address')
+        i.initializer = b.const('address', 0)
+        one = b.const('double', 1)
+        self.assertRaises(TypeError, irutil.for_range(b, i, N,
+                                                      vectorise=4).__enter__)
+        with irutil.for_range(b, i, N, vectorize_width=4, interleave=2,
+                              independent=True):
+            b.array_store(B, b.add(b.array_load(A, i), one), i)
+        b.ret()
+        self.assertIn('loop hints: independent=True, interleave=2, '
+                      'vectorize_width=4', str(impl))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        lfunc = backend.compile(funcdef)
+        self.assertIn('llvm.loop', str(lfunc.module))
+
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        shift = jit.compile(funcdef)
+        X = np.arange(100, dtype=np.float64)
+        Y = np.zeros_like(X)
+        shift(X, Y, 99)
+        self.assertTrue(np.all(Y[:99] == X[:99] + 1))
+        self.assertEqual(Y[99], 0)
+
+        # the loop vectorizer takes the width; the first compile is stale
+        lfunc = backend.link(backend.compile(funcdef))
+        self.assertIn('<4 x double>', str(lfunc.module))
+
+    def test_tiled(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # void transpose(array_float A, array_float B, address m, address n)
+        # { B[j * m + i] = A[i * n + j] }
+        func = context.add_function("transpose")
+        funcdef = func.add_definition("void", ("array_float", "array_float",
+                                               "address", "address"))
+        impl = funcdef.implement()
+        A, B, M, N = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('address')
+        j = b.var('address')
+        self.assertRaises(ValueError, irutil.for_tiled(b, [i, j], [M, N],
+                                                       [4, 0]).__enter__)
+        with irutil.for_tiled(b, [i, j], [M, N], [4, 3]):
+            value = b.array_load(A, b.add(b.mul(i, N), j))
+            b.array_store(B, value, b.add(b.mul(j, M), i))
+        b.ret()
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        transpose = jit.compile(funcdef)
+
+        # the same with int32 indices and address bounds
+        func = context.add_function("transpose32")
+        funcdef = func.add_definition("void", ("array_float", "array_float",
+                                               "address", "address"))
+        impl = funcdef.implement()
+        A, B, M, N = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('int32')
+        j = b.var('int32')
+        with irutil.for_tiled(b, [i, j], [M, N], [3, 2]):
+            I, J = b.cast(i, 'address'), b.cast(j, 'address')
+            value = b.array_load(A, b.add(b.mul(I, N), J))
+            b.array_store(B, value, b.add(b.mul(J, M), I))
+        b.ret()
+        transpose32 = jit.compile(funcdef)
+
+        for m, n in [(10, 7), (8, 6), (1, 5), (0, 3)]:
+            X = np.arange(m * n, dtype=np.float32).reshape(m, n)
+            for function in [transpose, transpose32]:
+                Y = np.zeros((n, m), dtype=np.float32)
+                function(X, Y, m, n)
+                self.assertTrue(np.all(X.T == Y))
+
+    def _compile_intrinsic(self, name, retty, argtys):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        func = context.add_function(name)
+        funcdef = func.add_definition(retty, argtys)
+        impl = funcdef.implement()
+        b = Builder(impl.append_basic_block())
+        result = getattr(b, name)(*impl.args)
+        if retty == 'void':
+            b.ret()
+        else:
+            b.ret(result)
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        return jit.compile(funcdef)
+
+    def test_indexed(self):
+        D = 'array_double'
+        I = 'array_int32'
+        M = 'array_uint8'
+        take = self._compile_intrinsic('array_take', 'double',
+                                     (D, I, 'address'))
+        put = self._compile_intrinsic('array_put', 'void',
+                                    (D, 'double', I, 'address'))
+        gather = self._compile_intrinsic('array_gather', 'void',
+                                       (D, I, D, 'address'))
+        gather_masked = self._compile_intrinsic('array_gather_masked', 'void',
+                                              (D, I, M, D, 'address'))
+        scatter = self._compile_intrinsic('array_scatter', 'void',
+                                        (D, I, D, 'address'))
+        scatter_masked = self._compile_intrinsic('array_scatter_masked',
+                                               'void', (D, I, M, D,
+                                                        'address'))
+
+        table = np.random.randn(50)
+        idx = np.random.randint(0, 50, size=103).astype(np.int32)
+        mask = (np.random.rand(103) < 0.5).astype(np.uint8)
+
+        self.assertEqual(take(table, idx, 7), table[idx[7]])
+        X = table.copy()
+        put(X, 2.5, idx, 7)
+        self.assertEqual(X[idx[7]], 2.5)
+
+        # lengths around the group of lanes
+        for n in [0, 1, 3, 4, 5, 103]:
+            out = np.zeros(103)
+            gather(table, idx, out, n)
+            self.assertTrue(np.all(out[:n] == table[idx[:n]]))
+            self.assertTrue(np.all(out[n:] == 0))
+
+            out = -np.ones(103)
+            gather_masked(table, idx, mask, out, n)
+            gold = np.where(mask[:n], table[idx[:n]], -1)
+            self.assertTrue(np.all(out[:n] == gold))
+
+            # a repeated index keeps the last value
+            values = np.random.randn(103)
+            X = np.zeros(50)
+            scatter(values, idx, X, n)
+            Y = np.zeros(50)
+            for k in range(n):
+                Y[idx[k]] = values[k]
+            self.assertTrue(np.all(X == Y))
+
+            X = np.zeros(50)
+            scatter_masked(values, idx, mask, X, n)
+            Y = np.zeros(50)
+            for k in range(n):
+                if mask[k]:
+                    Y[idx[k]] = values[k]
+            self.assertTrue(np.all(X == Y))
+
+        # masked-off indices are not dereferenced
+        bad = np.array([0, 1 << 30, 2, 1 << 30, 3], dtype=np.int32)
+        keep = np.array([1, 0, 1, 0, 1], dtype=np.uint8)
+        out = np.zeros(5)
+        gather_masked(table, bad, keep, out, 5)
+        self.assertTrue(np.all(out == [table[0], 0, table[2], 0, table[3]]))
+
+    def test_memory(self):
+        D = 'array_double'
+        copy = self._compile_intrinsic('array_copy', 'void',
+                                       (D, D, 'address'))
+        move = self._compile_intrinsic('array_move', 'void',
+                                       (D, D, 'address'))
+        fill = self._compile_intrinsic('array_fill', 'void',
+                                       (D, 'double', 'address'))
+        zero = self._compile_intrinsic('array_zero', 'void', (D, 'address'))
+        fill_int32 = self._compile_intrinsic('array_fill', 'void',
+                                             ('array_int32', 'int32',
+                                              'address'))
+        fill_uint8 = self._compile_intrinsic('array_fill', 'void',
+                                             ('array_uint8', 'uint8',
+                                              'address'))
+
+        A = np.random.randn(100)
+        C = np.zeros(101)
+        copy(A, C[1:], 99)      # unaligned
+        self.assertTrue(np.all(C[1:100] == A[:99]))
+        self.assertEqual(C[0], 0)
+        self.assertEqual(C[100], 0)
+
+        # overlapping arrays
+        X = A.copy()
+        move(X, X[3:], 97)
+        self.assertTrue(np.all(X[3:] == A[:97]))
+        self.assertTrue(np.all(X[:3] == A[:3]))
+
+        for value in [0.0, 1.5, -2.0]:
+            X = A.copy()
+            fill(X, value, 60)
+            self.assertTrue(np.all(X[:60] == value))
+            self.assertTrue(np.all(X[60:] == A[60:]))
+
+        X = A.copy()
+        zero(X, 50)
+        self.assertTrue(np.all(X[:50] == 0))
+        self.assertTrue(np.all(X[50:] == A[50:]))
+
+        for value in [-1, 7, 0x01010101]:
+            I = np.zeros(20, dtype=np.int32)
+            fill_int32(I, value, 19)
+            self.assertTrue(np.all(I[:19] == value))
+            self.assertEqual(I[19], 0)
+
+        B = np.zeros(20, dtype=np.uint8)
+        fill_uint8(B, 200, 20)
+        self.assertTrue(np.all(B == 200))
+
+    def test_fast_math(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # double norm2(array_double A, address n)
+        # { s = 0; s += A[i] * A[i]; return s / n }
+        func = context.add_function("norm2")
+        funcdef = func.add_definition("double", ("array_double", "address"))
+        impl = funcdef.implement()
+        impl.attributes.add('fast')
+        A, N = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('address')
+        i.initializer = b.const('address', 0)
+        s = b.var('double')
+        s.initializer = b.const('double', 0)
+        with irutil.for_range(b, i, N):
+            x = b.array_load(A, i)
+            b.assign(b.add(s, b.mul(x, x)), s)
+        quotient = b.div(s, b.cast(N, 'double'))
+        quotient.attributes.add('arcp')
+        b.ret(quotient)
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        lfunc = backend.compile(funcdef)
+        fadds = [inst for bb in lfunc.basic_blocks for inst in bb.instructions
+                 if inst.opcode_name == 'fadd']
+        if hasattr(fadds[0]._ptr, 'setHasUnsafeAlgebra'):
+            self.assertIn('fadd fast', str(lfunc))
+        if any(hasattr(fadds[0]._ptr, name)
+               for name in ('setFast', 'setHasUnsafeAlgebra')):
+            # the reduction is vectorized at link time
+            linked = backend.link(backend.compile(funcdef))
+            self.assertIn(' x double>', str(linked.module))
+
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        norm2 = jit.compile(funcdef)
+        X = np.random.random(1001)
+        self.assertAlmostEqual(norm2(X, 1001), X.dot(X) / 1001)
+
+    def test_fast_math_dropped(self):
+        from mlvm.llvm import backend as llvm_backend
+
+        class Ptr(object):
+            def __init__(self):
+                self.flags = []
+            def setHasNoNaNs(self, value):
+                self.flags.append('nnan')
+
+        class Inst(object):
+            _ptr = Ptr()
+
+        inst = Inst()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            llvm_backend._set_fast_math(inst, set(['nnan', 'ninf', 'arcp']))
+        self.assertEqual(inst._ptr.flags, ['nnan'])
+        self.assertEqual(len(caught), 1)
+        self.assertTrue(issubclass(caught[0].category, RuntimeWarning))
+        self.assertIn('arcp, ninf', str(caught[0].message))
+        self.assertAlmostEqual(norm2(X, 3), X[:3].dot(X[:3]) / 3)
 
 if __name__ == '__main__':
     unittest.main()
@@ -8,6 +8,9 @@ import numpy as np
 from ctypes import *
 from .support import sample_call_function_1, sample_call_function_2
 import math
+import threading
+import time
+import gc
 import unittest
 import logging
 logger = logging.getLogger(__name__)
@@ -49,6 +52,16 @@ class TestCall(unittest.TestCase):
         got = np.vectorize(lambda X: function(X))(X)
         self.assertTrue(np.allclose(expect, got))
 
+        # test batched invocation
+        got = function.call_many(X)
+        self.assertEqual(got.dtype, np.float32)
+        self.assertTrue(np.allclose(expect, got))
+
+        out = np.empty(X.shape, dtype=np.float32)
+        got = function.map(list(X), out=out)
+        self.assertTrue(got is out)
+        self.assertTrue(np.allclose(expect, out))
+
     def test_call_function_2(self):
         context = Context(TypeSystem())
         context.install(ext_arraytype)
@@ -82,5 +95,282 @@ class TestCall(unittest.TestCase):
         got = np.vectorize(lambda X: function(X))(X)
         self.assertTrue(np.allclose(expect, got))
 
+        # no conversion is needed for int32; unchecked is the ctype function
+        self.assertTrue(function.unchecked is function.ctype)
+        got = np.vectorize(function.unchecked)(X)
+        self.assertTrue(np.allclose(expect, got))
+
+        self.assertRaises(TypeError, function, 1, 2)
+
+    def test_call_trampoline(self):
+        context = Context(TypeSystem())
+
+        funcdef = sample_call_function_2(context)
+
+        incrdef = context.get_function("incr").get_definition(('int32',))
+        incrimpl = incrdef.implement()
+        b = Builder(incrimpl.append_basic_block())
+        b.ret(b.add(incrimpl.args[0], b.const('int32', 1)))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+
+        jit = JIT(manager, {'': backend})
+        jit.compile(incrdef)
+        function = jit.compile(funcdef, trampoline=True)
+
+        # the trampoline is a builtin function
+        self.assertEqual(type(function.unchecked), type(len))
+        self.assertEqual(function(41), 42)
+        self.assertEqual(function(-1), 0)
+
+        # the trampoline is cached
+        self.assertTrue(function == jit.compile(funcdef, trampoline=True))
+
+        self.assertRaises(TypeError, function)
+        self.assertRaises(TypeError, function, 1, 2)
+        self.assertRaises(TypeError, function, "a")
+
+    def test_concurrent_compile(self):
+        context = Context(TypeSystem())
+
+        funcdef = sample_call_function_2(context)
+
+        incrdef = context.get_function("incr").get_definition(('int32',))
+        incrimpl = incrdef.implement()
+        b = Builder(incrimpl.append_basic_block())
+        b.ret(b.add(incrimpl.args[0], b.const('int32', 1)))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+
+        jit = JIT(manager, {'': backend})
+        jit.compile(incrdef)
+
+        functions = []
+        def compile():
+            functions.append(jit.compile(funcdef))
+            functions.append(jit.compile(funcdef, trampoline=True))
+
+        threads = [threading.Thread(target=compile) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # every thread gets the same compiled function
+        self.assertEqual(len(functions), 16)
+        for function in functions[2:]:
+            self.assertTrue(function == functions[0] or
+                            function == functions[1])
+        for function in functions:
+            self.assertEqual(function(41), 42)
+
+    def test_compile_after_failure(self):
+        context = Context(TypeSystem())
+        funcdef = sample_call_function_2(context)
+        incrdef = context.get_function("incr").get_definition(('int32',))
+        incrimpl = incrdef.implement()
+        b = Builder(incrimpl.append_basic_block())
+        b.ret(b.add(incrimpl.args[0], b.const('int32', 1)))
+
+        lock = threading.Lock()
+        counts = {'active': 0, 'peak': 0, 'failed': 0}
+
+        class FlakyBackend(LLVMBackend):
+            # the first compile of funcdef fails after a while
+            def compile(self, defn):
+                if defn is not funcdef:
+                    return super(FlakyBackend, self).compile(defn)
+                with lock:
+                    counts['active'] += 1
+                    counts['peak'] = max(counts['peak'], counts['active'])
+                    fail = not counts['failed']
+                    counts['failed'] = 1
+                try:
+                    time.sleep(0.05)
+                    if fail:
+                        raise RuntimeError("compile failed")
+                    return super(FlakyBackend, self).compile(defn)
+                finally:
+                    with lock:
+                        counts['active'] -= 1
+
+        backend = FlakyBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        jit.compile(incrdef)
+
+        functions = []
+        def compile():
+            try:
+                functions.append(jit.compile(funcdef))
+            except RuntimeError:
+                pass
+
+        threads = [threading.Thread(target=compile) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # the waiting threads compile one at a time after the failure
+        self.assertEqual(counts['peak'], 1)
+        self.assertEqual(len(functions), 3)
+        for function in functions:
+            self.assertEqual(function(41), 42)
+
+    def test_code_cache_eviction(self):
+        context = Context(TypeSystem())
+
+        funcdef = sample_call_function_2(context)
+
+        incrdef = context.get_function("incr").get_definition(('int32',))
+        incrimpl = incrdef.implement()
+        b = Builder(incrimpl.append_basic_block())
+        b.ret(b.add(incrimpl.args[0], b.const('int32', 1)))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        manager = LLVMExecutionManager(max_segments=1)
+
+        jit = JIT(manager, {'': backend})
+        incr = jit.compile(incrdef)
+        function = jit.compile(funcdef)
+        self.assertEqual(function(41), 42)
+
+        # incr is called by foo and foo is referenced
+        self.assertEqual(manager.segment_count, 2)
+        self.assertTrue(manager.nbytes > 0)
+        del incr
+        self.assertEqual(manager.evict(), 0)
+
+        # foo is unreferenced; incr is unreferenced once foo is evicted
+        del function
+        gc.collect()
+        self.assertEqual(manager.evict(), 1)
+        self.assertFalse(manager.has_function(funcdef))
+        self.assertTrue(manager.has_function(incrdef))
+
+        # recompiled on demand
+        function = jit.compile(funcdef)
+        self.assertEqual(function(1), 2)
+
+        # a dropped callee is evicted and built again for its caller
+        manager = LLVMExecutionManager(max_segments=0)
+        jit = JIT(manager, {'': backend})
+        jit.compile(incrdef)
+        gc.collect()
+        self.assertEqual(manager.evict(), 1)
+        self.assertFalse(manager.has_function(incrdef))
+        function = jit.compile(funcdef)
+        self.assertTrue(manager.has_function(incrdef))
+        self.assertEqual(function(41), 42)
+
+    def test_lazy_compile(self):
+        context = Context(TypeSystem())
+
+        funcdef = sample_call_function_2(context)
+
+        incrdef = context.get_function("incr").get_definition(('int32',))
+        incrimpl = incrdef.implement()
+        b = Builder(incrimpl.append_basic_block())
+        b.ret(b.add(incrimpl.args[0], b.const('int32', 1)))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+
+        jit = JIT(manager, {'': backend})
+        incr = jit.compile(incrdef, lazy=True)
+        function = jit.compile(funcdef, lazy=True)
+
+        # nothing is compiled until the first call
+        self.assertFalse(function.is_compiled)
+        self.assertFalse(manager.has_function(incrdef))
+        self.assertFalse(manager.has_function(funcdef))
+
+        self.assertEqual(incr(1), 2)
+        self.assertEqual(function(41), 42)
+        self.assertTrue(function.is_compiled)
+        self.assertTrue(type(function.materialize()) is JITFunction)
+        self.assertTrue(function == jit.compile(funcdef, lazy=True))
+
+    def test_lazy_compile_threads(self):
+        context = Context(TypeSystem())
+
+        funcdef = sample_call_function_2(context)
+
+        incrdef = context.get_function("incr").get_definition(('int32',))
+        incrimpl = incrdef.implement()
+        b = Builder(incrimpl.append_basic_block())
+        b.ret(b.add(incrimpl.args[0], b.const('int32', 1)))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+
+        jit = JIT(manager, {'': backend})
+        function = jit.compile(funcdef, lazy=True)
+
+        start = threading.Event()
+        results = []
+        def call():
+            start.wait()
+            results.append(function(41))
+            results.append(function.ctype(1))
+            results.append(function.unchecked(2))
+
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for t in threads:
+            t.start()
+        # every thread makes its first call at the same time
+        start.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(results), [2] * 8 + [3] * 8 + [42] * 8)
+        self.assertTrue(function.is_compiled)
+        self.assertTrue(function == jit.compile(funcdef))
+
+    def test_replace_function(self):
+        context = Context(TypeSystem())
+
+        funcdef = sample_call_function_2(context)
+
+        incrdef = context.get_function("incr").get_definition(('int32',))
+        incrimpl = incrdef.implement()
+        b = Builder(incrimpl.append_basic_block())
+        b.ret(b.add(incrimpl.args[0], b.const('int32', 1)))
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM, indirect=True)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+
+        jit = JIT(manager, {'': backend})
+        incr = jit.compile(incrdef)
+        function = jit.compile(funcdef)
+        self.assertEqual(function(41), 42)
+
+        # swap in int32 incr(int32 x) { return x + 2; }
+        module = lc.Module.new('incr.v2')
+        fnty = lc.Type.function(lc.Type.int(32), [lc.Type.int(32)])
+        mangled = LLVMBackend.mangle_function('incr', ('int32',))
+        lfunc = module.add_function(fnty, mangled)
+        lb = lc.Builder.new(lfunc.append_basic_block('entry'))
+        lb.ret(lb.add(lfunc.args[0], lc.Constant.int(lc.Type.int(32), 2)))
+        manager.replace_function(backend, incrdef, lfunc, {}, True)
+
+        # callers and existing JITFunctions use the new version
+        self.assertEqual(function(41), 43)
+        self.assertEqual(incr(1), 3)
+        self.assertEqual(manager.release_retired(), 1)
+
+        # back to the MLVM implementation
+        jit.recompile(incrdef)
+        self.assertEqual(function(41), 42)
+        self.assertEqual(incr(1), 2)
+
+        # a backend with direct calls cannot replace functions
+        direct = JIT(LLVMExecutionManager(), {'': LLVMBackend()})
+        direct.compile(incrdef)
+        self.assertRaises(ValueError, direct.recompile, incrdef)
+
 if __name__ == '__main__':
     unittest.main()
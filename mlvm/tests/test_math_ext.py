@@ -0,0 +1,144 @@
+from mlvm.ir import *
+from mlvm import irutil
+from mlvm.jit import *
+from mlvm.llvm.jit import *
+from mlvm.llvm.backend import *
+from mlvm.llvm.ext import arraytype as ext_arraytype
+from mlvm.llvm.ext import vectortype as ext_vectortype
+from mlvm.llvm.ext import mathlib as ext_mathlib
+
+import numpy as np
+import unittest
+
+class TestMathExtension(unittest.TestCase):
+    def setUp(self):
+        self.context = Context(TypeSystem())
+        self.context.install(ext_arraytype)
+        self.context.install(ext_vectortype)
+        self.context.install(ext_mathlib)
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        backend.install(ext_vectortype)
+        backend.install(ext_mathlib)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        self.jit = JIT(manager, {'': backend})
+        self.count = 0
+
+    def _compile_map(self, name, elemtype, nargs):
+        # void map(array_T X..., array_T Y, address n)
+        # { Y[i] = name(X[i]...) }
+        arraytype = 'array_%s' % elemtype
+        self.count += 1
+        function = self.context.add_function('map%d' % self.count)
+        funcdef = function.add_definition('void', (arraytype,) * (nargs + 1)
+                                                  + ('address',))
+        impl = funcdef.implement()
+        arrays = impl.args[:-1]
+        n = impl.args[-1]
+        b = Builder(impl.append_basic_block())
+        idx = b.var('address')
+        idx.initializer = b.const('address', 0)
+        with irutil.for_range(b, idx, n):
+            values = [b.array_load(X, idx) for X in arrays[:-1]]
+            b.array_store(arrays[-1], getattr(b, name)(*values), idx)
+        b.ret()
+        return self.jit.compile(funcdef)
+
+    def _check(self, name, gold, args, rtol):
+        for elemtype, dtype in [('double', np.float64), ('float', np.float32)]:
+            function = self._compile_map(name, elemtype, len(args))
+            arrays = [np.asarray(x, dtype=dtype) for x in args]
+            out = np.zeros(len(arrays[0]), dtype=dtype)
+            function(*(arrays + [out, len(out)]))
+            expect = gold(*arrays)
+            tol = rtol if dtype == np.float64 else 1e-5
+            self.assertTrue(np.allclose(out, expect, rtol=tol, atol=0,
+                                        equal_nan=True),
+                            (name, elemtype, out, expect))
+
+    def test_scalar(self):
+        X = np.linspace(-20, 20, 1001)
+        P = np.concatenate([np.logspace(-30, 30, 601), [0, 1, np.inf]])
+        S = np.linspace(-100, 100, 1001)
+        self._check('math_sqrt', np.sqrt, [P], 0)
+        self._check('math_fabs', np.fabs, [X], 0)
+        self._check('math_floor', np.floor, [X], 0)
+        self._check('math_ceil', np.ceil, [X], 0)
+        self._check('math_exp', np.exp, [X], 1e-14)
+        self._check('math_expm1', np.expm1, [X / 1000], 1e-14)
+        self._check('math_log', np.log, [P], 1e-14)
+        self._check('math_tanh', np.tanh, [X / 10], 1e-14)
+        self._check('math_pow', np.power,
+                    [P[300:400], np.ones(100) * -2.5], 1e-13)
+        self._check('math_pow', np.power,
+                    [-np.arange(10.0), np.arange(10.0)], 1e-13)
+        self._check('math_fma', lambda a, b, c: a * b + c,
+                    [X, X, np.fabs(X) + 1], 1e-15)
+
+        # sin and cos are not relative to the zeros
+        for name, gold in [('math_sin', np.sin), ('math_cos', np.cos)]:
+            function = self._compile_map(name, 'double', 1)
+            out = np.zeros_like(S)
+            function(S, out, len(S))
+            self.assertTrue(np.allclose(out, gold(S), rtol=0, atol=1e-14))
+
+    def test_special(self):
+        inf = np.inf
+        X = np.array([-inf, inf, np.nan, -1, 0, 1000])
+        for name, gold in [('math_exp', np.exp), ('math_log', np.log),
+                           ('math_tanh', np.tanh), ('math_sin', np.sin)]:
+            function = self._compile_map(name, 'double', 1)
+            out = np.zeros_like(X)
+            function(X, out, len(X))
+            with np.errstate(all='ignore'):
+                expect = gold(X)
+            self.assertTrue(np.allclose(out, expect, rtol=1e-14, atol=0,
+                                        equal_nan=True), (name, out, expect))
+
+    def test_limits(self):
+        # finite results just below overflow
+        for elemtype, dtype, X, rtol in [
+                ('double', np.float64, [709.0, 709.5, 709.78], 1e-13),
+                ('float', np.float32, [88.0, 88.5, 88.7], 1e-5)]:
+            X = np.array(X, dtype=dtype)
+            for name, gold in [('math_exp', np.exp),
+                               ('math_expm1', np.expm1)]:
+                function = self._compile_map(name, elemtype, 1)
+                out = np.zeros_like(X)
+                function(X, out, len(X))
+                self.assertTrue(np.all(np.isfinite(out)), (name, out))
+                self.assertTrue(np.allclose(out, gold(X), rtol=rtol, atol=0))
+
+            pow = self._compile_map('math_pow', elemtype, 2)
+            two = np.ones_like(X) * 2
+            Y = X / np.log(dtype(2))
+            out = np.zeros_like(X)
+            pow(two, Y, out, len(X))
+            self.assertTrue(np.all(np.isfinite(out)), out)
+            self.assertTrue(np.allclose(out, np.power(two, Y), rtol=rtol * 10,
+                                        atol=0))
+
+    def test_vector(self):
+        # void vexp(array_double X, array_double Y, address n)
+        # { Y[i:i+4] = exp(X[i:i+4]) }
+        function = self.context.add_function("vexp")
+        funcdef = function.add_definition('void', ('array_double',
+                                                   'array_double',
+                                                   'address'))
+        impl = funcdef.implement()
+        X, Y, n = impl.args
+        b = Builder(impl.append_basic_block())
+        idx = b.var('address')
+        idx.initializer = b.const('address', 0)
+        with irutil.for_range(b, idx, n, b.const('address', 4)):
+            b.vector_store(b.math_exp(b.double4_load(X, idx)), Y, idx)
+        b.ret()
+        vexp = self.jit.compile(funcdef)
+
+        X = np.linspace(-10, 10, 64)
+        Y = np.zeros(64)
+        vexp(X, Y, 64)
+        self.assertTrue(np.allclose(Y, np.exp(X), rtol=1e-14, atol=0))
+
+if __name__ == '__main__':
+    unittest.main()
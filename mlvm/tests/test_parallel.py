@@ -0,0 +1,227 @@
+from mlvm.ir import *
+from mlvm import irutil
+from mlvm.jit import *
+from mlvm.llvm.jit import *
+from mlvm.llvm.backend import *
+from mlvm.llvm.ext import arraytype as ext_arraytype
+from mlvm.parallel import ParallelExecutor, split_range
+from mlvm.llvm.process import ProcessExecutor
+
+import os
+import numpy as np
+from ctypes import c_float, c_double
+from .support import sample_array_function_1
+import unittest
+
+class TestParallel(unittest.TestCase):
+    def test_split_range(self):
+        self.assertEqual(split_range(10, 4, 1), [(0, 3), (3, 6), (6, 9), (9, 10)])
+        self.assertEqual(split_range(10, 4, 5), [(0, 5), (5, 10)])
+        self.assertEqual(split_range(0, 4), [(0, 0)])
+
+    def test_parallel_array_float(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+        funcdef = sample_array_function_1(context, 'array_float')
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+
+        executor = ParallelExecutor(threads=4)
+        try:
+            function = jit.compile(funcdef, gil=False)
+            A = np.arange(100000, dtype=np.float32)
+            B = A * 2
+            C = np.zeros_like(A)
+            results = function.parallel(A, B, C, A.shape[0], grain=1000,
+                                        executor=executor)
+            self.assertEqual(len(results), 4)
+            self.assertEqual(sum(results), A.shape[0])
+            self.assertTrue(np.allclose((A + B) * 3.14, C))
+
+            # must not hold the GIL
+            manager = LLVMExecutionManager()
+            function = JIT(manager, {'': backend}).compile(funcdef)
+            self.assertRaises(ValueError, function.parallel,
+                              A, B, C, A.shape[0])
+        finally:
+            executor.close()
+
+    def test_process_array_float(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+        funcdef = sample_array_function_1(context, 'array_float')
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+
+        executor = ProcessExecutor(processes=2)
+        try:
+            # the GIL may be held
+            function = jit.compile(funcdef)
+            N = 10000
+            A = executor.empty(N, c_float)
+            B = executor.empty(N, c_float)
+            C = executor.empty(N, c_float)
+            A[:] = np.arange(N)
+            B[:] = A * 2
+            results = function.parallel(A, B, C, N, grain=1000,
+                                        executor=executor)
+            self.assertEqual(results, [N // 2, N // 2])
+            self.assertTrue(np.allclose((A + B) * 3.14, C))
+
+            # arrays must be in shared memory
+            D = np.zeros_like(A)
+            self.assertRaises(ValueError, function.parallel, A, B, D, N,
+                              executor=executor)
+        finally:
+            executor.close()
+
+    def test_process_callee(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # float twice(float x) { return x * 2 }
+        twice = context.add_function("twice")
+        twicedef = twice.add_definition('float', ('float',))
+        impl = twicedef.implement()
+        b = Builder(impl.append_basic_block())
+        b.ret(b.mul(impl.args[0], b.const('float', 2)))
+
+        # address apply(array_float A, array_float C, address n)
+        # { C[i] = twice(A[i]); return n }
+        func = context.add_function("apply")
+        funcdef = func.add_definition('address', ('array_float', 'array_float',
+                                                  'address'))
+        impl = funcdef.implement()
+        A, C, N = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('address')
+        i.initializer = b.const('address', 0)
+        with irutil.for_range(b, i, N):
+            b.array_store(C, b.call(twice, b.array_load(A, i)), i)
+        b.ret(N)
+
+        # slots of indirect calls are resolved in the workers
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM, indirect=True)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+
+        executor = ProcessExecutor(processes=2)
+        try:
+            jit.compile(twicedef)
+            function = jit.compile(funcdef)
+            N = 1000
+            A = executor.empty(N, c_float)
+            C = executor.empty(N, c_float)
+            A[:] = np.arange(N)
+            for _ in range(2):  # the second call reuses the workers' kernel
+                results = function.parallel(A, C, N, grain=100,
+                                            executor=executor)
+                self.assertEqual(sum(results), N)
+                self.assertTrue(np.all(C == A * 2))
+                C[:] = 0
+        finally:
+            executor.close()
+
+    def test_parallel_range(self):
+        context = Context(TypeSystem())
+        context.install(ext_arraytype)
+
+        # void rowsum(array_double A, array_double S, address m, address n)
+        # { parallel for i < m: S[i] = sum(A[i * n:(i + 1) * n]) }
+        func = context.add_function("rowsum")
+        funcdef = func.add_definition('void', ('array_double', 'array_double',
+                                               'address', 'address'))
+        impl = funcdef.implement()
+        A, S, M, N = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('address')
+        i.initializer = b.const('address', 0)
+        with irutil.parallel_range(b, i, M, schedule='dynamic', chunk=3):
+            j = b.var('address')
+            acc = b.var('double')
+            b.assign(b.const('address', 0), j)
+            b.assign(b.const('double', 0), acc)
+            with irutil.for_range(b, j, N):
+                x = b.array_load(A, b.add(b.mul(i, N), j))
+                b.assign(b.add(acc, x), acc)
+            b.array_store(S, acc, i)
+        b.ret()
+
+        # void scale(array_double A, address m, address n)
+        # { parallel for i < m: parallel for j < n: A[i * n + j] *= 2 }
+        func = context.add_function("scale")
+        scaledef = func.add_definition('void', ('array_double', 'address',
+                                                'address'))
+        impl = scaledef.implement()
+        A, M, N = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('address')
+        i.initializer = b.const('address', 0)
+        two = b.const('double', 2)
+        with irutil.parallel_range(b, i, M):
+            j = b.var('address')
+            b.assign(b.const('address', 0), j)
+            with irutil.parallel_range(b, j, N, vectorize_width=2):
+                k = b.add(b.mul(i, N), j)
+                b.array_store(A, b.mul(b.array_load(A, k), two), k)
+        b.ret()
+
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        jit = JIT(manager, {'': backend})
+        rowsum = jit.compile(funcdef)
+        scale = jit.compile(scaledef)
+
+        A = np.arange(1000 * 37, dtype=np.float64).reshape(1000, 37)
+        S = np.zeros(1000)
+        rowsum(A, S, 1000, 37)
+        self.assertTrue(np.allclose(A.sum(axis=1), S))
+
+        B = A.copy()
+        scale(B, 1000, 37)
+        self.assertTrue(np.all(B == A * 2))
+        scale(B, 0, 37)
+        self.assertTrue(np.all(B == A * 2))
+
+        # a forked child starts its own workers
+        pid = os.fork()
+        if not pid:
+            C = A.copy()
+            scale(C, 1000, 37)
+            os._exit(0 if np.all(C == A * 2) else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+        # the workers of a process executor link the runtime
+        executor = ProcessExecutor(processes=2)
+        try:
+            N = 1000 * 37
+            C = executor.empty(N, c_double)
+            C[:] = A.ravel()
+            scale.parallel(C, 1, N, grain=N // 4, executor=executor)
+            self.assertTrue(np.all(C == A.ravel() * 2))
+        finally:
+            executor.close()
+
+        # the body cannot return
+        func = context.add_function("early")
+        earlydef = func.add_definition('void', ('address',))
+        impl = earlydef.implement()
+        M, = impl.args
+        b = Builder(impl.append_basic_block())
+        i = b.var('address')
+        i.initializer = b.const('address', 0)
+        with irutil.parallel_range(b, i, M):
+            b.ret()
+        b.ret()
+        self.assertRaises(TypeError, backend.compile, earlydef)
+
+if __name__ == '__main__':
+    unittest.main()
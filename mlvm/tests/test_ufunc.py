@@ -0,0 +1,99 @@
+from mlvm.ir import *
+from mlvm import irutil
+from mlvm.jit import *
+from mlvm.llvm.jit import *
+from mlvm.llvm.backend import *
+from mlvm.llvm.ext import arraytype as ext_arraytype
+from mlvm.llvm.ufunc import make_ufunc, make_gufunc, parse_layout
+
+import numpy as np
+import unittest
+
+def sample_scalar_function(context, ty):
+    '''ty foo(ty x, ty y) { return x + y * 2; }
+    '''
+    function = context.get_or_insert_function("foo")
+    funcdef = function.add_definition(ty, (ty, ty))
+    impl = funcdef.implement()
+    x, y = impl.args
+    b = Builder(impl.append_basic_block())
+    b.ret(b.add(x, b.mul(y, b.const(ty, 2))))
+    return funcdef
+
+def sample_dot_kernel(context):
+    '''Kernel of the layout (n),(n)->()
+    '''
+    function = context.get_or_insert_function("dot")
+    argtys = ('array_double', 'array_double', 'array_double',
+              'address', 'address', 'address')
+    funcdef = function.add_definition('void', argtys)
+    impl = funcdef.implement()
+    A, B, C, n, sa, sb = impl.args
+    b = Builder(impl.append_basic_block())
+
+    idx = b.var('address')
+    idx.initializer = b.const('address', 0)
+    acc = b.var('double')
+    acc.initializer = b.const('double', 0.0)
+    with irutil.for_range(b, idx, n):
+        lval = b.array_load(A, b.mul(idx, sa))
+        rval = b.array_load(B, b.mul(idx, sb))
+        b.assign(b.add(acc, b.mul(lval, rval)), acc)
+    b.array_store(C, acc, b.const('address', 0))
+    b.ret()
+    return funcdef
+
+class TestUFunc(unittest.TestCase):
+    def setUp(self):
+        self.context = Context(TypeSystem())
+        self.context.install(ext_arraytype)
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        self.jit = JIT(manager, {'': backend})
+
+    def test_parse_layout(self):
+        self.assertEqual(parse_layout("(m,n),(n)->(m)"),
+                         ([('m', 'n'), ('n',)], [('m',)]))
+        self.assertEqual(parse_layout("(),() -> ()"), ([(), ()], [()]))
+        self.assertRaises(ValueError, parse_layout, "(n)")
+
+    def test_ufunc(self):
+        funcdefs = [sample_scalar_function(self.context, ty)
+                    for ty in ('float', 'double')]
+        foo = make_ufunc(self.jit, funcdefs)
+
+        self.assertEqual(foo.nin, 2)
+        self.assertEqual(foo.types, ['ff->f', 'dd->d'])
+
+        A = np.arange(12, dtype=np.float32).reshape(3, 4)
+        B = np.arange(4, dtype=np.float32)
+        got = foo(A, B)
+        self.assertEqual(got.dtype, np.float32)
+        self.assertTrue(np.allclose(A + B * 2, got))
+
+        # strided and out=
+        X = np.arange(20.)[::2]
+        out = np.empty(10)
+        self.assertTrue(foo(X, 1.5, out=out) is out)
+        self.assertTrue(np.allclose(X + 3, out))
+
+        # reduction
+        self.assertTrue(np.allclose(foo.reduce(X), X[0] + X[1:].sum() * 2))
+
+    def test_gufunc(self):
+        dot = make_gufunc(self.jit, [sample_dot_kernel(self.context)],
+                          "(n),(n)->()")
+        A = np.random.random((5, 7))
+        B = np.random.random(7)
+        self.assertTrue(np.allclose(A.dot(B), dot(A, B)))
+        # non-contiguous core dimensions
+        S = np.random.random(14)[::2]
+        self.assertTrue(np.allclose(A.dot(S), dot(A, S)))
+        C = np.asfortranarray(A)
+        self.assertTrue(np.allclose(A.dot(B), dot(C, B)))
+        # a core dimension of one element
+        self.assertTrue(np.allclose(A[:, :1].dot(B[:1]), dot(A[:, :1], B[:1])))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+from mlvm.ir import *
+from mlvm import irutil
+from mlvm.jit import *
+from mlvm.llvm.jit import *
+from mlvm.llvm.backend import *
+from mlvm.llvm.ext import arraytype as ext_arraytype
+from mlvm.llvm.ext import vectortype as ext_vectortype
+
+import numpy as np
+import unittest
+
+class TestVectorExtension(unittest.TestCase):
+    def setUp(self):
+        self.context = Context(TypeSystem())
+        self.context.install(ext_arraytype)
+        self.context.install(ext_vectortype)
+        backend = LLVMBackend(opt=LLVMBackend.OPT_MAXIMUM)
+        backend.install(ext_arraytype)
+        backend.install(ext_vectortype)
+        manager = LLVMExecutionManager(opt=LLVMExecutionManager.OPT_MAXIMUM)
+        self.jit = JIT(manager, {'': backend})
+
+    def test_saxpy(self):
+        # void saxpy(array_float X, array_float Y, float a, address n)
+        # { Y[i:i+4] = a * X[i:i+4] + Y[i:i+4] }
+        function = self.context.add_function("saxpy")
+        funcdef = function.add_definition('void', ('array_float',
+                                                   'array_float',
+                                                   'float', 'address'))
+        impl = funcdef.implement()
+        X, Y, a, n = impl.args
+        b = Builder(impl.append_basic_block())
+        idx = b.var('address')
+        idx.initializer = b.const('address', 0)
+        va = b.float4_splat(a)
+        with irutil.for_range(b, idx, n, b.const('address', 4)):
+            vx = b.float4_load(X, idx)
+            vy = b.float4_load(Y, idx)
+            b.vector_store(b.vector_fma(va, vx, vy), Y, idx)
+        b.ret()
+
+        saxpy = self.jit.compile(funcdef)
+        X = np.arange(64, dtype=np.float32)
+        Y = np.ones(65, dtype=np.float32)
+        Gold = X * 3 + 1
+        saxpy(X, Y[1:], 3, 64)  # unaligned
+        self.assertTrue(np.allclose(Gold, Y[1:]))
+        self.assertEqual(Y[0], 1)
+
+    def test_lanes(self):
+        # double clamped_sum(double4 v)
+        # { return sum(v < 0 ? 0 : v) }
+        function = self.context.add_function("clamped_sum")
+        funcdef = function.add_definition('double', ('double4',))
+        impl = funcdef.implement()
+        v, = impl.args
+        b = Builder(impl.append_basic_block())
+        zero = b.const('double4', 0)
+        b.ret(b.vector_sum(b.vector_select(b.vector_lt(v, zero), zero, v)))
+        clamped_sum = self.jit.compile(funcdef)
+
+        self.assertEqual(clamped_sum([1, -2, 3, -4]), 4)
+        self.assertEqual(clamped_sum(np.arange(4.0)), 6)
+        X = np.arange(4.0)
+        self.assertEqual(clamped_sum(X.ctypes.data), 6)
+        self.assertRaises(ValueError, clamped_sum, [1, 2])
+
+        # int32 last(int32x4 v) { return reverse(v)[0] + max(v) }
+        function = self.context.add_function("last")
+        funcdef = function.add_definition('int32', ('int32x4',))
+        impl = funcdef.implement()
+        v, = impl.args
+        b = Builder(impl.append_basic_block())
+        reverse = b.vector_shuffle(v, b.const('int32x4', [3, 2, 1, 0]))
+        first = b.vector_extract(reverse, b.const('address', 0))
+        b.ret(b.add(first, b.vector_max(b.mul(v, v))))
+        last = self.jit.compile(funcdef)
+
+        self.assertEqual(last([1, -5, 2, 3]), 3 + 25)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import sys, ctypes
+from collections import namedtuple
 
 #
 # Native address width
@@ -19,7 +20,141 @@ else:
     PYOBJECT_HEAD_LEN = 2 * ADDRESS_WIDTH
 
 #
-# Offset to data pointer in a memoryview object
+# Py_buffer structure of the buffer protocol
 #
-MEMORYVIEW_DATA_OFFSET = PYOBJECT_HEAD_LEN + ADDRESS_WIDTH
+class PyBuffer(ctypes.Structure):
+    _fields_ = [('buf',         ctypes.c_void_p),
+                ('obj',         ctypes.c_void_p),
+                ('len',         ctypes.c_ssize_t),
+                ('itemsize',    ctypes.c_ssize_t),
+                ('readonly',    ctypes.c_int),
+                ('ndim',        ctypes.c_int),
+                ('format',      ctypes.c_char_p),
+                ('shape',       ctypes.POINTER(ctypes.c_ssize_t)),
+                ('strides',     ctypes.POINTER(ctypes.c_ssize_t)),
+                ('suboffsets',  ctypes.POINTER(ctypes.c_ssize_t))]
+    if sys.version_info[0] < 3:
+        _fields_ += [('smalltable', ctypes.c_ssize_t * 2)]
+    _fields_ += [('internal', ctypes.c_void_p)]
 
+#
+# Buffer request flags
+#
+PyBUF_SIMPLE = 0
+PyBUF_WRITABLE = 0x0001
+PyBUF_FORMAT = 0x0004
+PyBUF_ND = 0x0008
+PyBUF_STRIDES = 0x0010 | PyBUF_ND
+PyBUF_C_CONTIGUOUS = 0x0020 | PyBUF_STRIDES
+PyBUF_ANY_CONTIGUOUS = 0x0080 | PyBUF_STRIDES
+
+#
+# PyMethodDef structure for building builtin function objects
+#
+class PyMethodDef(ctypes.Structure):
+    _fields_ = [('ml_name',  ctypes.c_char_p),
+                ('ml_meth',  ctypes.c_void_p),
+                ('ml_flags', ctypes.c_int),
+                ('ml_doc',   ctypes.c_char_p)]
+
+METH_VARARGS = 0x0001
+METH_FASTCALL = 0x0080
+
+#
+# Calling convention of builtin functions.
+# METH_FASTCALL is public since Python 3.7.
+#
+if sys.version_info >= (3, 7):
+    METH_CALLCONV = METH_FASTCALL
+else:
+    METH_CALLCONV = METH_VARARGS
+
+#
+# Array interface type string of a ctypes scalar type
+#
+_TYPECODE_KIND = {
+    'b' : 'i', 'h' : 'i', 'i' : 'i', 'l' : 'i', 'q' : 'i',
+    'B' : 'u', 'H' : 'u', 'I' : 'u', 'L' : 'u', 'Q' : 'u',
+    'f' : 'f', 'd' : 'f', 'g' : 'f',
+    '?' : 'b',
+}
+
+if sys.byteorder == 'little':
+    _NATIVE_ORDER = '<'
+else:
+    _NATIVE_ORDER = '>'
+
+def ctype_typestr(cty):
+    '''Returns the type string of the array interface for a ctypes
+    scalar type; e.g. '<f4' for c_float.
+    '''
+    kind = _TYPECODE_KIND[cty._type_]
+    size = ctypes.sizeof(cty)
+    order = '|' if size == 1 else _NATIVE_ORDER
+    return '%s%s%d' % (order, kind, size)
+
+#
+# Buffer protocol access from Python
+#
+_PyObject_GetBuffer = ctypes.pythonapi.PyObject_GetBuffer
+_PyObject_GetBuffer.restype = ctypes.c_int
+_PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(PyBuffer),
+                                ctypes.c_int]
+
+_PyBuffer_Release = ctypes.pythonapi.PyBuffer_Release
+_PyBuffer_Release.restype = None
+_PyBuffer_Release.argtypes = [ctypes.POINTER(PyBuffer)]
+
+BufferInfo = namedtuple('BufferInfo', ['address', 'nbytes', 'itemsize',
+                                       'readonly', 'format', 'shape',
+                                       'strides'])
+
+def get_buffer_info(obj, flags=PyBUF_C_CONTIGUOUS | PyBUF_FORMAT):
+    '''Query the buffer of an object with the buffer protocol.
+
+    The buffer is released before returning.  The address remains valid
+    as long as the object is alive and is not resized.
+    Raises BufferError or TypeError if the object does not provide
+    a buffer satisfying the flags.
+    '''
+    view = PyBuffer()
+    _PyObject_GetBuffer(obj, ctypes.byref(view), flags)
+    try:
+        if view.shape:
+            shape = tuple(view.shape[i] for i in range(view.ndim))
+        else:
+            shape = (view.len // max(view.itemsize, 1),)
+        if view.strides:
+            strides = tuple(view.strides[i] for i in range(view.ndim))
+        else:
+            strides = c_contiguous_strides(shape, view.itemsize)
+        return BufferInfo(view.buf or 0, view.len, view.itemsize,
+                          bool(view.readonly), view.format, shape, strides)
+    finally:
+        _PyBuffer_Release(ctypes.byref(view))
+
+def c_contiguous_strides(shape, itemsize):
+    '''Returns the strides in bytes of a C-contiguous array.
+    '''
+    strides = []
+    stride = itemsize
+    for extent in reversed(shape):
+        strides.append(stride)
+        stride *= extent
+    return tuple(reversed(strides))
+
+def typestr_of_format(format, itemsize):
+    '''Returns the array interface type string of a struct format of
+    a single native item; or None if it is not a simple scalar format.
+    '''
+    if format is None:
+        format = 'B'
+    if not isinstance(format, str):
+        format = format.decode('ascii')
+    if format[:1] in '@=':
+        format = format[1:]
+    kind = _TYPECODE_KIND.get(format)
+    if len(format) != 1 or kind is None:
+        return None
+    order = '|' if itemsize == 1 else _NATIVE_ORDER
+    return '%s%s%d' % (order, kind, itemsize)